@@ -0,0 +1,314 @@
+# coding:utf-8
+# @File  : start_rag_api.py
+# @Author: ganchun
+# @Date  :  2025/06/27
+# @Description: OpenAI兼容的RAG服务，提供/v1/chat/completions（支持SSE流式）和/retrieve接口
+#               在仓库根目录运行: python -m API.start_rag_api --workers 4
+
+import json
+import time
+import uuid
+import asyncio
+import argparse
+from functools import partial
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import uvicorn
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, field_validator
+
+from RAG.clients import create_async_openai_client
+from RAG.generation.context_builder import build_context, SYSTEM_PROMPT
+from RAG.retrieval.contextual_rewrite import (get_embeddings, list_knowledge_bases, load_knowledge_base,
+                                              get_kb_members, get_kb_cache_stats)
+from RAG.retrieval.query_router import routed_retrieve, get_router_stats
+from config import (LLM_API_URL, RAG_API_LLM_MODEL, RAG_API_HOST, RAG_API_PORT, RAG_API_WORKERS,
+                    RAG_API_DEFAULT_KB, RAG_API_BATCH_SIZE, RAG_API_BATCH_WAIT, RAG_API_MAX_CONCURRENCY,
+                    RAG_API_RETRIEVAL_WORKERS, RAG_API_PRELOAD_KBS)
+
+class ChatMessage(BaseModel):
+    role: str
+    content: Union[str, List[Dict[str, Any]], None] = ""
+
+    @field_validator("content", mode="before")
+    @classmethod
+    def join_text_parts(cls, content):
+        """OpenAI的多段内容格式（[{"type": "text", "text": ...}, ...]）只保留文本段并拼接，图片等其他类型忽略"""
+        if content is None:
+            return ""
+        if isinstance(content, list):
+            return "\n".join(part.get("text") or "" for part in content
+                             if isinstance(part, dict) and part.get("type") == "text")
+        return content
+
+
+class ChatCompletionRequest(BaseModel):
+    model: str = RAG_API_LLM_MODEL
+    messages: List[ChatMessage]
+    stream: bool = False
+    temperature: float = 0.7
+    max_tokens: int = 2048
+    # 以下为扩展字段
+    kb_name: str = RAG_API_DEFAULT_KB  # 检索的知识库，支持虚拟知识库
+    rerank_mode: Optional[str] = None  # 排序方式，为None时使用RERANK_MODE
+
+
+class RetrieveRequest(BaseModel):
+    query: str
+    kb_name: str = RAG_API_DEFAULT_KB
+    rerank_mode: Optional[str] = None
+
+
+class RetrievalBatcher:
+    """
+    检索请求微批处理
+
+    batch_wait秒内到达的请求（最多batch_size个）合并为一次嵌入请求，
+    之后各请求带着查询向量在线程池中并发检索，高并发时减少嵌入服务的请求次数
+    """
+
+    def __init__(self, batch_size: int = RAG_API_BATCH_SIZE, batch_wait: float = RAG_API_BATCH_WAIT,
+                 workers: int = RAG_API_RETRIEVAL_WORKERS):
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rag-api")
+        self._queue = None
+        self._task = None
+        self._stats = {"requests": 0, "batches": 0}
+
+    def start(self):
+        """在服务的事件循环中启动收集任务"""
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._collect())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        self.executor.shutdown(wait=False)
+
+    async def retrieve(self, kb_name: str, query: str, rerank_mode: Optional[str] = None) -> Dict[str, Any]:
+        """提交一次检索，返回routed_retrieve的结果"""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((kb_name, query, rerank_mode, future))
+        self._stats["requests"] += 1
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_wait
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # 处理过程中继续收集下一批
+            asyncio.create_task(self._process(batch))
+
+    async def _process(self, batch):
+        loop = asyncio.get_running_loop()
+        self._stats["batches"] += 1
+        try:
+            embeddings = await loop.run_in_executor(self.executor, get_embeddings, [item[1] for item in batch])
+        except Exception as e:
+            # 批量嵌入失败时各请求自行生成查询向量
+            print(f"批量嵌入查询出错: {e}")
+            embeddings = [None] * len(batch)
+
+        tasks = [loop.run_in_executor(self.executor, partial(
+            routed_retrieve, kb_name, query, rerank_mode=rerank_mode, query_embedding=embedding))
+            for (kb_name, query, rerank_mode, _), embedding in zip(batch, embeddings)]
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+        for (_, _, _, future), result in zip(batch, results):
+            if future.done():  # 客户端已断开
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        stats["avg_batch_size"] = stats["requests"] / stats["batches"] if stats["batches"] else 0.0
+        return stats
+
+
+batcher = RetrievalBatcher()
+llm_client = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global llm_client
+    batcher.start()
+    llm_client = create_async_openai_client(LLM_API_URL, max_connections=RAG_API_MAX_CONCURRENCY)
+    # 预加载常用知识库，避免首个请求承担加载耗时
+    loop = asyncio.get_running_loop()
+    for kb_name in RAG_API_PRELOAD_KBS:
+        for member in get_kb_members(kb_name) or [kb_name]:
+            await loop.run_in_executor(batcher.executor, load_knowledge_base, member)
+    yield
+    await batcher.close()
+    await llm_client.close()
+
+
+app = FastAPI(title="ERAG RAG API", lifespan=lifespan)
+
+
+def check_kb_name(kb_name: str):
+    if kb_name not in list_knowledge_bases() and get_kb_members(kb_name) is None:
+        raise HTTPException(status_code=404, detail=f"知识库 '{kb_name}' 不存在")
+
+
+async def retrieve(kb_name: str, query: str, rerank_mode: Optional[str]) -> Dict[str, Any]:
+    check_kb_name(kb_name)
+    try:
+        return await batcher.retrieve(kb_name, query, rerank_mode)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def build_rag_messages(messages: List[ChatMessage], references: List[Dict]) -> Tuple[List[Dict[str, str]], List[Dict]]:
+    """
+    在对话消息前插入带参考资料的系统提示，参考资料和历史消息按token预算裁剪
+
+    返回:
+        (消息列表, 实际放入上下文的参考资料)
+    """
+    # 客户端的系统消息附在默认系统提示之后
+    system_prompt = "\n\n".join([SYSTEM_PROMPT] + [message.content for message in messages if message.role == "system"])
+    history = [message.model_dump() for message in messages if message.role in ("user", "assistant")]
+    # 以最后一条用户消息为当前问题，其后的消息不参与上下文
+    last_user = max(i for i, message in enumerate(history) if message["role"] == "user")
+    return build_context(history[:last_user + 1], references, system_prompt=system_prompt)
+
+
+@app.post("/retrieve")
+async def retrieve_endpoint(request: RetrieveRequest):
+    """只检索不生成，返回query_info和检索到的文档"""
+    return await retrieve(request.kb_name, request.query, request.rerank_mode)
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: ChatCompletionRequest):
+    """
+    OpenAI兼容的对话接口
+
+    以最后一条用户消息检索知识库，参考资料放入系统提示后调用大模型；
+    响应中额外带有references和query_info字段，流式响应放在第一个数据块中
+    """
+    if request.model != RAG_API_LLM_MODEL:
+        raise HTTPException(status_code=400, detail=f"不支持的模型 '{request.model}'，可用模型: {RAG_API_LLM_MODEL}")
+    queries = [message.content for message in request.messages if message.role == "user"]
+    if not queries:
+        raise HTTPException(status_code=400, detail="messages中没有用户消息")
+
+    result = await retrieve(request.kb_name, queries[-1], request.rerank_mode)
+    messages, references = build_rag_messages(request.messages, result["retrieved_docs"])
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+
+    if request.stream:
+        return StreamingResponse(
+            stream_chat(request, messages, completion_id, created, references, result["query_info"]),
+            media_type="text/event-stream"
+        )
+
+    try:
+        response = await llm_client.chat.completions.create(
+            model=request.model,
+            messages=messages,
+            max_tokens=request.max_tokens,
+            temperature=request.temperature
+        )
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"生成回复时出错: {e}")
+
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": created,
+        "model": request.model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": response.choices[0].message.content},
+            "finish_reason": response.choices[0].finish_reason
+        }],
+        "usage": response.usage.model_dump() if response.usage else None,
+        "references": references,
+        "query_info": result["query_info"]
+    }
+
+
+async def stream_chat(request: ChatCompletionRequest, messages: List[Dict[str, str]],
+                      completion_id: str, created: int, references: List[Dict], query_info: Dict[str, Any]):
+    """以SSE格式产出chat.completion.chunk数据块，最后发送[DONE]"""
+
+    def event(delta: Dict[str, str], finish_reason: Optional[str] = None, **extra) -> str:
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": request.model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            **extra
+        }
+        return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+    yield event({"role": "assistant"}, references=references, query_info=query_info)
+    try:
+        response = await llm_client.chat.completions.create(
+            model=request.model,
+            messages=messages,
+            max_tokens=request.max_tokens,
+            temperature=request.temperature,
+            stream=True
+        )
+        finish_reason = "stop"
+        async for chunk in response:
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if choice.delta.content:
+                yield event({"content": choice.delta.content})
+            finish_reason = choice.finish_reason or finish_reason
+        yield event({}, finish_reason)
+    except Exception as e:
+        error = {"error": {"message": f"生成回复时出错: {e}", "type": "upstream_error"}}
+        yield f"data: {json.dumps(error, ensure_ascii=False)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+@app.get("/v1/models")
+async def list_models():
+    return {"object": "list", "data": [{"id": RAG_API_LLM_MODEL, "object": "model", "owned_by": "erag"}]}
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", "knowledge_bases": list_knowledge_bases(),
+            "kb_cache": get_kb_cache_stats(), "batcher": batcher.stats(), "router": get_router_stats()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI兼容的RAG服务")
+    parser.add_argument("--host", type=str, default=RAG_API_HOST)
+    parser.add_argument("--port", type=int, default=RAG_API_PORT)
+    parser.add_argument("--workers", type=int, default=RAG_API_WORKERS,
+                        help="工作进程数，开启INDEX_MMAP时各进程通过页缓存共享索引")
+    args = parser.parse_args()
+
+    # 多进程时uvicorn需要以导入路径加载应用
+    uvicorn.run("API.start_rag_api:app", host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+# coding:utf-8
+# @File  : bm25.py
+# @Author: ganchun
+# @Date  :  2025/06/23
+# @Description: 中文BM25倒排索引，构建知识库时生成，与FAISS索引一起保存，检索时用于精确词匹配
+
+import os
+import re
+import math
+from typing import Dict, List, Optional
+
+import numpy as np
+
+try:
+    import jieba
+except ImportError:
+    jieba = None
+
+from config import BM25_K1, BM25_B
+
+BM25_FILE = "bm25.npz"
+
+# 英文、数字、版本号等整体作为一个词，如qwen2.5、v1.0、gpt-4o
+ASCII_TOKEN = re.compile(r"[a-z0-9]+(?:[.\-_][a-z0-9]+)*")
+CJK_SPAN = re.compile(r"[\u4e00-\u9fff]+")
+
+
+def default_tokenizer() -> str:
+    """安装了jieba时使用jieba分词，否则使用汉字单字+二元组"""
+    return "jieba" if jieba is not None else "ngram"
+
+
+def tokenize(text: str, tokenizer: str = None) -> List[str]:
+    """
+    分词
+
+    英文和数字串整体保留（小写）；中文部分按tokenizer切分：
+        jieba - jieba搜索引擎模式分词
+        ngram - 单字和相邻二元组
+    """
+    tokenizer = tokenizer or default_tokenizer()
+    text = (text or "").lower()
+    tokens = ASCII_TOKEN.findall(text)
+    for span in CJK_SPAN.findall(text):
+        if tokenizer == "jieba":
+            tokens.extend(word for word in jieba.lcut_for_search(span) if word.strip())
+        else:
+            tokens.extend(span)
+            tokens.extend(span[i:i + 2] for i in range(len(span) - 1))
+    return tokens
+
+
+def build_bm25(texts: List[Optional[str]], tokenizer: str = None) -> Dict[str, np.ndarray]:
+    """
+    构建BM25倒排表
+
+    参数:
+        texts: 每个文档的待索引文本，下标即文档ID，None表示已删除的文档
+        tokenizer: 分词方式，为None时自动选择
+
+    返回:
+        CSR格式的倒排表数组：词i出现在doc_ids[indptr[i]:indptr[i + 1]]中，词频为对应的tfs
+    """
+    tokenizer = tokenizer or default_tokenizer()
+    vocab = {}
+    postings = []  # 词ID -> [(文档ID, 词频)]
+    doc_lengths = np.zeros(len(texts), dtype=np.float32)
+
+    for doc_id, text in enumerate(texts):
+        if text is None:
+            continue
+        tokens = tokenize(text, tokenizer)
+        doc_lengths[doc_id] = len(tokens)
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            term_id = vocab.setdefault(token, len(vocab))
+            if term_id == len(postings):
+                postings.append([])
+            postings[term_id].append((doc_id, count))
+
+    indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(items) for items in postings])
+    doc_ids = np.array([doc_id for items in postings for doc_id, _ in items], dtype=np.int32)
+    tfs = np.array([count for items in postings for _, count in items], dtype=np.float32)
+    return {
+        "terms": np.array(list(vocab.keys()), dtype=str),
+        "indptr": indptr,
+        "doc_ids": doc_ids,
+        "tfs": tfs,
+        "doc_lengths": doc_lengths,
+        "tokenizer": np.array(tokenizer)
+    }
+
+
+def save_bm25(path: str, arrays: Dict[str, np.ndarray]):
+    with open(path, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+class BM25Index:
+    """只读BM25索引"""
+
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        self.tokenizer = str(arrays["tokenizer"])
+        self.term_ids = {term: i for i, term in enumerate(arrays["terms"].tolist())}
+        self.indptr = arrays["indptr"]
+        self.doc_ids = arrays["doc_ids"]
+        self.tfs = arrays["tfs"]
+        self.doc_lengths = arrays["doc_lengths"]
+        self.doc_count = int(np.count_nonzero(self.doc_lengths))
+        self.avg_doc_length = float(self.doc_lengths.sum() / self.doc_count) if self.doc_count else 0.0
+
+    @classmethod
+    def load(cls, kb_dir: str) -> Optional["BM25Index"]:
+        """加载知识库目录中的BM25索引，不存在或分词器不可用时返回None"""
+        path = os.path.join(kb_dir, BM25_FILE)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            arrays = {key: data[key] for key in data.files}
+        if str(arrays["tokenizer"]) == "jieba" and jieba is None:
+            print("BM25索引使用jieba分词构建，但当前环境未安装jieba，跳过BM25检索")
+            return None
+        return cls(arrays)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.indptr.nbytes + self.doc_ids.nbytes + self.tfs.nbytes + self.doc_lengths.nbytes)
+
+    def search(self, query: str, top_k: int, k1: float = BM25_K1, b: float = BM25_B) -> Dict[int, float]:
+        """
+        BM25检索
+
+        返回:
+            得分最高的top_k个文档 {文档ID: 得分}
+        """
+        if not self.doc_count:
+            return {}
+        scores = np.zeros(len(self.doc_lengths), dtype=np.float32)
+        for token in dict.fromkeys(tokenize(query, self.tokenizer)):
+            term_id = self.term_ids.get(token)
+            if term_id is None:
+                continue
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            doc_ids = self.doc_ids[start:end]
+            tfs = self.tfs[start:end]
+            idf = math.log(1 + (self.doc_count - (end - start) + 0.5) / ((end - start) + 0.5))
+            norm = k1 * (1 - b + b * self.doc_lengths[doc_ids] / self.avg_doc_length)
+            scores[doc_ids] += idf * tfs * (k1 + 1) / (tfs + norm)
+
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        return {int(doc_id): float(scores[doc_id]) for doc_id in candidates}
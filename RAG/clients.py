@@ -0,0 +1,136 @@
+# coding:utf-8
+# @File  : clients.py
+# @Author: ganchun
+# @Date  :  2025/06/11
+# @Description: 共享的API客户端，复用连接池并缓存重排序模型句柄
+
+import threading
+from typing import Any, Dict, List, Optional
+
+import httpx
+from openai import OpenAI, AsyncOpenAI
+
+from config import (DOUBAO_API_URL, DOUBAO_API_KEY, LLM_API_URL,
+                    EMBEDDING_API_URL, RERANKER_API_URL, RERANKER_MODEL_UID,
+                    HTTP_TIMEOUT, HTTP_CONNECT_TIMEOUT, HTTP_MAX_CONNECTIONS,
+                    HTTP_MAX_KEEPALIVE_CONNECTIONS, HTTP_MAX_RETRIES, RERANK_HTTP_TIMEOUT)
+
+_lock = threading.Lock()
+_openai_clients = {}
+_reranker_model = None
+
+
+def get_openai_client(base_url: str, api_key: str = "not empty",
+                      timeout: Optional[float] = None) -> OpenAI:
+    """
+    获取指定端点的OpenAI兼容客户端，同一端点在进程内只创建一次
+
+    参数:
+        base_url: API地址
+        api_key: API密钥
+        timeout: 请求超时时间（秒），为None时使用HTTP_TIMEOUT
+
+    返回:
+        持有keep-alive连接池的OpenAI客户端
+    """
+    timeout = HTTP_TIMEOUT if timeout is None else timeout
+    key = (base_url, api_key, timeout)
+
+    with _lock:
+        client = _openai_clients.get(key)
+        if client is None:
+            http_client = httpx.Client(
+                limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                                    max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS),
+                timeout=httpx.Timeout(timeout, connect=HTTP_CONNECT_TIMEOUT)
+            )
+            client = OpenAI(api_key=api_key, base_url=base_url,
+                            http_client=http_client, max_retries=HTTP_MAX_RETRIES)
+            _openai_clients[key] = client
+        return client
+
+
+def create_async_openai_client(base_url: str, api_key: str = "not empty",
+                               timeout: Optional[float] = None,
+                               max_connections: int = HTTP_MAX_CONNECTIONS) -> AsyncOpenAI:
+    """
+    创建异步OpenAI兼容客户端
+
+    异步连接池绑定在创建它的事件循环上，因此不做进程级缓存，
+    由调用方在事件循环内创建并在结束时调用close()
+
+    参数:
+        base_url: API地址
+        api_key: API密钥
+        timeout: 请求超时时间（秒），为None时使用HTTP_TIMEOUT
+        max_connections: 最大连接数，一般与并发数一致
+
+    返回:
+        AsyncOpenAI客户端
+    """
+    timeout = HTTP_TIMEOUT if timeout is None else timeout
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=max_connections,
+                            max_keepalive_connections=max_connections),
+        timeout=httpx.Timeout(timeout, connect=HTTP_CONNECT_TIMEOUT)
+    )
+    # 重试由调用方带退避地处理
+    return AsyncOpenAI(api_key=api_key, base_url=base_url,
+                       http_client=http_client, max_retries=0)
+
+
+def get_embedding_client() -> OpenAI:
+    """本地嵌入模型服务客户端"""
+    return get_openai_client(EMBEDDING_API_URL)
+
+
+def get_llm_client() -> OpenAI:
+    """本地大模型服务客户端"""
+    return get_openai_client(LLM_API_URL)
+
+
+def get_doubao_client(api_key: str = DOUBAO_API_KEY) -> OpenAI:
+    """豆包API客户端"""
+    return get_openai_client(DOUBAO_API_URL, api_key)
+
+
+class RerankerModel:
+    """
+    Xinference重排序模型句柄，接口与xinference.client的rerank一致
+
+    直接请求Xinference的/v1/rerank接口：xinference.client基于不带超时的requests会话，
+    服务挂起时重排序线程会一直阻塞；这里使用带超时和连接池的httpx客户端
+    """
+
+    def __init__(self, base_url: str = RERANKER_API_URL, model_uid: str = RERANKER_MODEL_UID,
+                 timeout: float = RERANK_HTTP_TIMEOUT):
+        self.url = f"{base_url.rstrip('/')}/v1/rerank"
+        self.model_uid = model_uid
+        self.http_client = httpx.Client(
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS),
+            timeout=httpx.Timeout(timeout, connect=HTTP_CONNECT_TIMEOUT)
+        )
+
+    def rerank(self, documents: List[str], query: str) -> Dict[str, Any]:
+        response = self.http_client.post(self.url, json={"model": self.model_uid, "documents": documents,
+                                                         "query": query})
+        if response.status_code != 200:
+            raise RuntimeError(f"重排序请求失败({response.status_code}): {response.text[:200]}")
+        return response.json()
+
+
+def get_reranker_model() -> RerankerModel:
+    """获取重排序模型句柄，进程内只创建一次"""
+    global _reranker_model
+    with _lock:
+        if _reranker_model is None:
+            _reranker_model = RerankerModel()
+        return _reranker_model
+
+
+def reset_reranker_model():
+    """丢弃缓存的重排序模型句柄，服务重启或调用出错后下次重新创建连接；其他线程进行中的请求仍使用旧句柄"""
+    global _reranker_model
+    with _lock:
+        _reranker_model = None
@@ -0,0 +1,203 @@
+# coding:utf-8
+# @File  : doc_store.py
+# @Author: ganchun
+# @Date  :  2025/06/16
+# @Description: 列式文档存储，偏移量数组 + 连续UTF-8数据块，检索时内存映射按需读取
+
+import os
+import json
+import mmap
+import time
+import shutil
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from config import DOC_STORE_MMAP
+
+DOC_FIELDS = ("内容", "总结", "标签")
+DATA_FILE = "documents.bin"
+OFFSETS_FILE = "documents_offsets.npy"
+ALIVE_FILE = "documents_alive.npy"
+MANIFEST_FILE = "documents.json"  # 记录当前版本目录，写入新版本后最后替换
+VERSION_PREFIX = "documents_v"
+
+
+def _encode_field(doc: Dict[str, Any], field: str) -> bytes:
+    value = doc.get(field, "")
+    if field == "标签":
+        value = json.dumps(value or [], ensure_ascii=False)
+    return str(value).encode('utf-8')
+
+
+def write_doc_store(kb_dir: str, documents: List[Optional[Dict[str, Any]]]):
+    """
+    写入文档存储
+
+    文档i的第j个字段位于数据块的[offsets[i * F + j], offsets[i * F + j + 1])，F为字段数；
+    None表示已删除的文档，对应字段为空且alive标记为0。
+    三个文件写入新的版本目录，最后用一次原子替换更新清单文件切换版本，
+    读取方不会看到新旧文件混合的状态；旧版本目录在切换后删除，仍被其他进程映射（Windows）时留到下次写入再删
+
+    参数:
+        kb_dir: 知识库目录
+        documents: 文档列表，下标即文档ID
+    """
+    field_count = len(DOC_FIELDS)
+    offsets = np.zeros(len(documents) * field_count + 1, dtype=np.int64)
+    alive = np.zeros(len(documents), dtype=np.uint8)
+
+    version = f"{VERSION_PREFIX}{time.time_ns()}"
+    version_dir = os.path.join(kb_dir, version)
+    os.makedirs(version_dir)
+    position = 0
+    with open(os.path.join(version_dir, DATA_FILE), 'wb') as f:
+        for doc_id, doc in enumerate(documents):
+            if doc is not None:
+                alive[doc_id] = 1
+            for j, field in enumerate(DOC_FIELDS):
+                if doc is not None:
+                    data = _encode_field(doc, field)
+                    f.write(data)
+                    position += len(data)
+                offsets[doc_id * field_count + j + 1] = position
+
+    np.save(os.path.join(version_dir, OFFSETS_FILE), offsets)
+    np.save(os.path.join(version_dir, ALIVE_FILE), alive)
+
+    manifest = {"version": version, "count": len(documents), "data_size": position}
+    manifest_tmp = os.path.join(kb_dir, MANIFEST_FILE + ".tmp")
+    with open(manifest_tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_tmp, os.path.join(kb_dir, MANIFEST_FILE))
+
+    _remove_old_versions(kb_dir, version)
+
+
+def _remove_old_versions(kb_dir: str, current: str):
+    """删除旧版本目录和旧布局下直接位于知识库目录的文件，删除失败（仍被映射）时忽略"""
+    for name in os.listdir(kb_dir):
+        path = os.path.join(kb_dir, name)
+        if name.startswith(VERSION_PREFIX) and name != current and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif name in (DATA_FILE, OFFSETS_FILE, ALIVE_FILE):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _read_manifest(kb_dir: str) -> Optional[Dict[str, Any]]:
+    manifest_path = os.path.join(kb_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+class DocStore:
+    """
+    只读文档存储
+
+    use_mmap为True时数据块和偏移量均使用内存映射，加载时不解析任何文档，检索只物化命中的少量文档；
+    为False时整体读入内存并关闭文件，Windows下重建知识库时不会因文件被映射而无法删除旧版本
+    """
+
+    def __init__(self, kb_dir: str, use_mmap: bool = DOC_STORE_MMAP):
+        # 读取清单和打开文件之间旧版本可能刚被写入方删除，重新读取清单
+        for attempt in range(3):
+            manifest = _read_manifest(kb_dir)
+            # 没有清单时为旧布局，文件直接位于知识库目录
+            store_dir = os.path.join(kb_dir, manifest["version"]) if manifest else kb_dir
+            try:
+                self._open(store_dir, use_mmap)
+                break
+            except FileNotFoundError:
+                if manifest is None or attempt == 2:
+                    raise
+        self._validate(manifest)
+
+    def _open(self, store_dir: str, use_mmap: bool):
+        mmap_mode = 'r' if use_mmap else None
+        self._offsets = np.load(os.path.join(store_dir, OFFSETS_FILE), mmap_mode=mmap_mode)
+        self._alive = np.load(os.path.join(store_dir, ALIVE_FILE), mmap_mode=mmap_mode)
+        with open(os.path.join(store_dir, DATA_FILE), 'rb') as f:
+            if not use_mmap:
+                self._data = f.read()
+                return
+            size = os.fstat(f.fileno()).st_size
+            # 空文件无法映射；映射建立后可以关闭文件
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def _validate(self, manifest: Optional[Dict[str, Any]]):
+        """检查偏移量、alive标记和数据块的长度是否一致"""
+        count = len(self._alive)
+        if len(self._offsets) != count * len(DOC_FIELDS) + 1 or int(self._offsets[-1]) != len(self._data):
+            raise ValueError("文档存储的偏移量与数据文件不一致")
+        if manifest is not None and (manifest["count"] != count or manifest["data_size"] != len(self._data)):
+            raise ValueError("文档存储与清单文件不一致")
+
+    def __len__(self):
+        return len(self._alive)
+
+    def is_alive(self, doc_id: int) -> bool:
+        return 0 <= doc_id < len(self._alive) and bool(self._alive[doc_id])
+
+    def get_field(self, doc_id: int, field: str) -> Any:
+        """读取单个字段"""
+        j = DOC_FIELDS.index(field)
+        position = doc_id * len(DOC_FIELDS) + j
+        start, end = int(self._offsets[position]), int(self._offsets[position + 1])
+        value = bytes(self._data[start:end]).decode('utf-8')
+        if field == "标签":
+            return json.loads(value) if value else []
+        return value
+
+    def get(self, doc_id: int) -> Optional[Dict[str, Any]]:
+        """物化单个文档，返回新的字典；文档不存在或已删除时返回None"""
+        if not self.is_alive(doc_id):
+            return None
+        doc = {field: self.get_field(doc_id, field) for field in DOC_FIELDS}
+        doc["doc_id"] = int(doc_id)
+        return doc
+
+    def iter_documents(self) -> Iterator[Tuple[int, Optional[Dict[str, Any]]]]:
+        for doc_id in range(len(self)):
+            yield doc_id, self.get(doc_id)
+
+    def close(self):
+        """释放数据块映射，偏移量数组的映射在不再被引用后释放"""
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._data = b""
+        self._offsets = self._alive = np.zeros(0, dtype=np.uint8)
+
+
+class InMemoryDocStore:
+    """旧格式知识库(metadata.pkl)的文档列表，接口与DocStore一致"""
+
+    def __init__(self, documents: List[Optional[Dict[str, Any]]]):
+        self._documents = documents
+
+    def __len__(self):
+        return len(self._documents)
+
+    def is_alive(self, doc_id: int) -> bool:
+        return 0 <= doc_id < len(self._documents) and self._documents[doc_id] is not None
+
+    def get_field(self, doc_id: int, field: str) -> Any:
+        return self._documents[doc_id].get(field, [] if field == "标签" else "")
+
+    def get(self, doc_id: int) -> Optional[Dict[str, Any]]:
+        if not self.is_alive(doc_id):
+            return None
+        doc = self._documents[doc_id].copy()
+        doc["doc_id"] = int(doc_id)
+        return doc
+
+    def iter_documents(self) -> Iterator[Tuple[int, Optional[Dict[str, Any]]]]:
+        for doc_id in range(len(self)):
+            yield doc_id, self.get(doc_id)
+
+    def close(self):
+        pass
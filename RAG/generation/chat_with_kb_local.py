@@ -8,15 +8,21 @@ import os
 import json
 import time
 import argparse
-from typing import List, Dict, Any, Tuple, Optional
-import jsonlines
+from typing import List, Dict, Any, Tuple, Optional, Iterator
 import gradio as gr
-from openai import OpenAI
+import uvicorn
+from fastapi import FastAPI
+from contextlib import asynccontextmanager
 from datetime import datetime
 
 # 导入自定义模块
-from Prompt.prompt_templates import query_rewrite_prompt
-from RAG.retrieval.contextual_rewrite import retrieve_from_knowledge_base, list_knowledge_bases, rerank
+from RAG.clients import get_openai_client
+from RAG.retrieval.contextual_rewrite import list_knowledge_bases
+from RAG.retrieval.query_router import routed_retrieve
+from RAG.generation.session_manager import SessionManager
+from RAG.generation.history_store import history_store, compact_references
+from RAG.generation.context_builder import build_context
+from config import CHAT_SERVER_PORT
 
 # 配置参数
 LLM_API_URL = "http://localhost:9997/v1"
@@ -43,19 +49,12 @@ class ChatSession:
         self.session_id = session_id if session_id else f"chat_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
         self.history_file = os.path.join(CHAT_HISTORY_DIR, f"{self.session_id}.jsonl")
         self.history = self._load_history()
-        self.client = OpenAI(api_key="not empty", base_url=LLM_API_URL)
+        self.client = get_openai_client(LLM_API_URL)
 
     def _load_history(self) -> List[Dict[str, Any]]:
-        """加载历史对话记录"""
-        if not os.path.exists(self.history_file):
-            return []
-
-        history = []
+        """加载历史对话记录，只从文件末尾读取上下文用到的最近几轮"""
         try:
-            with jsonlines.open(self.history_file, 'r') as reader:
-                for item in reader:
-                    history.append(item)
-            return history
+            return history_store.read_tail(self.history_file, MAX_HISTORY_TURNS * 2)
         except Exception as e:
             print(f"加载历史记录出错: {e}")
             return []
@@ -76,15 +75,15 @@ class ChatSession:
         }
 
         if role == "assistant" and references:
-            message["references"] = references
+            # 参考资料只保存知识库、文档ID和内容哈希，不保存原文
+            message["references"] = compact_references(references, self.kb_name)
 
         self.history.append(message)
+        # 内存中只保留上下文用到的最近几轮，长时间的会话不会持续增长
+        del self.history[:-MAX_HISTORY_TURNS * 2]
 
-        try:
-            with jsonlines.open(self.history_file, 'a') as writer:
-                writer.write(message)
-        except Exception as e:
-            print(f"保存消息出错: {e}")
+        # 写入缓冲，由后台线程批量追加到文件
+        history_store.append(self.history_file, message)
 
     def get_chat_messages(self) -> List[Dict[str, str]]:
         """获取用于LLM上下文的历史消息"""
@@ -105,7 +104,7 @@ class ChatSession:
 
     def chat(self, query: str) -> Tuple[str, List[Dict]]:
         """
-        处理用户输入并生成回复
+        处理用户输入并生成回复，等待完整回复后返回
 
         参数:
             query: 用户输入
@@ -113,55 +112,68 @@ class ChatSession:
         返回:
             (回复内容, 引用的知识片段)
         """
+        reply, references = "", []
+        for delta, references in self.chat_stream(query):
+            reply += delta
+        return reply.strip(), references
+
+    def prepare(self, query: str) -> Tuple[List[Dict[str, str]], List[Dict]]:
+        """
+        保存用户消息、检索知识库并构建发送给大模型的消息
+
+        参数:
+            query: 用户输入
+
+        返回:
+            (消息列表, 引用的知识片段)
+        """
         # 保存用户消息
         self.save_message("user", query)
 
-        # 从知识库检索相关信息
-        references = retrieve_from_knowledge_base(self.kb_name, query, query_rewrite_prompt)
+        # 从知识库检索相关信息，闲聊不检索，简单查询不调用查询重写
+        references = routed_retrieve(self.kb_name, query)["retrieved_docs"]
 
-        # 构建提示上下文
-        context = ""
-        if references:
-            for i, ref in enumerate(references, 1):
-                context += f"[{i}] {ref.get('总结', '')}:\n{ref.get('内容', '')[:800]}...\n\n"
+        # 参考资料和历史对话按token预算放入上下文，只返回实际使用的参考资料
+        return build_context(self.get_chat_messages(), references)
 
-        # 准备消息
-        messages = self.get_chat_messages()
-
-        # 插入系统提示
-        system_prompt = (
-            "你是一个专业、友好的智能助手。请根据提供的参考资料回答用户问题。"
-            "如果参考资料中没有相关信息，请基于你的知识谨慎回答，并明确指出这是你的判断而非来自参考资料。"
-            "回答应当准确、清晰，并尽量使用参考资料中的原文表述。"
-            "不要在回答中直接提及参考资料编号，要自然地融入信息。"
-        )
+    def chat_stream(self, query: str) -> Iterator[Tuple[str, List[Dict]]]:
+        """
+        处理用户输入并流式生成回复，回复完成后再写入历史记录
 
-        # 如果有上下文，则添加到系统提示中
-        if context:
-            system_prompt += f"\n\n以下是相关的参考资料：\n{context}"
+        参数:
+            query: 用户输入
 
-        messages.insert(0, {"role": "system", "content": system_prompt})
+        返回:
+            逐段产出(新增的回复文本, 引用的知识片段)的生成器
+        """
+        messages, references = self.prepare(query)
 
+        reply = ""
         try:
-            # 调用LLM生成回复
+            # 流式调用LLM生成回复
             response = self.client.chat.completions.create(
                 model=LLM_MODEL_UID,
                 messages=messages,
                 max_tokens=2048,
-                temperature=0.7
+                temperature=0.7,
+                stream=True
             )
 
-            reply = response.choices[0].message.content.strip()
-
-            # 保存助手回复
-            self.save_message("assistant", reply, references)
-
-            return reply, references
+            for chunk in response:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    reply += delta
+                    yield delta, references
         except Exception as e:
             error_msg = f"生成回复时出错: {e}"
             print(error_msg)
             self.save_message("system", error_msg)
-            return error_msg, []
+            yield error_msg, []
+            return
+        finally:
+            # 正常结束或调用方中途停止时，保存已生成的回复
+            if reply:
+                self.save_message("assistant", reply.strip(), references)
 
 
 def chat_command_line(kb_name: str):
@@ -178,9 +190,13 @@ def chat_command_line(kb_name: str):
             break
 
         print("\n思考中...")
-        reply, references = session.chat(query)
-
-        print(f"\n助手: {reply}\n")
+        references = []
+        # 检索过程的日志打印完后再输出回复
+        for i, (delta, references) in enumerate(session.chat_stream(query)):
+            if i == 0:
+                print("\n助手: ", end="", flush=True)
+            print(delta, end="", flush=True)
+        print("\n")
 
         if references:
             print("\n参考来源:")
@@ -190,22 +206,31 @@ def chat_command_line(kb_name: str):
 
 
 def chat_web_interface(kb_name: str):
-    """Gradio Web聊天界面"""
-    session = ChatSession(kb_name)
-    references_store = []
-
-    def predict(message, history):
-        reply, refs = session.chat(message)
-        references_store.clear()
-        references_store.extend(refs)
-        return reply
-
-    def show_references():
-        if not references_store:
+    """
+    Gradio Web聊天界面
+
+    每个浏览器页面（session_hash）使用独立的会话，历史和参考来源互不影响；
+    界面挂载在FastAPI上由uvicorn异步服务，检索在线程池中执行，生成使用异步流式请求
+    """
+    manager = SessionManager(
+        lambda session_id: ChatSession(kb_name, session_id=f"web_{session_id}"),
+        LLM_API_URL, LLM_MODEL_UID
+    )
+
+    async def predict(message, history, request: gr.Request):
+        # 逐段更新最后一条助手消息，实现流式显示
+        history = history + [{"role": "user", "content": message}, {"role": "assistant", "content": ""}]
+        async for delta, _ in manager.chat_stream(request.session_hash, message):
+            history[-1]["content"] += delta
+            yield "", history
+
+    def show_references(request: gr.Request):
+        references = manager.get_references(request.session_hash)
+        if not references:
             return "没有找到相关参考资料"
 
         refs_text = "### 参考来源\n\n"
-        for i, ref in enumerate(references_store, 1):
+        for i, ref in enumerate(references, 1):
             tags = ", ".join(ref.get("标签", []))
             summary = ref.get("总结", "")
             content = ref.get("内容", "")[:500] + "..."
@@ -223,7 +248,7 @@ def chat_web_interface(kb_name: str):
 
         with gr.Row():
             with gr.Column(scale=7):
-                chatbot = gr.Chatbot(height=500)
+                chatbot = gr.Chatbot(height=500, type="messages")
                 msg = gr.Textbox(
                     show_label=False,
                     placeholder="请输入您的问题...",
@@ -236,7 +261,8 @@ def chat_web_interface(kb_name: str):
                     ref_btn = gr.Button("显示/更新参考来源")
                     ref_btn.click(show_references, outputs=[references_output])
 
-        msg.submit(predict, [msg, chatbot], [chatbot])
+        # 并发由SessionManager控制，不使用Gradio默认的单并发队列
+        msg.submit(predict, [msg, chatbot], [msg, chatbot], concurrency_limit=None)
 
         gr.Markdown("""
         ### 使用说明
@@ -245,7 +271,13 @@ def chat_web_interface(kb_name: str):
         3. 点击"显示/更新参考来源"查看AI回答所依据的资料
         """)
 
-    demo.launch(share=False, server_name="0.0.0.0")
+    @asynccontextmanager
+    async def lifespan(app):
+        yield
+        await manager.close()
+
+    app = gr.mount_gradio_app(FastAPI(lifespan=lifespan), demo, path="/")
+    uvicorn.run(app, host="0.0.0.0", port=CHAT_SERVER_PORT)
 
 
 def main():
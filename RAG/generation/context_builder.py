@@ -0,0 +1,224 @@
+# coding:utf-8
+# @File  : context_builder.py
+# @Author: ganchun
+# @Date  :  2025/06/29
+# @Description: 按token预算构建发送给大模型的消息：参考资料去重后按得分装入预算，历史对话从最早的轮次开始舍弃或压缩
+
+import re
+import math
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from config import (CONTEXT_TOKENIZER, CONTEXT_MAX_TOKENS, CONTEXT_REFERENCE_TOKENS, CONTEXT_MAX_DOC_TOKENS,
+                    CONTEXT_MIN_DOC_TOKENS, CONTEXT_DEDUP_THRESHOLD, CONTEXT_HISTORY_SUMMARY)
+
+SYSTEM_PROMPT = (
+    "你是一个专业、友好的智能助手。请根据提供的参考资料回答用户问题。"
+    "如果参考资料中没有相关信息，请基于你的知识谨慎回答，并明确指出这是你的判断而非来自参考资料。"
+    "回答应当准确、清晰，并尽量使用参考资料中的原文表述。"
+    "不要在回答中直接提及参考资料编号，要自然地融入信息。"
+)
+
+MESSAGE_OVERHEAD_TOKENS = 4  # 每条消息的角色标记等额外token
+SUMMARY_QUERY_TOKENS = 48  # 压缩历史时每个用户问题保留的token数
+DEDUP_NGRAM = 3  # 判断片段重叠使用的字符n-gram长度
+
+CJK_CHAR = re.compile(r"[\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]")
+WHITESPACE = re.compile(r"\s+")
+
+
+class TokenCounter:
+    """
+    token计数
+
+    tokenizer为transformers模型目录或名称（如"Qwen/Qwen2.5-7B-Instruct"）时使用该模型的分词器，
+    为"tiktoken:编码名"（如"tiktoken:cl100k_base"）时使用tiktoken；
+    为None或加载失败时按字符估算：中文字符每个计1个token（Qwen等模型实际约1.3~1.5字/token，估算偏保守），其余每4个字符计1个token
+    """
+
+    def __init__(self, tokenizer: Optional[str] = CONTEXT_TOKENIZER):
+        self.name = "estimate"
+        self._encode = None
+        self._decode = None
+        if tokenizer:
+            self._load(tokenizer)
+
+    def _load(self, tokenizer: str):
+        try:
+            if tokenizer.startswith("tiktoken:"):
+                import tiktoken
+                encoding = tiktoken.get_encoding(tokenizer.split(":", 1)[1])
+                self._encode = lambda text: encoding.encode(text, disallowed_special=())
+                self._decode = encoding.decode
+            else:
+                from transformers import AutoTokenizer
+                hf_tokenizer = AutoTokenizer.from_pretrained(tokenizer)
+                self._encode = lambda text: hf_tokenizer.encode(text, add_special_tokens=False)
+                self._decode = hf_tokenizer.decode
+            self.name = tokenizer
+        except ImportError as e:
+            print(f"未安装分词器依赖，按字符估算token数: {e}")
+        except Exception as e:
+            print(f"加载分词器 '{tokenizer}' 出错，按字符估算token数: {e}")
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        if self._encode is not None:
+            return len(self._encode(text))
+        cjk = len(CJK_CHAR.findall(text))
+        return cjk + math.ceil((len(text) - cjk) / 4)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """截断到不超过max_tokens个token"""
+        if max_tokens <= 0:
+            return ""
+        if self._encode is not None:
+            ids = self._encode(text)
+            return text if len(ids) <= max_tokens else self._decode(ids[:max_tokens])
+
+        # 按估算规则逐字累加，非中文字符每个计1/4个token
+        cost = 0.0
+        for i, char in enumerate(text):
+            cost += 1.0 if CJK_CHAR.match(char) else 0.25
+            if cost > max_tokens:
+                return text[:i]
+        return text
+
+    def count_messages(self, messages: List[Dict[str, str]]) -> int:
+        return sum(self.count(message["content"]) + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+
+@lru_cache(maxsize=None)
+def get_token_counter(tokenizer: Optional[str] = CONTEXT_TOKENIZER) -> TokenCounter:
+    """同一分词器在进程内只加载一次"""
+    return TokenCounter(tokenizer)
+
+
+def reference_score(doc: Dict[str, Any]) -> Optional[float]:
+    """文档的排序得分，优先使用重排序模型得分"""
+    score = doc.get("relevance_score", doc.get("fusion_score"))
+    return float(score) if score is not None else None
+
+
+def _shingles(text: str) -> Set[str]:
+    text = WHITESPACE.sub("", text or "")
+    return {text[i:i + DEDUP_NGRAM] for i in range(max(len(text) - DEDUP_NGRAM + 1, 1))} if text else set()
+
+
+def dedup_references(references: List[Dict[str, Any]],
+                     threshold: float = CONTEXT_DEDUP_THRESHOLD) -> List[Dict[str, Any]]:
+    """
+    去除内容重叠的片段，保留排在前面的
+
+    两个片段的字符n-gram交集占较短片段的比例达到threshold时视为重叠，
+    可以去掉相邻分块的重复部分、被其他片段包含的短片段以及联合检索中不同知识库的相同文档
+    """
+    kept, kept_shingles = [], []
+    for ref in references:
+        shingles = _shingles(ref.get("内容", ""))
+        if shingles and any(len(shingles & other) / min(len(shingles), len(other)) >= threshold
+                            for other in kept_shingles if other):
+            continue
+        kept.append(ref)
+        kept_shingles.append(shingles)
+    return kept
+
+
+def pack_references(references: List[Dict[str, Any]], budget: int,
+                    counter: TokenCounter) -> Tuple[str, List[Dict[str, Any]]]:
+    """
+    参考资料按得分从高到低装入token预算
+
+    每个片段最多CONTEXT_MAX_DOC_TOKENS个token；放不下时截断到剩余预算，
+    剩余预算不足CONTEXT_MIN_DOC_TOKENS时跳过，继续尝试后面更短的片段
+
+    返回:
+        (参考资料文本, 实际使用的片段)，片段顺序与文本中的编号一致
+    """
+    if all(reference_score(ref) is not None for ref in references):
+        references = sorted(references, key=reference_score, reverse=True)
+
+    context, packed = "", []
+    for ref in dedup_references(references):
+        header = f"[{len(packed) + 1}] {ref.get('总结', '')}:\n"
+        remaining = budget - counter.count(header) - 1
+        if remaining < CONTEXT_MIN_DOC_TOKENS:
+            continue
+        content = ref.get("内容", "")
+        truncated = counter.truncate(content, min(CONTEXT_MAX_DOC_TOKENS, remaining))
+        entry = header + truncated + ("..." if len(truncated) < len(content) else "") + "\n\n"
+        context += entry
+        budget -= counter.count(entry)
+        packed.append(ref)
+    return context, packed
+
+
+def summarize_history(dropped: List[Dict[str, str]], budget: int, counter: TokenCounter) -> str:
+    """把舍弃的历史压缩为用户问过的问题列表，从最近的问题开始放入预算"""
+    header = "\n\n更早的对话中用户还询问过："
+    budget -= counter.count(header)
+    questions = []
+    for message in reversed(dropped):
+        if message["role"] != "user":
+            continue
+        question = counter.truncate(message["content"], SUMMARY_QUERY_TOKENS)
+        cost = counter.count(question) + 1
+        if cost > budget:
+            break
+        questions.insert(0, question)
+        budget -= cost
+    return header + "；".join(questions) if questions else ""
+
+
+def build_context(history: List[Dict[str, str]], references: List[Dict[str, Any]],
+                  system_prompt: str = SYSTEM_PROMPT, max_tokens: int = CONTEXT_MAX_TOKENS,
+                  reference_tokens: int = CONTEXT_REFERENCE_TOKENS,
+                  counter: TokenCounter = None) -> Tuple[List[Dict[str, str]], List[Dict[str, Any]]]:
+    """
+    在token预算内构建发送给大模型的消息
+
+    系统提示和当前问题（history的最后一条）始终保留；参考资料最多使用reference_tokens，
+    未用完的部分留给历史对话；历史对话从最近的轮次开始装入，放不下的较早轮次被舍弃，
+    CONTEXT_HISTORY_SUMMARY开启时把其中的用户问题压缩后附在系统提示中
+
+    参数:
+        history: OpenAI格式的对话消息，最后一条为当前用户问题
+        references: 检索到的文档
+        system_prompt: 系统提示
+        max_tokens: 输入消息的总token预算，不含生成的token
+        reference_tokens: 参考资料的token预算
+        counter: token计数器，为None时使用CONTEXT_TOKENIZER
+
+    返回:
+        (消息列表, 实际放入上下文的参考资料)
+    """
+    counter = counter or get_token_counter()
+    history = [{"role": message["role"], "content": message["content"]} for message in history]
+    current, earlier = history[-1:], history[:-1]
+
+    budget = max_tokens - counter.count(system_prompt) - counter.count_messages(current) - MESSAGE_OVERHEAD_TOKENS
+    context, packed = "", []
+    if references:
+        header = "\n\n以下是相关的参考资料：\n"
+        context, packed = pack_references(references, min(reference_tokens, budget) - counter.count(header), counter)
+        if context:
+            context = header + context
+            budget -= counter.count(context)
+
+    # 从最近的轮次开始保留历史，按整轮舍弃，避免留下没有问题的回答
+    kept = len(earlier)
+    while kept > 0:
+        start = kept - 2 if kept >= 2 and earlier[kept - 2]["role"] == "user" else kept - 1
+        cost = counter.count_messages(earlier[start:kept])
+        if cost > budget:
+            break
+        budget -= cost
+        kept = start
+
+    summary = ""
+    if kept and CONTEXT_HISTORY_SUMMARY:
+        summary = summarize_history(earlier[:kept], budget, counter)
+
+    messages = [{"role": "system", "content": system_prompt + summary + context}]
+    return messages + earlier[kept:] + current, packed
@@ -0,0 +1,128 @@
+# coding:utf-8
+# @File  : history_store.py
+# @Author: ganchun
+# @Date  :  2025/06/28
+# @Description: 对话历史存储，缓冲后批量追加写入、从文件末尾读取最近消息、参考资料按文档ID保存
+
+import os
+import json
+import atexit
+import hashlib
+import threading
+from typing import Any, Dict, List
+
+from config import HISTORY_FLUSH_INTERVAL, HISTORY_FLUSH_SIZE
+
+TAIL_BLOCK_SIZE = 8192  # 从文件末尾向前读取的块大小
+
+
+def content_hash(text: str) -> str:
+    """文档内容的短哈希，全量重建后文档ID会变化，可据此判断ID是否仍指向引用时的文档"""
+    return hashlib.md5((text or "").encode('utf-8')).hexdigest()[:12]
+
+
+def compact_references(references: List[Dict[str, Any]], kb_name: str) -> List[Dict[str, Any]]:
+    """
+    将检索到的文档压缩为引用，只保存知识库、文档ID、得分和内容哈希
+
+    参数:
+        references: 检索结果中的文档
+        kb_name: 会话使用的知识库，联合检索的文档自带kb_name时以文档为准
+    """
+    compacted = []
+    for ref in references:
+        if ref.get("doc_id") is None:
+            # 没有文档ID（如旧格式知识库）时保留原文
+            compacted.append(ref)
+            continue
+        compacted.append({
+            "kb_name": ref.get("kb_name", kb_name),
+            "doc_id": int(ref["doc_id"]),
+            "score": ref.get("relevance_score", ref.get("fusion_score")),
+            "hash": content_hash(ref.get("内容", ""))
+        })
+    return compacted
+
+
+def read_jsonl_tail(path: str, n: int, block_size: int = TAIL_BLOCK_SIZE) -> List[Dict[str, Any]]:
+    """从文件末尾按块向前读取，只解析最后n行"""
+    if n <= 0 or not os.path.exists(path):
+        return []
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = b""
+        # 读到n+1个换行符时，最后n行一定是完整的
+        while pos > 0 and data.count(b"\n") <= n:
+            size = min(block_size, pos)
+            pos -= size
+            f.seek(pos)
+            data = f.read(size) + data
+
+    items = []
+    for line in [line for line in data.split(b"\n") if line.strip()][-n:]:
+        try:
+            items.append(json.loads(line.decode('utf-8')))
+        except ValueError:
+            print(f"跳过无法解析的历史记录: {line[:50]}")
+    return items
+
+
+class HistoryStore:
+    """
+    JSONL对话历史存储
+
+    - append只写入内存缓冲，后台线程每flush_interval秒或缓冲达到flush_size条时批量追加，
+      同一文件的多条消息一次打开写入；进程退出时写入剩余缓冲
+    - read_tail先写入该文件的缓冲，再从文件末尾读取最近的消息，不扫描整个文件
+    """
+
+    def __init__(self, flush_interval: float = HISTORY_FLUSH_INTERVAL, flush_size: int = HISTORY_FLUSH_SIZE):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._buffers = {}  # path -> [待写入的行]
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()  # 保证同一文件的写入顺序
+        self._wakeup = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="history-flush", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def append(self, path: str, message: Dict[str, Any]):
+        line = json.dumps(message, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._buffers.setdefault(path, []).append(line)
+            self._pending += 1
+            if self._pending >= self.flush_size:
+                self._wakeup.set()
+
+    def flush(self, path: str = None):
+        """写入缓冲，path为None时写入所有文件"""
+        with self._write_lock:
+            with self._lock:
+                if path is None:
+                    buffers, self._buffers = self._buffers, {}
+                else:
+                    buffers = {path: self._buffers.pop(path)} if path in self._buffers else {}
+                self._pending -= sum(len(lines) for lines in buffers.values())
+            for file_path, lines in buffers.items():
+                try:
+                    with open(file_path, 'a', encoding='utf-8') as f:
+                        f.writelines(lines)
+                except Exception as e:
+                    print(f"保存对话历史出错: {e}")
+
+    def read_tail(self, path: str, n: int) -> List[Dict[str, Any]]:
+        """读取文件中最近的n条消息"""
+        self.flush(path)
+        return read_jsonl_tail(path, n)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+history_store = HistoryStore()
@@ -0,0 +1,185 @@
+# coding:utf-8
+# @File  : session_manager.py
+# @Author: ganchun
+# @Date  :  2025/06/26
+# @Description: 异步多会话管理，按会话ID隔离历史和参考来源，限制并发并淘汰空闲会话
+
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from RAG.clients import create_async_openai_client
+from config import (CHAT_MAX_CONCURRENCY, CHAT_SESSION_IDLE_TIMEOUT, CHAT_MAX_SESSIONS,
+                    CHAT_RETRIEVAL_WORKERS, CHAT_EVICT_INTERVAL)
+
+
+class ManagedSession:
+    """会话及其运行状态"""
+
+    def __init__(self, session: Any):
+        self.session = session
+        self.lock = asyncio.Lock()  # 同一会话的请求依次处理，避免历史记录交错
+        self.references = []  # 最近一次回复引用的知识片段
+        self.pending = 0  # 进行中和排队中的请求数，不为0时不会被淘汰
+        self.last_active = time.time()
+
+
+class SessionManager:
+    """
+    异步会话管理器
+
+    - 每个会话ID（如Gradio的session_hash）对应一个独立的ChatSession，历史和参考来源互不影响
+    - 所有会话共享一个信号量，同时处理的请求数不超过max_concurrency，其余请求排队等待
+    - 检索、读写历史等同步操作在线程池中执行，大模型生成使用异步流式请求，不阻塞事件循环
+    - 后台任务定期淘汰超过idle_timeout未活动的会话，会话数超过max_sessions时淘汰最久未活动的会话；
+      历史记录已保存在文件中，淘汰只释放内存
+    """
+
+    def __init__(self, session_factory: Callable[[str], Any], llm_api_url: str, model: str,
+                 api_key: str = "not empty", max_concurrency: int = CHAT_MAX_CONCURRENCY,
+                 idle_timeout: float = CHAT_SESSION_IDLE_TIMEOUT, max_sessions: int = CHAT_MAX_SESSIONS,
+                 retrieval_workers: int = CHAT_RETRIEVAL_WORKERS):
+        """
+        参数:
+            session_factory: 根据会话ID创建会话的函数，会话需提供prepare和save_message方法
+            llm_api_url: 生成回复的大模型地址
+            model: 大模型ID
+            api_key: API密钥
+            max_concurrency: 同时处理的最大请求数
+            idle_timeout: 会话空闲超过该秒数后淘汰
+            max_sessions: 内存中保留的最大会话数
+            retrieval_workers: 执行检索等同步操作的线程数
+        """
+        self.session_factory = session_factory
+        self.llm_api_url = llm_api_url
+        self.model = model
+        self.api_key = api_key
+        self.max_concurrency = max_concurrency
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self._sessions = {}  # session_id -> ManagedSession
+        self._executor = ThreadPoolExecutor(max_workers=retrieval_workers, thread_name_prefix="chat")
+        # 以下对象绑定事件循环，首次请求时在服务的事件循环中创建
+        self._semaphore = None
+        self._client = None
+        self._evictor = None
+        self._stats = {"requests": 0, "in_flight": 0, "active": 0, "evicted": 0, "errors": 0}
+
+    def _ensure_started(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._client = create_async_openai_client(self.llm_api_url, self.api_key,
+                                                      max_connections=self.max_concurrency)
+            self._evictor = asyncio.create_task(self._evict_loop())
+
+    def _run(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def _acquire(self, session_id: str) -> ManagedSession:
+        """获取会话并登记一个请求，不存在时创建（加载历史记录在线程池中进行）"""
+        self._ensure_started()
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            session = await self._run(self.session_factory, session_id)
+            # 创建期间可能已有同一会话的其他请求完成创建
+            entry = self._sessions.setdefault(session_id, ManagedSession(session))
+        # 登记和淘汰之间没有await，已登记请求的会话不会被淘汰
+        entry.pending += 1
+        entry.last_active = time.time()
+        self._evict_overflow()
+        return entry
+
+    def get_references(self, session_id: str) -> List[Dict]:
+        entry = self._sessions.get(session_id)
+        return entry.references if entry is not None else []
+
+    async def chat_stream(self, session_id: str, query: str) -> AsyncIterator[Tuple[str, List[Dict]]]:
+        """
+        在指定会话中处理用户输入，流式产出回复
+
+        返回:
+            逐段产出(新增的回复文本, 引用的知识片段)的异步生成器，回复完成后写入该会话的历史记录
+        """
+        entry = await self._acquire(session_id)
+        self._stats["requests"] += 1
+        self._stats["in_flight"] += 1
+        try:
+            async with entry.lock, self._semaphore:
+                self._stats["active"] += 1
+                reply, references = "", []
+                try:
+                    messages, references = await self._run(entry.session.prepare, query)
+                    entry.references = references
+                    response = await self._client.chat.completions.create(
+                        model=self.model,
+                        messages=messages,
+                        max_tokens=2048,
+                        temperature=0.7,
+                        stream=True
+                    )
+                    async for chunk in response:
+                        delta = chunk.choices[0].delta.content if chunk.choices else None
+                        if delta:
+                            reply += delta
+                            yield delta, references
+                except Exception as e:
+                    self._stats["errors"] += 1
+                    error_msg = f"生成回复时出错: {e}"
+                    print(error_msg)
+                    await self._run(entry.session.save_message, "system", error_msg)
+                    yield error_msg, []
+                finally:
+                    # 正常结束或客户端断开时，保存已生成的回复
+                    if reply:
+                        await self._run(entry.session.save_message, "assistant", reply.strip(), references)
+                    self._stats["active"] -= 1
+                    entry.last_active = time.time()
+        finally:
+            self._stats["in_flight"] -= 1
+            entry.pending -= 1
+
+    def _evict_overflow(self):
+        """会话数超过上限时淘汰最久未活动且没有请求的会话"""
+        overflow = len(self._sessions) - self.max_sessions
+        if overflow <= 0:
+            return
+        idle = sorted((entry.last_active, session_id) for session_id, entry in self._sessions.items()
+                      if not entry.pending)
+        for _, session_id in idle[:overflow]:
+            del self._sessions[session_id]
+            self._stats["evicted"] += 1
+
+    def evict_idle(self) -> int:
+        """淘汰空闲超时的会话以及超出数量上限的会话，返回淘汰数量"""
+        now = time.time()
+        expired = [session_id for session_id, entry in self._sessions.items()
+                   if now - entry.last_active > self.idle_timeout and not entry.pending]
+        for session_id in expired:
+            del self._sessions[session_id]
+        self._stats["evicted"] += len(expired)
+        # 请求高峰期间超出上限的会话在这里补充淘汰
+        count = len(self._sessions)
+        self._evict_overflow()
+        return len(expired) + count - len(self._sessions)
+
+    async def _evict_loop(self):
+        while True:
+            await asyncio.sleep(CHAT_EVICT_INTERVAL)
+            evicted = self.evict_idle()
+            if evicted:
+                print(f"淘汰{evicted}个空闲会话，当前会话数: {len(self._sessions)}")
+
+    async def close(self):
+        """停止后台任务并关闭连接"""
+        if self._evictor is not None:
+            self._evictor.cancel()
+        if self._client is not None:
+            await self._client.close()
+        self._executor.shutdown(wait=False)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = dict(self._stats)
+        stats["waiting"] = stats.pop("in_flight") - stats["active"]
+        stats["sessions"] = len(self._sessions)
+        return stats
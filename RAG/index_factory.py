@@ -0,0 +1,227 @@
+# coding:utf-8
+# @File  : index_factory.py
+# @Author: ganchun
+# @Date  :  2025/06/14
+# @Description: 向量索引工厂，支持Flat、IVF-Flat、IVF-PQ、HNSW和标量量化（fp16/int8），以及压缩索引的原始向量重打分
+
+import math
+import os
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import faiss
+
+from config import (INDEX_TYPE, INDEX_FLAT_THRESHOLD, IVF_NLIST, IVF_PQ_M, IVF_PQ_NBITS,
+                    HNSW_M, HNSW_EF_CONSTRUCTION, IVF_NPROBE, HNSW_EF_SEARCH,
+                    RESCORE_FACTOR, RECALL_EVAL_QUERIES, RECALL_EVAL_K)
+
+INDEX_TYPES = ("auto", "flat", "ivf_flat", "ivf_pq", "hnsw", "sq_fp16", "sq_int8")
+# 标量量化类型：fp16每维2字节，int8每维1字节（按维度训练取值范围）
+SQ_TYPES = {
+    "sq_fp16": faiss.ScalarQuantizer.QT_fp16,
+    "sq_int8": faiss.ScalarQuantizer.QT_8bit
+}
+# 有损压缩的索引，检索时需要用原始向量重打分
+LOSSY_INDEX_TYPES = ("ivf_pq", "sq_fp16", "sq_int8")
+
+
+def resolve_index_type(index_type: str, n: int) -> str:
+    """
+    根据向量数量确定实际使用的索引类型
+
+    向量数少于INDEX_FLAT_THRESHOLD时一律使用Flat，近似索引在小数据上没有收益；
+    标量量化是为了节省内存，与数据量无关，只在没有向量（int8无法训练）时使用Flat；
+    auto在数据量较大时使用IVF-Flat，它既能加速检索又支持增量删除
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"不支持的索引类型: {index_type}，可选: {', '.join(INDEX_TYPES)}")
+    if index_type in SQ_TYPES:
+        return index_type if n else "flat"
+    if n < INDEX_FLAT_THRESHOLD:
+        return "flat"
+    if index_type == "auto":
+        return "ivf_flat"
+    return index_type
+
+
+def _ivf_nlist(n: int) -> int:
+    """IVF聚类中心数，保证每个中心至少有约39个训练样本"""
+    return max(1, min(IVF_NLIST, int(4 * math.sqrt(n)), n // 39))
+
+
+def create_index(vectors: np.ndarray, ids, dimension: int,
+                 index_type: str = INDEX_TYPE) -> Tuple[Any, Dict[str, Any]]:
+    """
+    创建带ID映射的内积索引并写入向量
+
+    参数:
+        vectors: 已归一化的float32向量
+        ids: 向量对应的ID
+        dimension: 向量维度
+        index_type: 索引类型，见INDEX_TYPES
+
+    返回:
+        (索引, 索引参数)，索引参数随知识库一起保存
+    """
+    n = len(ids)
+    actual_type = resolve_index_type(index_type, n)
+    params = {"index_type": actual_type, "dimension": dimension, "count": n}
+
+    if actual_type == "flat":
+        base_index = faiss.IndexFlatIP(dimension)
+    elif actual_type in SQ_TYPES:
+        base_index = faiss.IndexScalarQuantizer(dimension, SQ_TYPES[actual_type], faiss.METRIC_INNER_PRODUCT)
+        if not base_index.is_trained:
+            base_index.train(vectors)
+    elif actual_type == "hnsw":
+        base_index = faiss.IndexHNSWFlat(dimension, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        base_index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        params.update({"hnsw_m": HNSW_M, "ef_construction": HNSW_EF_CONSTRUCTION})
+    else:
+        nlist = _ivf_nlist(n)
+        quantizer = faiss.IndexFlatIP(dimension)
+        if actual_type == "ivf_pq":
+            base_index = faiss.IndexIVFPQ(quantizer, dimension, nlist, IVF_PQ_M, IVF_PQ_NBITS,
+                                          faiss.METRIC_INNER_PRODUCT)
+            params.update({"pq_m": IVF_PQ_M, "pq_nbits": IVF_PQ_NBITS})
+        else:
+            base_index = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_INNER_PRODUCT)
+        print(f"训练{actual_type}索引，聚类中心数: {nlist}")
+        base_index.train(vectors)
+        params["nlist"] = nlist
+
+    index = faiss.IndexIDMap2(base_index)
+    if n:
+        index.add_with_ids(vectors, np.asarray(ids, dtype=np.int64))
+    apply_search_params(index)
+    return index, params
+
+
+def _base_index(index):
+    """取出IDMap包装下的实际索引"""
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return faiss.downcast_index(index.index)
+    return faiss.downcast_index(index)
+
+
+def apply_search_params(index, nprobe: int = IVF_NPROBE, ef_search: int = HNSW_EF_SEARCH):
+    """设置检索参数：IVF的nprobe和HNSW的efSearch，对Flat索引无影响"""
+    base_index = _base_index(index)
+    if isinstance(base_index, faiss.IndexIVF):
+        base_index.nprobe = min(nprobe, base_index.nlist)
+    elif isinstance(base_index, faiss.IndexHNSW):
+        base_index.hnsw.efSearch = ef_search
+    return index
+
+
+def supports_remove(index) -> bool:
+    """HNSW不支持按ID删除，增量更新时需要重建"""
+    return not isinstance(_base_index(index), faiss.IndexHNSW)
+
+
+def needs_rescore(index_params: Dict[str, Any]) -> bool:
+    """索引为有损压缩类型时需要原始向量重打分"""
+    return index_params.get("index_type") in LOSSY_INDEX_TYPES
+
+
+def rescore_vectors_path(kb_dir: str, name: str) -> str:
+    """原始向量文件路径，如summary_vectors.npy，第i行为ID为i的归一化float32向量"""
+    return os.path.join(kb_dir, f"{name}_vectors.npy")
+
+
+def load_rescore_vectors(kb_dir: str, name: str) -> Optional[np.ndarray]:
+    """内存映射读取原始向量，只有重打分用到的行会被读入内存；文件不存在时返回None"""
+    path = rescore_vectors_path(kb_dir, name)
+    if not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode='r')
+
+
+def rescore(distances: np.ndarray, ids: np.ndarray, queries: np.ndarray,
+            vectors: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    用原始向量重新计算候选的内积并取前k个
+
+    参数:
+        distances, ids: 压缩索引的检索结果，每行为一个查询的候选
+        queries: 查询向量
+        vectors: 按ID排列的原始向量
+        k: 每个查询保留的数量
+
+    返回:
+        与faiss检索结果格式相同的(得分, ID)，不足k个时ID补-1
+    """
+    out_distances = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    out_ids = np.full((len(queries), k), -1, dtype=np.int64)
+    for row, (query, row_ids) in enumerate(zip(queries, ids)):
+        row_ids = row_ids[(row_ids >= 0) & (row_ids < len(vectors))]
+        if not len(row_ids):
+            continue
+        # 按ID排序后读取，内存映射文件上是顺序访问
+        row_ids = np.unique(row_ids)
+        exact = np.asarray(vectors[row_ids], dtype=np.float32) @ query
+        order = np.argsort(-exact)[:k]
+        out_distances[row, :len(order)] = exact[order]
+        out_ids[row, :len(order)] = row_ids[order]
+    return out_distances, out_ids
+
+
+class RescoringIndex:
+    """
+    压缩索引的检索包装
+
+    先在压缩索引中取k * factor个候选，再用原始向量重打分后取前k个，
+    其余属性和方法（ntotal等）直接使用被包装的索引
+    """
+
+    def __init__(self, index, vectors: np.ndarray, factor: int = RESCORE_FACTOR):
+        self.index = index
+        self.vectors = vectors
+        self.factor = factor
+
+    def search(self, queries: np.ndarray, k: int):
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        distances, ids = self.index.search(queries, k * self.factor)
+        return rescore(distances, ids, queries, self.vectors, k)
+
+    def __getattr__(self, name):
+        return getattr(self.index, name)
+
+
+def evaluate_recall(index, vectors: np.ndarray, ids, k: int = RECALL_EVAL_K,
+                    num_queries: int = RECALL_EVAL_QUERIES, factor: int = RESCORE_FACTOR) -> Dict[str, float]:
+    """
+    以float32精确检索为基准评估索引的召回率
+
+    从已入库的向量中抽样作为查询，分别计算索引直接检索和原始向量重打分后的recall@k
+
+    参数:
+        index: 待评估的索引
+        vectors: 入库的归一化float32向量
+        ids: 向量对应的ID
+
+    返回:
+        {"k", "queries", "recall", "rescored_recall"}
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    k = min(k, len(ids))
+    if k == 0:
+        return {}
+    rng = np.random.default_rng(0)
+    sample = rng.choice(len(ids), size=min(num_queries, len(ids)), replace=False)
+    queries = np.ascontiguousarray(vectors[sample], dtype=np.float32)
+
+    baseline = faiss.IndexFlatIP(vectors.shape[1])
+    baseline.add(vectors)
+    _, truth = baseline.search(queries, k)
+    truth = ids[truth]
+
+    by_id = np.zeros((int(ids.max()) + 1, vectors.shape[1]), dtype=np.float32)
+    by_id[ids] = vectors
+    _, approx = index.search(queries, k)
+    _, rescored = RescoringIndex(index, by_id, factor).search(queries, k)
+
+    def recall(result):
+        return float(np.mean([len(set(row) & set(expected)) / k for row, expected in zip(result, truth)]))
+
+    return {"k": k, "queries": len(sample), "recall": recall(approx), "rescored_recall": recall(rescored)}
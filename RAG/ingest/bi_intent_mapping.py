@@ -3,16 +3,26 @@
 # @Author: ganchun
 # @Date  :  2025/04/18
 # @Description: 为知识库文档生成摘要和标签
+# 逐行流式读取CSV，由线程池并发调用API，结果持久化到SQLite缓存，中断后重新运行不会重复调用
 
 import json
 import os
 import time
 import csv
+import random
 import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 from Prompt.prompt_templates import bi_intent_mapping_prompt
-from semantic_segment import (use_doubao_api, return_csv_file_list, read_csv_rows)
+from RAG.cache import SQLiteCache
+from RAG.ingest.rate_limiter import TokenBucket
+from RAG.ingest.semantic_segment import use_doubao_api, return_csv_file_list
+from config import (BI_INTENT_WORKERS, BI_INTENT_RATE_LIMIT, BI_INTENT_MAX_RETRIES,
+                    BI_INTENT_RATE_BURST, BI_INTENT_RETRY_BASE_DELAY)
+
+BI_INTENT_CACHE_FILE = ".bi_intent_cache.sqlite"  # 默认保存在输出目录下
 
 
 def process_json(response_text):
@@ -75,121 +85,142 @@ def get_cache_key(text):
     return hashlib.md5(text.encode('utf-8')).hexdigest()
 
 
-def bi_intent_mapping(api_key, input_csv_path, output_csv_path):
-    """为知识库文档生成摘要和标签"""
+def iter_csv_rows(file_path, encoding='utf-8'):
+    """逐行读取CSV，跳过首行表头"""
+    try:
+        with open(file_path, 'r', encoding=encoding) as csvfile:
+            csv_reader = csv.reader(csvfile)
+            next(csv_reader, None)
+            for row in csv_reader:
+                yield row
+    except FileNotFoundError:
+        print(f"错误：文件 {file_path} 未找到")
+
+
+def build_output_row(row, summary, tags):
+    """取前三列（不足补空）并追加总结和标签"""
+    new_row = list(row[:3])
+    while len(new_row) < 3:
+        new_row.append("")
+    new_row.extend([summary, tags])
+    return new_row
+
+
+def generate_summary_and_tags(api_key, prompt, cache, limiter, max_retries=BI_INTENT_MAX_RETRIES):
+    """
+    为单行生成总结和标签，先查持久化缓存，未命中时调用API
+
+    只有非空结果写入缓存，空结果或失败下次运行会重新请求
+
+    返回:
+        (总结, 标签, 来源)，来源为cache、api或failed
+    """
+    cache_key = get_cache_key(prompt)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached[0], cached[1], "cache"
+
+    for retry in range(max_retries):
+        limiter.acquire()
+        try:
+            response = use_doubao_api(api_key, prompt)
+            summary, tags = process_json(response)
+            if summary or tags:
+                cache.set(cache_key, [summary, tags])
+                return summary, tags, "api"
+            print(f"API返回结果为空，重试中... (尝试 {retry + 1}/{max_retries})")
+        except Exception as e:
+            print(f"API调用失败: {e} (尝试 {retry + 1}/{max_retries})")
+        if retry < max_retries - 1:
+            time.sleep(BI_INTENT_RETRY_BASE_DELAY * (2 ** retry) * (1 + random.random()))
+    return '', [], "failed"
+
+
+def bi_intent_mapping(api_key, input_csv_path, output_csv_path, cache_path=None,
+                      workers=BI_INTENT_WORKERS, rate=BI_INTENT_RATE_LIMIT):
+    """
+    为知识库文档生成摘要和标签
+
+    参数:
+        api_key: 豆包API密钥
+        input_csv_path: 输入CSV目录
+        output_csv_path: 输出CSV目录
+        cache_path: SQLite缓存文件路径，默认为输出目录下的BI_INTENT_CACHE_FILE
+        workers: 并发调用API的线程数
+        rate: 每秒最多发起的请求数
+    """
     start_time = datetime.now()
     print(f"开始处理: {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
 
-    # 初始化缓存字典
-    cache = {}
+    os.makedirs(output_csv_path, exist_ok=True)
+    cache = SQLiteCache(cache_path or os.path.join(output_csv_path, BI_INTENT_CACHE_FILE))
+    print(f"持久化缓存中已有 {len(cache)} 条结果")
+    limiter = TokenBucket(rate, BI_INTENT_RATE_BURST)
 
     input_csv_file_list = return_csv_file_list(input_csv_path)
     print(f"找到 {len(input_csv_file_list)} 个CSV文件待处理")
 
-    # 添加API调用计数器
-    api_call_count = 0
+    counts = {"api": 0, "cache": 0, "failed": 0}
     total_processed = 0
-    total_rows = 0
-
-    # 首先统计总行数
-    for csv_file in input_csv_file_list:
-        rows = read_csv_rows(csv_file)
-        total_rows += len(rows)
-
-    print(f"总共需要处理 {total_rows} 行数据")
-
-    for file_index, csv_file in enumerate(input_csv_file_list):
-        file_name = os.path.basename(csv_file)
-        output_file = os.path.join(output_csv_path, file_name)
-        print(f"\n[{file_index + 1}/{len(input_csv_file_list)}] 处理文件：{file_name}")
-
-        # 确保输出目录存在
-        os.makedirs(os.path.dirname(output_file), exist_ok=True)
-
-        rows = read_csv_rows(csv_file)
-        print(f"读取到 {len(rows)} 行数据")
-
-        # 创建新表头
-        new_header = ['章节标题', '子标题', '内容', '总结', '标签']
-
-        new_rows = []
-        for row_index, row in enumerate(rows):
-            total_processed += 1
-            progress = (total_processed / total_rows) * 100
-
-            # 显示进度
-            print(f"进度: {total_processed}/{total_rows} ({progress:.1f}%) - 当前文件进度: {row_index + 1}/{len(rows)}")
-
-            # 确保行数据格式正确
-            if not row:
-                print("警告: 跳过空行")
-                continue
-
-            # 转换为JSON格式
-            json_data = list2json(row)
-            prompt = bi_intent_mapping_prompt.format(input_text=json.dumps(json_data, ensure_ascii=False))
-
-            # 检查缓存
-            cache_key = get_cache_key(prompt)
-            if cache_key in cache:
-                print("使用缓存结果")
-                summary, tags = cache[cache_key]
-            else:
-                # API调用频率限制：每10次调用暂停2秒
-                api_call_count += 1
-                if api_call_count % 10 == 0:
-                    print("已完成10次API调用，暂停2秒...")
-                    time.sleep(2)
-
-                # 添加重试机制
-                max_retries = 3
-                for retry in range(max_retries):
-                    try:
-                        print(f"调用API中... (尝试 {retry + 1}/{max_retries})")
-                        response = use_doubao_api(api_key, prompt)
-                        summary, tags = process_json(response)
-
-                        # 检查结果有效性
-                        if summary or tags:
-                            # 存入缓存
-                            cache[cache_key] = (summary, tags)
-                            break
-                        else:
-                            print("API返回结果为空，重试中...")
-                            time.sleep(1)
-                    except Exception as e:
-                        print(f"API调用失败: {e}")
-                        if retry == max_retries - 1:
-                            summary, tags = '', []
-                        time.sleep(2)
-
-            # 构建新行，安全处理
-            new_row = []
-            for i in range(min(3, len(row))):
-                new_row.append(row[i])
-
-            # 确保行有3个元素
-            while len(new_row) < 3:
-                new_row.append("")
-
-            # 添加总结和标签
-            new_row.extend([summary, tags])
-            new_rows.append(new_row)
-
-        # 写入新CSV文件
-        with open(output_file, 'w', newline='', encoding='utf-8') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(new_header)
-            writer.writerows(new_rows)
-
-        print(f"完成文件处理，已写入新文件: {output_file}")
-
+    # 同时在途的行数上限，行按顺序写出，保证内存占用与文件大小无关
+    window = workers * 4
+
+    # 创建新表头
+    new_header = ['章节标题', '子标题', '内容', '总结', '标签']
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for file_index, csv_file in enumerate(input_csv_file_list):
+            file_name = os.path.basename(csv_file)
+            output_file = os.path.join(output_csv_path, file_name)
+            print(f"\n[{file_index + 1}/{len(input_csv_file_list)}] 处理文件：{file_name}")
+
+            tmp_file = output_file + ".tmp"
+            in_flight = deque()
+            file_rows = 0
+            with open(tmp_file, 'w', newline='', encoding='utf-8') as csvfile:
+                writer = csv.writer(csvfile)
+                writer.writerow(new_header)
+
+                def write_head():
+                    nonlocal total_processed
+                    row, future = in_flight.popleft()
+                    summary, tags, source = future.result()
+                    counts[source] += 1
+                    total_processed += 1
+                    writer.writerow(build_output_row(row, summary, tags))
+                    if total_processed % 100 == 0:
+                        print(f"进度: 已处理 {total_processed} 行，API调用 {counts['api']} 次，"
+                              f"缓存命中 {counts['cache']} 次，失败 {counts['failed']} 次")
+
+                for row in iter_csv_rows(csv_file):
+                    # 确保行数据格式正确
+                    if not row:
+                        print("警告: 跳过空行")
+                        continue
+
+                    # 转换为JSON格式
+                    json_data = list2json(row)
+                    prompt = bi_intent_mapping_prompt.format(input_text=json.dumps(json_data, ensure_ascii=False))
+                    in_flight.append((row, executor.submit(generate_summary_and_tags, api_key, prompt, cache, limiter)))
+                    file_rows += 1
+                    if len(in_flight) >= window:
+                        write_head()
+
+                while in_flight:
+                    write_head()
+
+            os.replace(tmp_file, output_file)
+            print(f"完成文件处理（{file_rows}行），已写入新文件: {output_file}")
+
+    cache.close()
     end_time = datetime.now()
     time_used = end_time - start_time
     print(f"\n处理完成: {end_time.strftime('%Y-%m-%d %H:%M:%S')}")
     print(f"总耗时: {time_used}")
-    print(f"API总调用次数: {api_call_count}")
-    print(f"缓存命中次数: {total_processed - api_call_count}")
+    print(f"总处理行数: {total_processed}")
+    print(f"API总调用次数: {counts['api']}")
+    print(f"缓存命中次数: {counts['cache']}")
+    print(f"失败行数: {counts['failed']}")
 
 
 if __name__ == "__main__":
@@ -9,22 +9,40 @@ import csv
 import json
 import numpy as np
 import faiss
-import pickle
+import hashlib
 from tqdm import tqdm
 import time
 import argparse
 from datetime import datetime
 from openai import OpenAI
 
+from RAG.ingest.embedding_cache import get_embedding_cache, embed_with_cache
+from RAG.index_factory import (INDEX_TYPES, create_index, supports_remove, needs_rescore, evaluate_recall,
+                               rescore_vectors_path, load_rescore_vectors)
+from RAG.doc_store import DOC_FIELDS, DocStore, write_doc_store
+from RAG.bm25 import BM25_FILE, build_bm25, save_bm25
+from config import INDEX_TYPE, BM25_ENABLED, CONTENT_INDEX_ENABLED, CONTENT_INDEX_TYPE, FEDERATED_ALL_KB_NAME
+
 # 配置参数
 EMBEDDING_MODEL_UID = None  # 将在运行时从API获取
 EMBEDDING_API_URL = "http://localhost:9997/v1"
 KNOWLEDGE_BASE_ROOT = r"F:\StrivingRendersMeCozy\DeepLearning\ERAG\Data\Knowledge_Base"
 CSV_ROOT = r"F:\StrivingRendersMeCozy\DeepLearning\ERAG\Data\Knowledge_Docs"
 VECTOR_DIMENSION = 1024  # bge-m3的维度
+EMBEDDING_CACHE_DIR = r"F:\StrivingRendersMeCozy\DeepLearning\ERAG\Data\Embedding_Cache"
+USE_EMBEDDING_CACHE = True  # 是否复用已生成的嵌入向量
+INCREMENTAL_REBUILD_RATIO = 0.3  # 增量更新时已删除文档占比超过该值则全量重建
 
 
 def get_embeddings(texts):
+    """获取文本的嵌入向量，缓存中已有的文本不再重复请求"""
+    cache = None
+    if USE_EMBEDDING_CACHE:
+        cache = get_embedding_cache(EMBEDDING_CACHE_DIR, EMBEDDING_MODEL_UID, VECTOR_DIMENSION)
+    return embed_with_cache(texts, request_embeddings, cache)
+
+
+def request_embeddings(texts):
     """使用OpenAI API获取文本的嵌入向量"""
     client = OpenAI(api_key="not empty", base_url=EMBEDDING_API_URL)
 
@@ -102,6 +120,263 @@ def read_csv_file(file_path):
     return documents
 
 
+def doc_fingerprint(doc):
+    """文档指纹，内容、总结、标签任一变化都会得到不同的指纹"""
+    payload = json.dumps([doc['内容'], doc['总结'], doc['标签']], ensure_ascii=False)
+    return hashlib.md5(payload.encode('utf-8')).hexdigest()
+
+
+def build_tag_postings(documents, tag_vocab=None):
+    """
+    构建去重后的标签词表和CSR格式的倒排表
+
+    参数:
+        documents: 文档列表，下标即文档ID，None表示已删除的文档
+        tag_vocab: 已有的标签词表，增量更新时沿用其中的标签ID，新标签追加到末尾
+
+    返回:
+        (标签词表, indptr, indices)，标签i关联的文档ID为indices[indptr[i]:indptr[i + 1]]，
+        不再关联任何文档的标签在词表中置为None
+    """
+    tag_vocab = list(tag_vocab) if tag_vocab else []
+    tag_ids = {tag: i for i, tag in enumerate(tag_vocab) if tag is not None}
+    postings = [[] for _ in tag_vocab]
+
+    for doc_id, doc in enumerate(documents):
+        if doc is None:
+            continue
+        for tag in dict.fromkeys(doc['标签']):
+            if not tag:
+                continue
+            if tag not in tag_ids:
+                tag_ids[tag] = len(tag_vocab)
+                tag_vocab.append(tag)
+                postings.append([])
+            postings[tag_ids[tag]].append(doc_id)
+
+    for tag_idx, doc_ids in enumerate(postings):
+        if not doc_ids:
+            tag_vocab[tag_idx] = None
+
+    indptr = np.zeros(len(tag_vocab) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(doc_ids) for doc_ids in postings])
+    indices = np.array([doc_id for doc_ids in postings for doc_id in doc_ids], dtype=np.int64)
+    return tag_vocab, indptr, indices
+
+
+def build_id_index(vectors, ids, index_type=None):
+    """
+    构建带ID映射的FAISS索引，支持按ID增删向量
+
+    使用内积相似度，向量归一化后等价于余弦相似度；索引类型由index_type（默认INDEX_TYPE）和向量数量决定
+
+    返回:
+        (索引, 索引参数)
+    """
+    if len(ids):
+        faiss.normalize_L2(vectors)
+    index, params = create_index(vectors, ids, VECTOR_DIMENSION, index_type or INDEX_TYPE)
+    if needs_rescore(params) and len(ids):
+        # 有损压缩索引与float32精确检索对比召回率，结果随索引参数保存
+        params["recall"] = evaluate_recall(index, vectors, ids)
+        recall = params["recall"]
+        print(f"{params['index_type']}索引recall@{recall['k']}: {recall['recall']:.4f}，"
+              f"原始向量重打分后: {recall['rescored_recall']:.4f}")
+    return index, params
+
+
+def dense_vectors(count, ids, vectors, base=None):
+    """
+    按ID排列的归一化原始向量，供有损压缩索引重打分
+
+    参数:
+        count: 行数（ID上限）
+        ids: 写入的ID
+        vectors: ids对应的向量
+        base: 已有的按ID排列的向量，先复制到前几行
+    """
+    dense = np.zeros((count, VECTOR_DIMENSION), dtype=np.float32)
+    if base is not None:
+        rows = min(len(base), count)
+        dense[:rows] = base[:rows]
+    if vectors is not None and len(ids):
+        vectors = np.array(vectors, dtype=np.float32)
+        faiss.normalize_L2(vectors)
+        dense[np.asarray(ids, dtype=np.int64)] = vectors
+    return dense
+
+
+def update_dense_vectors(kb_dir, name, count, remove_ids, add_ids, add_vectors, active_items):
+    """
+    增量更新按ID排列的原始向量
+
+    已有向量文件时只清空删除的行、写入新增的行；没有时（如由无损索引改为压缩索引）按active_items从嵌入缓存补全
+    """
+    base = load_rescore_vectors(kb_dir, name)
+    if base is None:
+        ids = [item_id for item_id, _ in active_items]
+        return dense_vectors(count, ids, get_embeddings([text for _, text in active_items]) if ids else None)
+    dense = dense_vectors(count, add_ids, add_vectors, base)
+    if remove_ids:
+        dense[np.asarray(remove_ids, dtype=np.int64)] = 0
+    return dense
+
+
+def update_id_index(index, index_params, remove_ids, add_ids, add_texts, active_items,
+                    add_vectors=None, index_type=None):
+    """
+    按ID增删索引中的向量
+
+    参数:
+        index: 已有索引
+        index_params: 已有索引的参数
+        remove_ids: 需要删除的ID
+        add_ids: 新增向量的ID
+        add_texts: 新增向量对应的文本
+        active_items: 更新后所有有效的(ID, 文本)，索引不支持删除时据此重建
+        add_vectors: 已生成的新增向量，为None时根据add_texts生成
+        index_type: 重建时使用的索引类型，默认INDEX_TYPE
+
+    返回:
+        (索引, 索引参数)
+    """
+    if remove_ids and not supports_remove(index):
+        # HNSW不支持删除，整体重建；嵌入向量来自缓存，不会重复请求
+        print("索引不支持按ID删除，使用嵌入缓存重建索引...")
+        ids = [item_id for item_id, _ in active_items]
+        vectors = get_embeddings([text for _, text in active_items])
+        return build_id_index(vectors, ids, index_type)
+
+    if remove_ids:
+        index.remove_ids(np.asarray(remove_ids, dtype=np.int64))
+    if add_ids:
+        vectors = get_embeddings(add_texts) if add_vectors is None else np.array(add_vectors, dtype=np.float32)
+        faiss.normalize_L2(vectors)
+        index.add_with_ids(vectors, np.asarray(add_ids, dtype=np.int64))
+
+    index_params = dict(index_params, count=int(index.ntotal))
+    return index, index_params
+
+
+def write_atomic(path, write_fn):
+    """先写临时文件再替换，避免检索进程读到写了一半的文件"""
+    tmp_path = path + ".tmp"
+    write_fn(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def save_knowledge_base(kb_dir, metadata, summary_index, tag_index, source_file, content_index=None,
+                        rescore_vectors=None):
+    """
+    保存索引、元数据和知识库信息，content_index为None时删除已有的内容索引
+
+    rescore_vectors为{索引名称: 按ID排列的原始向量}，只有有损压缩索引需要，其余索引的向量文件会被删除
+    """
+    print("保存索引和元数据...")
+    write_atomic(os.path.join(kb_dir, "summary_index.faiss"),
+                 lambda path: faiss.write_index(summary_index, path))
+    write_atomic(os.path.join(kb_dir, "tag_index.faiss"),
+                 lambda path: faiss.write_index(tag_index, path))
+    content_index_path = os.path.join(kb_dir, "content_index.faiss")
+    if content_index is not None:
+        write_atomic(content_index_path, lambda path: faiss.write_index(content_index, path))
+    elif os.path.exists(content_index_path):
+        os.remove(content_index_path)
+
+    rescore_vectors = rescore_vectors or {}
+    for name in ("summary", "tag", "content"):
+        vectors_path = rescore_vectors_path(kb_dir, name)
+        if name in rescore_vectors:
+            def dump_vectors(path, vectors=rescore_vectors[name]):
+                with open(path, 'wb') as f:
+                    np.save(f, vectors)
+
+            write_atomic(vectors_path, dump_vectors)
+        elif os.path.exists(vectors_path):
+            os.remove(vectors_path)
+
+    # 文档写入可内存映射的列式存储，检索时只读取命中的文档
+    write_doc_store(kb_dir, metadata["documents"])
+
+    # 标签倒排表和文档指纹存为数组，指纹只在增量更新时使用
+    def dump_arrays(path):
+        with open(path, 'wb') as f:
+            np.savez(f,
+                     tag_postings_indptr=metadata["tag_postings_indptr"],
+                     tag_postings_indices=metadata["tag_postings_indices"],
+                     fingerprints=np.array([fp or "" for fp in metadata["fingerprints"]], dtype="S32"))
+
+    write_atomic(os.path.join(kb_dir, "kb_arrays.npz"), dump_arrays)
+
+    # BM25倒排表不涉及嵌入，每次保存时按当前文档重新生成
+    bm25_path = os.path.join(kb_dir, BM25_FILE)
+    if BM25_ENABLED:
+        print("构建BM25索引...")
+        bm25_arrays = build_bm25([doc['内容'] + "\n" + doc['总结'] if doc is not None else None
+                                  for doc in metadata["documents"]])
+        write_atomic(bm25_path, lambda path: save_bm25(path, bm25_arrays))
+    elif os.path.exists(bm25_path):
+        os.remove(bm25_path)
+
+    def dump_metadata(path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({
+                "name": metadata["name"],
+                "tag_vocab": metadata["tag_vocab"],
+                "created_at": metadata["created_at"]
+            }, f, ensure_ascii=False)
+
+    write_atomic(os.path.join(kb_dir, "metadata.json"), dump_metadata)
+
+    # 保存索引类型和训练参数，检索时据此设置nprobe/efSearch，增量更新时也会读回
+    def dump_index_params(path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(metadata["index_params"], f, ensure_ascii=False, indent=2)
+
+    write_atomic(os.path.join(kb_dir, "index_params.json"), dump_index_params)
+
+    # 移除旧格式的元数据文件
+    legacy_path = os.path.join(kb_dir, "metadata.pkl")
+    if os.path.exists(legacy_path):
+        os.remove(legacy_path)
+
+    # 保存知识库信息
+    kb_info = {
+        "name": metadata["name"],
+        "document_count": sum(1 for doc in metadata["documents"] if doc is not None),
+        "tag_count": sum(1 for tag in metadata["tag_vocab"] if tag is not None),
+        "source_file": os.path.basename(source_file),
+        "created_at": metadata["created_at"],
+        "updated_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    }
+
+    def dump_info(path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(kb_info, f, ensure_ascii=False, indent=2)
+
+    write_atomic(os.path.join(kb_dir, "info.json"), dump_info)
+
+
+def load_saved_knowledge_base(kb_dir):
+    """读取已保存的知识库，返回与构建时结构相同的元数据字典"""
+    with open(os.path.join(kb_dir, "metadata.json"), 'r', encoding='utf-8') as f:
+        metadata = json.load(f)
+
+    with open(os.path.join(kb_dir, "index_params.json"), 'r', encoding='utf-8') as f:
+        metadata["index_params"] = json.load(f)
+
+    arrays = np.load(os.path.join(kb_dir, "kb_arrays.npz"))
+    metadata["tag_postings_indptr"] = arrays["tag_postings_indptr"]
+    metadata["tag_postings_indices"] = arrays["tag_postings_indices"]
+    metadata["fingerprints"] = [fp.decode('ascii') or None for fp in arrays["fingerprints"]]
+
+    store = DocStore(kb_dir)
+    metadata["documents"] = [{field: doc[field] for field in DOC_FIELDS} if doc else None
+                             for _, doc in store.iter_documents()]
+    store.close()
+    return metadata
+
+
 def build_single_knowledge_base(csv_file, kb_name):
     """构建单个知识库"""
     start_time = datetime.now()
@@ -118,72 +393,52 @@ def build_single_knowledge_base(csv_file, kb_name):
         return False
 
     print(f"读取了 {len(documents)} 个文档")
+    doc_ids = list(range(len(documents)))
 
     # 提取摘要文本
     summaries = [doc['总结'] for doc in documents]
-    print("为总结生成嵌入向量...")
-    summary_vectors = get_embeddings(summaries)
-
-    # 提取标签
-    all_tags = []
-    tag_to_doc_map = {}  # 标签索引到文档索引的映射
-
-    for doc_idx, doc in enumerate(documents):
-        for tag in doc['标签']:
-            if tag:
-                tag_idx = len(all_tags)
-                all_tags.append(tag)
-                if tag_idx not in tag_to_doc_map:
-                    tag_to_doc_map[tag_idx] = []
-                tag_to_doc_map[tag_idx].append(doc_idx)
-
-    print(f"总共有 {len(all_tags)} 个标签")
-    print("为标签生成嵌入向量...")
-    tag_vectors = get_embeddings(all_tags)
-
-    # 构建FAISS索引 - 使用内积相似度（归一化后等价于余弦相似度）
-    print("构建FAISS索引...")
-
-    # 为总结创建索引
-    summary_index = faiss.IndexFlatIP(VECTOR_DIMENSION)
-    # 归一化向量以使用余弦相似度
-    faiss.normalize_L2(summary_vectors)
-    summary_index.add(summary_vectors)
 
-    # 为标签创建索引
-    tag_index = faiss.IndexFlatIP(VECTOR_DIMENSION)
-    # 归一化向量以使用余弦相似度
-    faiss.normalize_L2(tag_vectors)
-    tag_index.add(tag_vectors)
+    # 提取去重后的标签词表，每个标签只嵌入和索引一次
+    tag_vocab, tag_indptr, tag_indices = build_tag_postings(documents)
+    print(f"总共有 {len(tag_indices)} 个标签，去重后 {len(tag_vocab)} 个")
 
-    # 保存索引
-    print("保存索引和元数据...")
-    faiss.write_index(summary_index, os.path.join(kb_dir, "summary_index.faiss"))
-    faiss.write_index(tag_index, os.path.join(kb_dir, "tag_index.faiss"))
+    # 总结、标签和内容（可选）在同一批次中生成嵌入向量
+    contents = [doc['内容'] for doc in documents] if CONTENT_INDEX_ENABLED else []
+    print("为总结、标签" + ("和内容" if contents else "") + "生成嵌入向量...")
+    vectors = get_embeddings(summaries + tag_vocab + contents)
+    summary_vectors = vectors[:len(summaries)]
+    tag_vectors = vectors[len(summaries):len(summaries) + len(tag_vocab)]
+    content_vectors = vectors[len(summaries) + len(tag_vocab):]
 
-    # 保存元数据
+    # 构建FAISS索引，文档ID即文档在列表中的位置
+    print("构建FAISS索引...")
+    summary_index, summary_params = build_id_index(summary_vectors, doc_ids)
+    tag_index, tag_params = build_id_index(tag_vectors, list(range(len(tag_vocab))))
+    index_params = {"summary": summary_params, "tag": tag_params}
+    content_index = None
+    if contents:
+        content_index, index_params["content"] = build_id_index(content_vectors, doc_ids, CONTENT_INDEX_TYPE)
+
+    # 有损压缩索引另存原始向量，检索时用于重打分
+    rescore_vectors = {}
+    for name, ids, index_vectors in (("summary", doc_ids, summary_vectors),
+                                     ("tag", list(range(len(tag_vocab))), tag_vectors),
+                                     ("content", doc_ids, content_vectors)):
+        if needs_rescore(index_params.get(name, {})):
+            rescore_vectors[name] = dense_vectors(len(ids), ids, index_vectors)
+
+    created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     metadata = {
         "name": kb_name,
         "documents": documents,
-        "all_tags": all_tags,
-        "tag_to_doc_map": tag_to_doc_map,
-        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        "fingerprints": [doc_fingerprint(doc) for doc in documents],
+        "tag_vocab": tag_vocab,
+        "tag_postings_indptr": tag_indptr,
+        "tag_postings_indices": tag_indices,
+        "index_params": index_params,
+        "created_at": created_at
     }
-
-    with open(os.path.join(kb_dir, "metadata.pkl"), 'wb') as f:
-        pickle.dump(metadata, f)
-
-    # 保存知识库信息
-    kb_info = {
-        "name": kb_name,
-        "document_count": len(documents),
-        "tag_count": len(all_tags),
-        "source_file": os.path.basename(csv_file),
-        "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    }
-
-    with open(os.path.join(kb_dir, "info.json"), 'w', encoding='utf-8') as f:
-        json.dump(kb_info, f, ensure_ascii=False, indent=2)
+    save_knowledge_base(kb_dir, metadata, summary_index, tag_index, csv_file, content_index, rescore_vectors)
 
     end_time = datetime.now()
     time_used = end_time - start_time
@@ -191,7 +446,169 @@ def build_single_knowledge_base(csv_file, kb_name):
     return True
 
 
-def build_all_knowledge_bases():
+def update_single_knowledge_base(csv_file, kb_name):
+    """
+    增量更新单个知识库
+
+    将CSV中的文档与已保存的文档指纹比对，只对新增或修改的文档生成嵌入并写入索引，
+    删除或被修改的旧文档从索引中移除。被删除的文档在元数据中保留为None，
+    使文档ID与列表位置保持一致；删除比例过高时改为全量重建以回收空间。
+    """
+    kb_dir = os.path.join(KNOWLEDGE_BASE_ROOT, kb_name)
+    if not os.path.exists(os.path.join(kb_dir, "metadata.json")):
+        if os.path.exists(os.path.join(kb_dir, "metadata.pkl")):
+            print(f"知识库 '{kb_name}' 为旧格式，执行全量构建")
+        else:
+            print(f"知识库 '{kb_name}' 不存在，执行全量构建")
+        return build_single_knowledge_base(csv_file, kb_name)
+
+    metadata = load_saved_knowledge_base(kb_dir)
+
+    start_time = datetime.now()
+    print(f"\n开始增量更新知识库 '{kb_name}'...")
+
+    new_documents = read_csv_file(csv_file)
+    if not new_documents:
+        print(f"错误: 无法从文件 {os.path.basename(csv_file)} 读取有效数据")
+        return False
+
+    documents = metadata["documents"]
+    fingerprints = metadata["fingerprints"]
+    old_tag_vocab = metadata["tag_vocab"]
+
+    # 比对指纹：指纹相同的文档保留，其余旧文档删除、新文档新增（修改等价于删除+新增）
+    existing = {}
+    for doc_id, fingerprint in enumerate(fingerprints):
+        if fingerprint is not None:
+            existing.setdefault(fingerprint, []).append(doc_id)
+
+    added_docs = []
+    for doc in new_documents:
+        fingerprint = doc_fingerprint(doc)
+        if existing.get(fingerprint):
+            existing[fingerprint].pop()
+        else:
+            added_docs.append(doc)
+    removed_ids = sorted(doc_id for ids in existing.values() for doc_id in ids)
+
+    print(f"新增 {len(added_docs)} 个文档，删除 {len(removed_ids)} 个文档")
+    if not added_docs and not removed_ids:
+        print(f"知识库 '{kb_name}' 无变化")
+        return True
+
+    active_count = len(new_documents)
+    dead_count = sum(1 for doc in documents if doc is None) + len(removed_ids)
+    if dead_count > INCREMENTAL_REBUILD_RATIO * (active_count + dead_count):
+        print("已删除文档占比过高，执行全量重建")
+        return build_single_knowledge_base(csv_file, kb_name)
+
+    summary_index = faiss.read_index(os.path.join(kb_dir, "summary_index.faiss"))
+    tag_index = faiss.read_index(os.path.join(kb_dir, "tag_index.faiss"))
+
+    index_params = metadata["index_params"]
+
+    # 删除旧文档，追加新文档
+    for doc_id in removed_ids:
+        documents[doc_id] = None
+        fingerprints[doc_id] = None
+    new_doc_ids = list(range(len(documents), len(documents) + len(added_docs)))
+    documents.extend(added_docs)
+    fingerprints.extend(doc_fingerprint(doc) for doc in added_docs)
+
+    # 新增文档的总结和内容在同一批次中生成嵌入向量
+    content_index_path = os.path.join(kb_dir, "content_index.faiss")
+    update_content = CONTENT_INDEX_ENABLED and os.path.exists(content_index_path)
+    added_summaries = [doc['总结'] for doc in added_docs]
+    added_contents = [doc['内容'] for doc in added_docs] if update_content else []
+    added_vectors = get_embeddings(added_summaries + added_contents) if added_docs else None
+
+    print("更新总结索引...")
+    active_summaries = [(doc_id, doc['总结']) for doc_id, doc in enumerate(documents) if doc is not None]
+    added_summary_vectors = added_vectors[:len(added_docs)] if added_docs else None
+    summary_index, summary_params = update_id_index(
+        summary_index, index_params.get("summary", {}), removed_ids,
+        new_doc_ids, added_summaries, active_summaries, added_summary_vectors
+    )
+    new_index_params = {"summary": summary_params}
+    rescore_vectors = {}
+    if needs_rescore(summary_params):
+        rescore_vectors["summary"] = update_dense_vectors(
+            kb_dir, "summary", len(documents), removed_ids, new_doc_ids, added_summary_vectors, active_summaries)
+
+    content_index = None
+    active_contents = [(doc_id, doc['内容']) for doc_id, doc in enumerate(documents) if doc is not None]
+    if update_content:
+        print("更新内容索引...")
+        added_content_vectors = added_vectors[len(added_docs):] if added_docs else None
+        content_index, new_index_params["content"] = update_id_index(
+            faiss.read_index(content_index_path), index_params.get("content", {}), removed_ids,
+            new_doc_ids, added_contents, active_contents, added_content_vectors, CONTENT_INDEX_TYPE
+        )
+        if needs_rescore(new_index_params["content"]):
+            rescore_vectors["content"] = update_dense_vectors(
+                kb_dir, "content", len(documents), removed_ids, new_doc_ids, added_content_vectors, active_contents)
+    elif CONTENT_INDEX_ENABLED:
+        # 之前未构建内容索引，为所有有效文档补建，已有嵌入从缓存读取
+        print("构建内容索引...")
+        active_ids = [doc_id for doc_id, _ in active_contents]
+        content_vectors = get_embeddings([text for _, text in active_contents])
+        content_index, new_index_params["content"] = build_id_index(content_vectors, active_ids, CONTENT_INDEX_TYPE)
+        if needs_rescore(new_index_params["content"]):
+            rescore_vectors["content"] = dense_vectors(len(documents), active_ids, content_vectors)
+
+    # 重建倒排表（不涉及嵌入），词表中新出现的标签加入索引，不再使用的标签移出索引
+    tag_vocab, tag_indptr, tag_indices = build_tag_postings(documents, old_tag_vocab)
+    removed_tag_ids = [tag_idx for tag_idx, tag in enumerate(old_tag_vocab)
+                       if tag is not None and tag_vocab[tag_idx] is None]
+    new_tag_ids = [tag_idx for tag_idx in range(len(old_tag_vocab), len(tag_vocab))
+                   if tag_vocab[tag_idx] is not None]
+
+    print(f"更新标签索引，新增 {len(new_tag_ids)} 个标签，移除 {len(removed_tag_ids)} 个标签...")
+    new_tags = [tag_vocab[tag_idx] for tag_idx in new_tag_ids]
+    active_tags = [(tag_idx, tag) for tag_idx, tag in enumerate(tag_vocab) if tag is not None]
+    added_tag_vectors = get_embeddings(new_tags) if new_tags else None
+    tag_index, tag_params = update_id_index(
+        tag_index, index_params.get("tag", {}), removed_tag_ids,
+        new_tag_ids, new_tags, active_tags, added_tag_vectors
+    )
+    if needs_rescore(tag_params):
+        rescore_vectors["tag"] = update_dense_vectors(
+            kb_dir, "tag", len(tag_vocab), removed_tag_ids, new_tag_ids, added_tag_vectors, active_tags)
+
+    metadata["tag_vocab"] = tag_vocab
+    metadata["tag_postings_indptr"] = tag_indptr
+    metadata["tag_postings_indices"] = tag_indices
+    new_index_params["tag"] = tag_params
+    metadata["index_params"] = new_index_params
+
+    save_knowledge_base(kb_dir, metadata, summary_index, tag_index, csv_file, content_index, rescore_vectors)
+
+    time_used = datetime.now() - start_time
+    print(f"知识库 '{kb_name}' 增量更新完成! 耗时: {time_used}")
+    return True
+
+
+def update_kb_mapping(entries):
+    """合并更新知识库映射文件，只修改传入的知识库条目"""
+    kb_mapping_path = os.path.join(KNOWLEDGE_BASE_ROOT, "kb_mapping.json")
+
+    if os.path.exists(kb_mapping_path):
+        with open(kb_mapping_path, 'r', encoding='utf-8') as f:
+            kb_mapping = json.load(f)
+    else:
+        kb_mapping = {}
+
+    kb_mapping.update(entries)
+
+    def dump_mapping(path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(kb_mapping, f, ensure_ascii=False, indent=2)
+
+    write_atomic(kb_mapping_path, dump_mapping)
+    return kb_mapping
+
+
+def build_all_knowledge_bases(incremental=False):
     """构建所有CSV文件的知识库"""
     # 确保输出目录存在
     os.makedirs(KNOWLEDGE_BASE_ROOT, exist_ok=True)
@@ -199,6 +616,12 @@ def build_all_knowledge_bases():
     # 读取所有CSV文件
     csv_files = [os.path.join(CSV_ROOT, f) for f in os.listdir(CSV_ROOT)
                  if f.endswith('.csv')]
+    if FEDERATED_ALL_KB_NAME:
+        # 全库由联合检索实现，不再把所有数据重复构建为一个知识库
+        all_csv = os.path.join(CSV_ROOT, f"{FEDERATED_ALL_KB_NAME}.csv")
+        if all_csv in csv_files:
+            csv_files.remove(all_csv)
+            print(f"跳过 {FEDERATED_ALL_KB_NAME}.csv，{FEDERATED_ALL_KB_NAME}知识库为所有知识库的联合检索")
 
     if not csv_files:
         print(f"错误: 在目录 {CSV_ROOT} 中没有找到CSV文件")
@@ -206,8 +629,9 @@ def build_all_knowledge_bases():
 
     print(f"找到 {len(csv_files)} 个CSV文件")
 
-    # 构建知识库映射文件
-    kb_mapping = {}
+    # 本次构建成功的知识库
+    kb_entries = {}
+    build_fn = update_single_knowledge_base if incremental else build_single_knowledge_base
 
     # 处理每个CSV文件
     for i, csv_file in enumerate(csv_files):
@@ -217,26 +641,32 @@ def build_all_knowledge_bases():
 
         print(f"\n[{i + 1}/{len(csv_files)}] 处理文件: {file_name}")
 
-        success = build_single_knowledge_base(
+        success = build_fn(
             csv_file=csv_file,
             kb_name=kb_name
         )
 
         if success:
-            kb_mapping[kb_name] = {
+            kb_entries[kb_name] = {
                 "path": os.path.join(KNOWLEDGE_BASE_ROOT, kb_name),
                 "source_file": file_name
             }
 
     # 保存知识库映射
-    with open(os.path.join(KNOWLEDGE_BASE_ROOT, "kb_mapping.json"), 'w', encoding='utf-8') as f:
-        json.dump(kb_mapping, f, ensure_ascii=False, indent=2)
+    kb_mapping = update_kb_mapping(kb_entries)
+    if FEDERATED_ALL_KB_NAME:
+        members = sorted(name for name, entry in kb_mapping.items()
+                         if name != FEDERATED_ALL_KB_NAME and not entry.get("members"))
+        update_kb_mapping({FEDERATED_ALL_KB_NAME: {"members": members, "virtual": True}})
+        print(f"虚拟知识库 {FEDERATED_ALL_KB_NAME} 包含: {', '.join(members)}")
+        if os.path.isdir(os.path.join(KNOWLEDGE_BASE_ROOT, FEDERATED_ALL_KB_NAME)):
+            print(f"提示: 旧的 {FEDERATED_ALL_KB_NAME} 知识库目录已不再使用，可以手动删除")
 
-    print(f"\n所有知识库构建完成! 总共构建了 {len(kb_mapping)} 个知识库")
-    print(f"知识库列表: {', '.join(kb_mapping.keys())}")
+    print(f"\n所有知识库构建完成! 总共构建了 {len(kb_entries)} 个知识库")
+    print(f"知识库列表: {', '.join(kb_entries.keys())}")
 
 
-def build_specific_knowledge_base(csv_file_path, kb_name):
+def build_specific_knowledge_base(csv_file_path, kb_name, incremental=False):
     """构建指定的CSV文件知识库"""
     if not os.path.exists(csv_file_path):
         print(f"错误: 文件 {csv_file_path} 不存在")
@@ -245,28 +675,20 @@ def build_specific_knowledge_base(csv_file_path, kb_name):
     # 确保输出目录存在
     os.makedirs(KNOWLEDGE_BASE_ROOT, exist_ok=True)
 
-    success = build_single_knowledge_base(
+    build_fn = update_single_knowledge_base if incremental else build_single_knowledge_base
+    success = build_fn(
         csv_file=csv_file_path,
         kb_name=kb_name
     )
 
     if success:
         # 更新知识库映射
-        kb_mapping_path = os.path.join(KNOWLEDGE_BASE_ROOT, "kb_mapping.json")
-
-        if os.path.exists(kb_mapping_path):
-            with open(kb_mapping_path, 'r', encoding='utf-8') as f:
-                kb_mapping = json.load(f)
-        else:
-            kb_mapping = {}
-
-        kb_mapping[kb_name] = {
-            "path": os.path.join(KNOWLEDGE_BASE_ROOT, kb_name),
-            "source_file": os.path.basename(csv_file_path)
-        }
-
-        with open(kb_mapping_path, 'w', encoding='utf-8') as f:
-            json.dump(kb_mapping, f, ensure_ascii=False, indent=2)
+        update_kb_mapping({
+            kb_name: {
+                "path": os.path.join(KNOWLEDGE_BASE_ROOT, kb_name),
+                "source_file": os.path.basename(csv_file_path)
+            }
+        })
 
 
 def get_embedding_model_uid():
@@ -295,8 +717,14 @@ if __name__ == "__main__":
     parser.add_argument('--all', action='store_true', help='构建所有CSV文件的知识库')
     parser.add_argument('--csv', type=str, help='指定CSV文件路径')
     parser.add_argument('--name', type=str, help='指定知识库名称')
+    parser.add_argument('--incremental', action='store_true', help='增量更新，只处理新增、修改和删除的文档')
+    parser.add_argument('--index-type', type=str, choices=INDEX_TYPES, default=INDEX_TYPE,
+                        help='向量索引类型，数据量低于INDEX_FLAT_THRESHOLD时自动使用flat')
+    parser.add_argument('--no-embedding-cache', action='store_true', help='不使用嵌入向量缓存，全部重新生成')
 
     args = parser.parse_args()
+    USE_EMBEDDING_CACHE = not args.no_embedding_cache
+    INDEX_TYPE = args.index_type
 
     # 获取embedding模型UID
     print("获取embedding模型UID...")
@@ -304,10 +732,11 @@ if __name__ == "__main__":
     print(f"使用embedding模型UID: {EMBEDDING_MODEL_UID}")
 
     if args.all:
-        build_all_knowledge_bases()
+        build_all_knowledge_bases(incremental=args.incremental)
     elif args.csv and args.name:
-        build_specific_knowledge_base(args.csv, args.name)
+        build_specific_knowledge_base(args.csv, args.name, incremental=args.incremental)
     else:
         print("请使用 --all 选项构建所有知识库，或使用 --csv 和 --name 选项构建特定知识库")
         print("例如: python build_knowledge_base.py --all")
-        print("或者: python build_knowledge_base.py --csv 文件路径.csv --name 知识库名称")
\ No newline at end of file
+        print("或者: python build_knowledge_base.py --csv 文件路径.csv --name 知识库名称")
+        print("增量更新: python build_knowledge_base.py --all --incremental")
\ No newline at end of file
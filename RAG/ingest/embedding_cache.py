@@ -0,0 +1,174 @@
+# coding:utf-8
+# @File  : embedding_cache.py
+# @Author: ganchun
+# @Date  :  2025/06/12
+# @Description: 磁盘嵌入向量缓存，按(模型UID, 维度, 文本哈希)复用已生成的向量
+
+import os
+import re
+import hashlib
+import threading
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+KEY_SIZE = 20  # sha1摘要长度
+
+
+class EmbeddingCache:
+    """
+    嵌入向量缓存
+
+    每个(模型UID, 维度)对应一个缓存目录，目录中包含两个只追加的文件:
+        keys.bin     - 每条记录20字节的文本sha1摘要，第i条对应向量第i行
+        vectors.f32  - 连续存放的float32向量，读取时使用内存映射
+
+    先写向量再写摘要，进程中断时多出的半截向量会在下次打开时被忽略
+    """
+
+    def __init__(self, cache_root: str, model_uid: str, dimension: int):
+        safe_uid = re.sub(r'[^0-9A-Za-z_.-]', '_', str(model_uid))
+        self.cache_dir = os.path.join(cache_root, f"{safe_uid}_{dimension}")
+        self.dimension = dimension
+        self.keys_path = os.path.join(self.cache_dir, "keys.bin")
+        self.vectors_path = os.path.join(self.cache_dir, "vectors.f32")
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._index = {}  # 摘要 -> 行号
+        self._rows = 0
+        self._pending = {}  # 待写入的 摘要 -> 向量
+        self._load()
+
+    @staticmethod
+    def text_hash(text: str) -> bytes:
+        return hashlib.sha1(text.encode('utf-8')).digest()
+
+    def _load(self):
+        """读取摘要文件，以摘要和向量都完整的行数为准"""
+        key_bytes = b""
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path, 'rb') as f:
+                key_bytes = f.read()
+        vector_rows = 0
+        if os.path.exists(self.vectors_path):
+            vector_rows = os.path.getsize(self.vectors_path) // (4 * self.dimension)
+
+        self._rows = min(len(key_bytes) // KEY_SIZE, vector_rows)
+        for row in range(self._rows):
+            self._index[key_bytes[row * KEY_SIZE:(row + 1) * KEY_SIZE]] = row
+
+        # 截掉中断写入留下的不完整数据，保证后续追加对齐
+        if len(key_bytes) != self._rows * KEY_SIZE:
+            with open(self.keys_path, 'r+b') as f:
+                f.truncate(self._rows * KEY_SIZE)
+        if os.path.exists(self.vectors_path) and \
+                os.path.getsize(self.vectors_path) != self._rows * 4 * self.dimension:
+            with open(self.vectors_path, 'r+b') as f:
+                f.truncate(self._rows * 4 * self.dimension)
+
+    def __len__(self):
+        return self._rows + len(self._pending)
+
+    def lookup(self, texts: List[str]) -> Tuple[np.ndarray, List[int]]:
+        """
+        查询缓存
+
+        返回:
+            (形状为(n, d)的向量矩阵, 未命中的位置列表)，未命中的行为零向量
+        """
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        missing = []
+        with self._lock:
+            stored = None
+            if self._rows:
+                stored = np.memmap(self.vectors_path, dtype=np.float32, mode='r',
+                                   shape=(self._rows, self.dimension))
+
+            for i, text in enumerate(texts):
+                key = self.text_hash(text)
+                row = self._index.get(key)
+                if row is not None and row < self._rows:
+                    vectors[i] = stored[row]
+                elif key in self._pending:
+                    vectors[i] = self._pending[key]
+                else:
+                    missing.append(i)
+        return vectors, missing
+
+    def add(self, texts: List[str], vectors: np.ndarray):
+        """添加新生成的向量，调用flush后写入磁盘"""
+        with self._lock:
+            for text, vector in zip(texts, vectors):
+                key = self.text_hash(text)
+                if key in self._index or key in self._pending:
+                    continue
+                self._pending[key] = np.asarray(vector, dtype=np.float32)
+
+    def flush(self):
+        """把待写入的向量追加到磁盘"""
+        with self._lock:
+            if not self._pending:
+                return
+            keys = list(self._pending.keys())
+            with open(self.vectors_path, 'ab') as f:
+                f.write(np.stack([self._pending[key] for key in keys]).astype(np.float32).tobytes())
+            with open(self.keys_path, 'ab') as f:
+                f.write(b"".join(keys))
+
+            for key in keys:
+                self._index[key] = self._rows
+                self._rows += 1
+            self._pending = {}
+
+
+_caches: Dict[Tuple[str, str, int], EmbeddingCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_embedding_cache(cache_root: str, model_uid: str, dimension: int) -> EmbeddingCache:
+    """获取进程内共享的缓存实例"""
+    key = (cache_root, str(model_uid), dimension)
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = EmbeddingCache(cache_root, model_uid, dimension)
+        return _caches[key]
+
+
+def embed_with_cache(texts: List[str], embed_fn, cache: EmbeddingCache = None,
+                     flush_every: int = 1024) -> np.ndarray:
+    """
+    带缓存的批量嵌入，只对缓存中没有的文本调用embed_fn
+
+    参数:
+        texts: 文本列表
+        embed_fn: 对文本列表生成嵌入向量的函数，返回(n, d)矩阵，失败的行为零向量
+        cache: 嵌入缓存，为None时直接调用embed_fn
+        flush_every: 每生成多少条新向量写一次磁盘，中断后已写入的部分不必重算
+
+    返回:
+        与texts顺序一致的(n, d)向量矩阵
+    """
+    if cache is None:
+        return embed_fn(texts)
+
+    vectors, missing = cache.lookup(texts)
+    print(f"嵌入缓存命中 {len(texts) - len(missing)}/{len(texts)} 条")
+    if not missing:
+        return vectors
+
+    # 相同文本只生成一次
+    unique_texts = list(dict.fromkeys(texts[i] for i in missing))
+    new_vectors = {}
+    for start in range(0, len(unique_texts), flush_every):
+        chunk = unique_texts[start:start + flush_every]
+        chunk_vectors = np.asarray(embed_fn(chunk), dtype=np.float32)
+        # 零向量是出错时的占位符，不写入缓存
+        valid = np.any(chunk_vectors != 0, axis=1)
+        cache.add([text for text, ok in zip(chunk, valid) if ok], chunk_vectors[valid])
+        cache.flush()
+        new_vectors.update(zip(chunk, chunk_vectors))
+
+    for i in missing:
+        vectors[i] = new_vectors[texts[i]]
+    return vectors
@@ -4,36 +4,77 @@
 # @Date  :  2025/04/15
 # @Description:
 # 输入是一个csv文件，调用LLM的API服务针对较多的内容进行语义分块，输出也是一个csv文件
+# 分块请求通过asyncio并发执行，受并发数和令牌桶速率双重限制，逐行记录断点，中断后可续跑
+import asyncio
 import csv
+import hashlib
 import json
 import os
-import time
+import random
 
-from openai import OpenAI
+from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
 
 from Prompt.prompt_templates import semantic_segment_prompt
+from RAG.clients import get_doubao_client, create_async_openai_client
+from RAG.ingest.rate_limiter import AsyncTokenBucket
+from config import (DOUBAO_API_URL, SEGMENT_CONCURRENCY, SEGMENT_RATE_LIMIT, SEGMENT_RATE_BURST,
+                    SEGMENT_MAX_RETRIES, SEGMENT_RETRY_BASE_DELAY)
 
-def use_doubao_api(api_key, prompt):
-    # 请确保您已将 API Key 存储在环境变量 ARK_API_KEY 中
-    client = OpenAI(
-        # 此为默认路径，您可根据业务所在地域进行配置
-        base_url="https://ark.cn-beijing.volces.com/api/v3",
-        api_key=api_key,
-    )
+SEGMENT_MODEL = "ep-20250306115053-vzsng"
+SEGMENT_SYSTEM_PROMPT = "你是十分强大的人工智能助手"
+SEGMENT_MIN_LENGTH = 500  # 内容长度达到该值才进行语义分块
+CHECKPOINT_DIR_NAME = ".checkpoint"
 
-    # Non-streaming:
-    print("----- standard request -----")
+# 限流、超时、连接失败和服务端错误可以重试，其余错误（如鉴权失败）重试也无济于事
+RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+def use_doubao_api(api_key, prompt):
+    """同步调用豆包API，供其他脚本单条调用"""
+    client = get_doubao_client(api_key)
     completion = client.chat.completions.create(
-        # 指定您创建的方舟推理接入点 ID，此处已帮您修改为您的推理接入点 ID
-        model="ep-20250306115053-vzsng",
+        model=SEGMENT_MODEL,
         messages=[
-            {"role": "system", "content": "你是十分强大的人工智能助手"},
+            {"role": "system", "content": SEGMENT_SYSTEM_PROMPT},
             {"role": "user", "content": prompt},
         ],
     )
-    result = completion.choices[0].message.content
-    # print(result)
-    return result
+    return completion.choices[0].message.content
+
+
+async def use_doubao_api_async(client, prompt, limiter: AsyncTokenBucket,
+                               max_retries: int = SEGMENT_MAX_RETRIES,
+                               base_delay: float = SEGMENT_RETRY_BASE_DELAY):
+    """
+    异步调用豆包API，失败时按指数退避加随机抖动重试
+
+    参数:
+        client: AsyncOpenAI客户端
+        prompt: 提示词
+        limiter: 令牌桶，每次请求（包括重试）都需要获取令牌
+        max_retries: 最大重试次数
+        base_delay: 首次重试前的等待时间（秒）
+
+    返回:
+        模型输出文本
+    """
+    for attempt in range(max_retries + 1):
+        await limiter.acquire()
+        try:
+            completion = await client.chat.completions.create(
+                model=SEGMENT_MODEL,
+                messages=[
+                    {"role": "system", "content": SEGMENT_SYSTEM_PROMPT},
+                    {"role": "user", "content": prompt},
+                ],
+            )
+            return completion.choices[0].message.content
+        except RETRYABLE_ERRORS as e:
+            if attempt == max_retries:
+                raise
+            delay = base_delay * (2 ** attempt) * (1 + random.random())
+            print(f"API调用失败({type(e).__name__})，{delay:.1f}秒后第{attempt + 1}次重试")
+            await asyncio.sleep(delay)
+
 
 def process_json(response_text):
     """处理API返回的JSON字符串，提value值作为列表返回"""
@@ -86,66 +127,149 @@ def return_csv_file_list(input_csv_path):
     return csv_file_list
 
 
-def semantic_segment(api_key, input_csv_path, output_csv_path):
+def row_hash(row):
+    """行内容的摘要，用于确认断点记录与输入行一致"""
+    return hashlib.md5(json.dumps(row, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def load_checkpoint(checkpoint_file):
+    """
+    读取断点文件
+
+    返回:
+        {行号: (行摘要, 分块列表)}
+    """
+    done = {}
+    if not os.path.exists(checkpoint_file):
+        return done
+    with open(checkpoint_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 中断时写了一半的最后一行
+                continue
+            done[record["row"]] = (record["hash"], record["segments"])
+    return done
+
+
+async def segment_file(client, csv_file, output_file, semaphore, limiter, overwrite=False):
+    """
+    对单个CSV文件做语义分块
+
+    每完成一行就追加写入断点文件，全部行完成后按输入顺序写出结果并删除断点文件；
+    有行最终失败时保留原文输出，同时保留断点文件，下次运行只重试失败的行
 
-    # 读取CSV文件
+    返回:
+        失败的行数
+    """
+    file_name = os.path.basename(csv_file)
+    checkpoint_file = os.path.join(os.path.dirname(output_file), CHECKPOINT_DIR_NAME, file_name + ".jsonl")
+    if os.path.exists(output_file) and not os.path.exists(checkpoint_file) and not overwrite:
+        print(f"已存在输出文件，跳过: {output_file}")
+        return 0
+
+    rows = read_csv_rows(csv_file)
+    print("{}读取到{}行数据".format(file_name, len(rows)))
+
+    os.makedirs(os.path.dirname(checkpoint_file), exist_ok=True)
+    done = load_checkpoint(checkpoint_file)
+
+    # 每行对应的输出行列表，按输入顺序拼接
+    results = [None] * len(rows)
+    pending = []
+    resumed = 0
+    for i, row in enumerate(rows):
+        if not row:
+            results[i] = []
+        elif row[0] == "摘要" or len(row[-1]) < SEGMENT_MIN_LENGTH:
+            results[i] = [row]
+        elif i in done and done[i][0] == row_hash(row):
+            results[i] = [[row[0], row[1], segment] for segment in done[i][1]]
+            resumed += 1
+        else:
+            pending.append(i)
+    print(f"{file_name}: 断点中已完成{resumed}行，待分块{len(pending)}行")
+
+    failed = 0
+
+    async def segment_row(i, checkpoint):
+        nonlocal failed
+        row = rows[i]
+        prompt = semantic_segment_prompt.format(input_text=row[-1])
+        async with semaphore:
+            try:
+                response = await use_doubao_api_async(client, prompt, limiter)
+                # 返回JSON数组、值不是字符串或内容为空时解析出错，与请求出错一样保留原文
+                segments = [segment.strip() for segment in process_json(response)]
+            except Exception as e:
+                print(f"{file_name}第{i + 1}行分块失败，保留原文: {e}")
+                results[i] = [row]
+                failed += 1
+                return
+        results[i] = [[row[0], row[1], segment] for segment in segments]
+        # 单线程事件循环中整行写入不会与其他协程交错
+        checkpoint.write(json.dumps({"row": i, "hash": row_hash(row), "segments": segments},
+                                    ensure_ascii=False) + "\n")
+        checkpoint.flush()
+
+    with open(checkpoint_file, 'a', encoding='utf-8') as checkpoint:
+        await asyncio.gather(*(segment_row(i, checkpoint) for i in pending))
+
+    # 写入新的CSV文件，先写临时文件再替换
+    tmp_file = output_file + ".tmp"
+    with open(tmp_file, 'w', newline='', encoding='utf-8') as csvfile:
+        csv_writer = csv.writer(csvfile)
+        csv_writer.writerow(['章节标题', '子标题', '内容'])
+        for new_rows in results:
+            csv_writer.writerows(new_rows)
+    os.replace(tmp_file, output_file)
+
+    if failed:
+        print(f"{file_name}有{failed}行分块失败，已保留原文，重新运行将只重试这些行")
+    else:
+        os.remove(checkpoint_file)
+    print(f"完成文件处理，已写入新文件: {output_file}")
+    return failed
+
+
+async def semantic_segment_async(api_key, input_csv_path, output_csv_path,
+                                 concurrency=SEGMENT_CONCURRENCY, rate=SEGMENT_RATE_LIMIT,
+                                 burst=SEGMENT_RATE_BURST, overwrite=False):
+    """
+    异步语义分块，所有文件共享同一个并发上限和令牌桶
+
+    参数:
+        api_key: 豆包API密钥
+        input_csv_path: 输入CSV目录
+        output_csv_path: 输出CSV目录，保持与输入相同的文件名
+        concurrency: 同时进行的请求数
+        rate: 每秒最多发起的请求数
+        burst: 令牌桶容量
+        overwrite: 是否重新处理已有输出且没有断点的文件
+    """
     csv_file_list = return_csv_file_list(input_csv_path)
     print("一共有{}份csv文件".format(len(csv_file_list)))
 
-    # 添加API调用计数器
-    api_call_count = 0
-
-    for csv_file in csv_file_list:
-        file_name = os.path.basename(csv_file)
-        output_file = os.path.join(output_csv_path, file_name)
-        print("正在处理文件：{}".format(file_name))
-
-        # 确保输出目录存在
-        os.makedirs(os.path.dirname(output_file), exist_ok=True)
-
-        rows = read_csv_rows(csv_file)
-        print("读取到{}行数据".format(len(rows)))
-
-        # 存储新行数据
-        new_rows = []
-
-        for row in rows:
-            if row[0] == "摘要":
-                new_rows.append(row)
-            if len(row[-1]) >= 500:
-                print("当前行的内容长度为{}，大于500，可进行语义分块".format(len(row[-1])))
-
-                # API调用频率限制：每10次调用暂停2秒
-                api_call_count += 1
-                if api_call_count % 10 == 0:
-                    print("已完成10次API调用，暂停2秒...")
-                    time.sleep(2)
-
-                # 调用API进行语义分块
-                prompt = semantic_segment_prompt.format(input_text=row[-1])
-                print(prompt)
-                response = use_doubao_api(api_key, prompt)
-
-                # 处理API返回的JSON数据
-                result = process_json(response)
-
-                for segment in result:
-                    segment = segment.strip()
-                    new_rows.append([row[0], row[1], segment])
-
-            else:
-                print("当前行的内容长度为{}，小于500，不进行语义分块".format(len(row[-1])))
-                new_rows.append(row)
-
-        # 写入新的CSV文件
-        with open(output_file, 'w', newline='', encoding='utf-8') as csvfile:
-            csv_writer = csv.writer(csvfile)
-            # 写入标题行
-            csv_writer.writerow(['章节标题', '子标题', '内容'])
-            # 写入数据行
-            csv_writer.writerows(new_rows)
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = AsyncTokenBucket(rate, burst)
+    client = create_async_openai_client(DOUBAO_API_URL, api_key, max_connections=concurrency)
+    try:
+        failed = await asyncio.gather(*(
+            segment_file(client, csv_file, os.path.join(output_csv_path, os.path.basename(csv_file)),
+                         semaphore, limiter, overwrite)
+            for csv_file in csv_file_list
+        ))
+    finally:
+        await client.close()
+
+    print(f"全部文件处理完成，失败{sum(failed)}行")
+
 
-        print(f"完成文件处理，已写入新文件: {output_file}")
+def semantic_segment(api_key, input_csv_path, output_csv_path, **kwargs):
+    """语义分块入口，参数见semantic_segment_async"""
+    os.makedirs(output_csv_path, exist_ok=True)
+    asyncio.run(semantic_segment_async(api_key, input_csv_path, output_csv_path, **kwargs))
 
 
 if __name__ == "__main__":
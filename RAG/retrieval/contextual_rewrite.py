@@ -5,27 +5,49 @@
 # @Description: 双层检索知识库查询
 
 import os
+import re
 import json
 import pickle
+import copy
+import hashlib
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import faiss
 import time
-from typing import List, Dict, Any
-import concurrent.futures
-from openai import OpenAI
-from xinference.client import Client
+from typing import List, Dict, Any, Optional
 
 from Prompt.prompt_templates import query_rewrite_prompt
 from scripts.use_doubao_api import use_doubao_api_custom
+from RAG.clients import get_embedding_client
+from RAG.retrieval.kb_registry import KnowledgeBaseRegistry
+from RAG.retrieval.semantic_cache import SemanticCache
+from RAG.retrieval.rerank_service import rerank_service
+from RAG.retrieval.fusion import rank_documents, planned_rerank_mode
+from RAG.index_factory import apply_search_params, load_rescore_vectors, RescoringIndex
+from RAG.doc_store import DocStore, InMemoryDocStore
+from RAG.bm25 import BM25Index
+from RAG.cache import TTLCache, SQLiteCache
 from config import (DOUBAO_API_KEY,SUB_QUERY_TOP_K,SUB_QUERY_TOP_P,
                     DOUBAO_MODEL,KEY_QUERY_TOP_K,KEY_QUERY_TOP_P,
-                    EMBEDDING_API_URL,FINAL_DOCS_TOP_K,RERANKER_API_URL,
-                    EMBEDDING_MODEL_UID,KNOWLEDGE_BASE_ROOT,RERANKER_MODEL_UID
+                    FINAL_DOCS_TOP_K,EMBEDDING_MODEL_UID,KNOWLEDGE_BASE_ROOT,
+                    KB_CACHE_MAX_BYTES,EMBEDDING_DIMENSION,
+                    REWRITE_CACHE_SIZE,REWRITE_CACHE_TTL,REWRITE_CACHE_PATH,
+                    SEMANTIC_CACHE_ENABLED,SEMANTIC_CACHE_THRESHOLD,
+                    SEMANTIC_CACHE_SIZE,SEMANTIC_CACHE_TTL,
+                    RETRIEVAL_PIPELINED,RETRIEVAL_PIPELINE_WORKERS,RERANK_MODE,
+                    SUB_QUERY_OVERFETCH,BM25_TOP_K,CONTENT_QUERY_TOP_K,CONTENT_QUERY_TOP_P,
+                    FEDERATED_ALL_KB_NAME,INDEX_MMAP
                     )
 
 
-def rewrite_query(query: str) -> str:
+def rewrite_query(query: str) -> Optional[Dict[str, Any]]:
+    """
+    调用大模型重写查询并解析结果
 
+    返回:
+        解析后的查询重写结果，API出错或返回内容无法解析时返回None
+    """
     try:
         prompt = query_rewrite_prompt.format(input_text=query)
         response = use_doubao_api_custom(
@@ -33,332 +55,688 @@ def rewrite_query(query: str) -> str:
             model=DOUBAO_MODEL,
             prompt=prompt
         )
-
-        return response
-
     except Exception as e:
         print(f"查询重写API调用出错: {e}")
-        # 出错时返回简单格式，仍确保后续流程能继续
-        return json.dumps({
-            "原始查询": query,
-            "子查询序列": [query],
-            "关键查询": query
-        }, ensure_ascii=False)
+        return None
+
+    rewritten_query = process_json_response(response)
+    if rewritten_query is None:
+        print(f"查询重写结果解析失败，原始响应: {str(response)[:200]}...")
+        return None
+    return normalize_rewritten_query(rewritten_query, query)
+
+
+def default_rewritten_query(query: str) -> Dict[str, Any]:
+    """查询重写失败时使用的默认结果，直接用原始查询检索；带"重写失败"标记，见rewrite_failed"""
+    return {
+        "原始查询": query,
+        "子查询序列": [query],
+        "关键查询": query,
+        "是否检索": True,
+        "重写失败": True
+    }
+
 
+def rewrite_failed(rewritten_query: Dict[str, Any]) -> bool:
+    """查询重写结果是否为失败后的默认结果，基于它的检索结果不写入语义缓存"""
+    return bool(rewritten_query.get("重写失败"))
 
-def process_json_response(json_str: str, max_retries=1, retry_callback=None) -> Dict[str, Any]:
+
+def normalize_rewritten_query(rewritten_query: Dict[str, Any], query: str) -> Dict[str, Any]:
+    """
+    规范查询重写结果的字段类型
+
+    大模型常把子查询序列输出为单个字符串或null：字符串包装为列表，null视为空列表，去掉非字符串和空白项，
+    最终为空时使用原始查询；关键查询不是非空字符串时使用原始查询
+    """
+    sub_queries = rewritten_query.get("子查询序列")
+    if isinstance(sub_queries, str):
+        sub_queries = [sub_queries]
+    elif not isinstance(sub_queries, list):
+        sub_queries = []
+    sub_queries = [item.strip() for item in sub_queries if isinstance(item, str) and item.strip()]
+    rewritten_query["子查询序列"] = sub_queries or [query]
+
+    key_query = rewritten_query.get("关键查询")
+    rewritten_query["关键查询"] = key_query.strip() if isinstance(key_query, str) and key_query.strip() else query
+    return rewritten_query
+
+
+def process_json_response(json_str: str) -> Optional[Dict[str, Any]]:
     """
     处理API返回的JSON结果，提取查询重写结果
 
     参数:
         json_str: API返回的响应文本
-        max_retries: 最大重试次数
-        retry_callback: 重试回调函数
 
     返回:
-        Dict: 解析后的查询重写结果
+        Dict: 解析后的查询重写结果，无法解析时返回None
     """
-    retry_count = 0
-    original_json_str = json_str
+    if not isinstance(json_str, str):
+        return None
 
-    while retry_count <= max_retries:
-        try:
-            # 处理可能的错误格式
-            json_str = json_str.replace('""', '"').strip()
-            json_str = json_str.replace('{{', '{').strip()
-            json_str = json_str.replace('}}', '}').strip()
+    # 处理可能的错误格式
+    json_str = json_str.replace('""', '"').strip()
+    json_str = json_str.replace('{{', '{').strip()
+    json_str = json_str.replace('}}', '}').strip()
 
-            # 尝试直接解析整个响应
+    # 尝试直接解析整个响应
+    try:
+        data = json.loads(json_str)
+        if isinstance(data, dict) and (
+                "原始查询" in data or "子查询序列" in data or "关键查询" in data):
+            return data
+    except json.JSONDecodeError:
+        pass
+
+    # 检查是否包含Markdown格式的JSON
+    if "```json" in json_str and "```" in json_str:
+        start = json_str.find("```json") + len("```json")
+        end = json_str.find("```", start)
+        if start != -1 and end > start:
+            json_content = json_str[start:end].strip()
             try:
-                data = json.loads(json_str)
-                if isinstance(data, dict) and (
-                        "原始查询" in data or "子查询序列" in data or "关键查询" in data):
+                data = json.loads(json_content)
+                if isinstance(data, dict):
                     return data
             except json.JSONDecodeError:
                 pass
 
-            # 检查是否包含Markdown格式的JSON
-            if "```json" in json_str and "```" in json_str:
-                start = json_str.find("```json") + len("```json")
-                end = json_str.find("```", start)
-                if start != -1 and end > start:
-                    json_content = json_str[start:end].strip()
-                    try:
-                        data = json.loads(json_content)
-                        if isinstance(data, dict):
-                            return data
-                    except:
-                        pass
-
-            # 尝试查找JSON对象部分
-            if '{' in json_str and '}' in json_str:
-                start = json_str.find('{')
-                end = json_str.rfind('}') + 1
-                if start != -1 and end > start:
-                    json_content = json_str[start:end]
-                    try:
-                        data = json.loads(json_content)
-                        if isinstance(data, dict):
-                            return data
-                    except:
-                        pass
-
-            # 所有解析尝试失败，如果有回调函数则重试
-            if retry_callback and retry_count < max_retries:
-                print(f"JSON解析失败，尝试重新请求 (尝试 {retry_count + 1}/{max_retries})")
-                retry_count += 1
-                json_str = retry_callback()  # 获取新的响应
-                continue
-            else:
-                # 解析失败时构造默认格式
-                print(f"JSON解析失败，返回默认格式")
-                return {
-                    "原始查询": original_json_str,
-                    "子查询序列": [original_json_str],
-                    "关键查询": original_json_str,
-                    "是否检索": True
-                }
-
-        except Exception as e:
-            if retry_callback and retry_count < max_retries:
-                print(f"处理失败({e})，尝试重新请求 (尝试 {retry_count + 1}/{max_retries})")
-                retry_count += 1
-                json_str = retry_callback()
-            else:
-                print(f"JSON解析最终失败: {e}")
-                print(f"原始响应: {original_json_str[:200]}...")
-                return {
-                    "原始查询": original_json_str,
-                    "子查询序列": [original_json_str],
-                    "关键查询": original_json_str,
-                    "是否检索": True
-                }
-
-    # 超过最大重试次数
-    return {
-        "原始查询": original_json_str,
-        "子查询序列": [original_json_str],
-        "关键查询": original_json_str,
-        "是否检索": True
-    }
+    # 尝试查找JSON对象部分
+    if '{' in json_str and '}' in json_str:
+        start = json_str.find('{')
+        end = json_str.rfind('}') + 1
+        if start != -1 and end > start:
+            json_content = json_str[start:end]
+            try:
+                data = json.loads(json_content)
+                if isinstance(data, dict):
+                    return data
+            except json.JSONDecodeError:
+                pass
 
+    return None
+
+
+# 查询重写结果缓存：进程内LRU，可选SQLite供多个工作进程共享
+rewrite_cache = TTLCache(REWRITE_CACHE_SIZE, REWRITE_CACHE_TTL)
+_rewrite_store = SQLiteCache(REWRITE_CACHE_PATH, table="query_rewrite") if REWRITE_CACHE_PATH else None
+
+
+def normalize_query(query: str) -> str:
+    """归一化查询文本作为缓存键：全半角统一、去首尾空白和句末标点、合并空白、英文小写"""
+    text = unicodedata.normalize("NFKC", query).strip().lower()
+    text = re.sub(r"\s+", " ", text)
+    return text.rstrip("?？。.!！~～ ")
+
+
+def get_rewritten_query(query: str) -> Dict[str, Any]:
+    """
+    获取查询重写的解析结果，相同（归一化后）的查询在有效期内直接复用
+
+    重写失败（rewrite_query返回None）时返回带失败标记的默认结果（rewrite_failed为True），且不写入缓存
+
+    参数:
+        query: 用户原始查询
+
+    返回:
+        查询重写结果的副本，调用方可以自由修改
+    """
+    key = normalize_query(query)
+    cached = rewrite_cache.get(key)
+    if cached is None and _rewrite_store is not None:
+        cached = _rewrite_store.get(hashlib.md5(key.encode('utf-8')).hexdigest(), max_age=REWRITE_CACHE_TTL)
+        if cached is not None:
+            rewrite_cache.set(key, cached)
+    if cached is not None:
+        print("查询重写命中缓存")
+        return copy.deepcopy(cached)
+
+    rewritten_query = rewrite_query(query)
+    if rewritten_query is None:
+        return default_rewritten_query(query)
+
+    rewrite_cache.set(key, rewritten_query)
+    if _rewrite_store is not None:
+        _rewrite_store.set(hashlib.md5(key.encode('utf-8')).hexdigest(), rewritten_query)
+    return copy.deepcopy(rewritten_query)
+
+
+def get_rewrite_cache_stats() -> Dict[str, Any]:
+    """返回查询重写缓存的命中统计"""
+    return rewrite_cache.stats()
+
+
+def get_embeddings(texts: List[str]) -> np.ndarray:
+    """
+    批量获取文本的嵌入向量，一次请求返回所有结果
+
+    参数:
+        texts: 文本列表
+
+    返回:
+        形状为(n, d)且已L2归一化的float32矩阵
+    """
+    if not texts:
+        return np.zeros((0, EMBEDDING_DIMENSION), dtype=np.float32)
 
-def get_embedding(text: str) -> np.ndarray:
-    """获取单个文本的嵌入向量"""
-    client = OpenAI(api_key="not empty", base_url=EMBEDDING_API_URL)
     try:
-        response = client.embeddings.create(
+        response = get_embedding_client().embeddings.create(
             model=EMBEDDING_MODEL_UID,
-            input=text
+            input=texts
         )
-        embedding = np.array(response.data[0].embedding, dtype=np.float32).reshape(1, -1)
-        faiss.normalize_L2(embedding)
-        return embedding
+        # 按index排序，保证与输入顺序一致
+        data = sorted(response.data, key=lambda item: item.index)
+        embeddings = np.array([item.embedding for item in data], dtype=np.float32)
+        faiss.normalize_L2(embeddings)
+        return embeddings
     except Exception as e:
         print(f"获取嵌入向量出错: {e}")
-        return np.zeros((1, 1024), dtype=np.float32)
-
-def load_knowledge_base(kb_name: str) -> Dict[str, Any]:
-
-    kb_dir = os.path.join(KNOWLEDGE_BASE_ROOT, kb_name)
+        return np.zeros((len(texts), EMBEDDING_DIMENSION), dtype=np.float32)
 
-    if not os.path.exists(kb_dir):
-        raise ValueError(f"知识库 '{kb_name}' 不存在")
 
-    # 加载元数据
-    with open(os.path.join(kb_dir, "metadata.pkl"), 'rb') as f:
-        metadata = pickle.load(f)
+def get_embedding(text: str) -> np.ndarray:
+    """获取单个文本的嵌入向量"""
+    return get_embeddings([text])
+
+
+def _read_knowledge_base(kb_dir: str) -> Dict[str, Any]:
+    """从磁盘读取知识库的元数据、文档存储和索引"""
+    if os.path.exists(os.path.join(kb_dir, "metadata.json")):
+        # 加载元数据，文档内容通过内存映射按需读取
+        with open(os.path.join(kb_dir, "metadata.json"), 'r', encoding='utf-8') as f:
+            metadata = json.load(f)
+        arrays = np.load(os.path.join(kb_dir, "kb_arrays.npz"))
+        metadata["tag_postings_indptr"] = arrays["tag_postings_indptr"]
+        metadata["tag_postings_indices"] = arrays["tag_postings_indices"]
+        documents = DocStore(kb_dir)
+    else:
+        # 旧格式知识库，整体反序列化
+        with open(os.path.join(kb_dir, "metadata.pkl"), 'rb') as f:
+            metadata = pickle.load(f)
+        documents = InMemoryDocStore(metadata["documents"])
 
     # 加载索引
-    summary_index = faiss.read_index(os.path.join(kb_dir, "summary_index.faiss"))
-    tag_index = faiss.read_index(os.path.join(kb_dir, "tag_index.faiss"))
+    indexes = {}
+    for name in ("summary", "tag", "content"):
+        index_path = os.path.join(kb_dir, f"{name}_index.faiss")
+        if name == "content" and not os.path.exists(index_path):
+            indexes[name] = None
+            continue
+        index = apply_search_params(faiss.read_index(index_path, faiss.IO_FLAG_MMAP if INDEX_MMAP else 0))
+        # 有损压缩索引带有原始向量文件，检索结果用原始向量重打分
+        rescore_vectors = load_rescore_vectors(kb_dir, name)
+        indexes[name] = index if rescore_vectors is None else RescoringIndex(index, rescore_vectors)
 
     return {
         "metadata": metadata,
-        "summary_index": summary_index,
-        "tag_index": tag_index
+        "documents": documents,
+        "summary_index": indexes["summary"],
+        "tag_index": indexes["tag"],
+        "content_index": indexes["content"],
+        "bm25": BM25Index.load(kb_dir)
     }
 
 
+def _close_knowledge_base(kb_data: Dict[str, Any]):
+    """释放知识库的文档存储映射，索引随对象回收释放"""
+    kb_data["documents"].close()
+
+
+# 进程内知识库缓存，所有检索函数共享
+kb_registry = KnowledgeBaseRegistry(_read_knowledge_base, KNOWLEDGE_BASE_ROOT, KB_CACHE_MAX_BYTES,
+                                    closer=_close_knowledge_base)
+
+
+def load_knowledge_base(kb_name: str) -> Dict[str, Any]:
+    """
+    加载知识库，优先使用进程内缓存
+
+    返回的数据在多次调用间共享，调用方不应修改其中的内容
+    """
+    return kb_registry.get(kb_name)
+
+
+def get_kb_cache_stats() -> Dict[str, Any]:
+    """返回知识库缓存的命中、未命中和加载耗时统计"""
+    return kb_registry.stats()
+
+
+# 流水线检索使用的线程池，重写、加载和检索都是阻塞IO或释放GIL的计算
+_pipeline_executor = ThreadPoolExecutor(max_workers=RETRIEVAL_PIPELINE_WORKERS, thread_name_prefix="retrieval")
+
+# 语义缓存：相似问题直接复用完整检索结果，知识库更新后自动失效
+semantic_cache = SemanticCache(SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_TTL, SEMANTIC_CACHE_THRESHOLD)
+
+
+def get_semantic_cache_stats() -> Dict[str, Any]:
+    """返回语义缓存的命中统计"""
+    return semantic_cache.stats()
+
+
+def get_tag_doc_scores(metadata: Dict[str, Any], matched_tags: List[tuple]) -> Dict[int, float]:
+    """
+    合并命中标签的倒排表，文档得分取其关联标签中的最高分
+
+    参数:
+        metadata: 知识库元数据
+        matched_tags: 命中的(标签ID, 得分)列表
+
+    返回:
+        {文档ID: 得分}
+    """
+    doc_scores = {}
+    for tag_idx, score in matched_tags:
+        for doc_idx in get_tag_doc_ids(metadata, [tag_idx]):
+            if score > doc_scores.get(doc_idx, float("-inf")):
+                doc_scores[doc_idx] = float(score)
+    return doc_scores
+
+
+def get_tag_doc_ids(metadata: Dict[str, Any], tag_ids: List[int]) -> set:
+    """
+    合并命中标签的倒排表，返回关联的文档ID
+
+    参数:
+        metadata: 知识库元数据
+        tag_ids: 命中的标签ID
+
+    返回:
+        文档ID集合
+    """
+    doc_ids = set()
+    if "tag_postings_indptr" in metadata:
+        indptr = metadata["tag_postings_indptr"]
+        indices = metadata["tag_postings_indices"]
+        for tag_idx in tag_ids:
+            if 0 <= tag_idx < len(indptr) - 1:
+                doc_ids.update(indices[indptr[tag_idx]:indptr[tag_idx + 1]].tolist())
+    else:
+        # 旧格式知识库：每次标签出现单独存一条映射
+        tag_to_doc_map = metadata.get("tag_to_doc_map", {})
+        for tag_idx in tag_ids:
+            doc_ids.update(tag_to_doc_map.get(int(tag_idx), []))
+    return doc_ids
+
+
+def merge_scores(*score_dicts: Dict[int, float]) -> Dict[int, float]:
+    """合并多组{文档ID: 得分}，同一文档取最高分"""
+    merged = {}
+    for scores in score_dicts:
+        for doc_idx, score in scores.items():
+            if score > merged.get(doc_idx, float("-inf")):
+                merged[doc_idx] = score
+    return merged
+
+
+def search_summaries(summary_index, documents, query_embeddings: np.ndarray,
+                     top_k: int = SUB_QUERY_TOP_K, top_p: float = SUB_QUERY_TOP_P) -> Dict[int, float]:
+    """
+    第一阶段：查询向量与文档总结的相似度检索，多个查询合并为一次批量检索
+
+    每个查询按top_p过滤后保留top_k个结果；内容索引的检索同样使用该函数
+
+    返回:
+        所有查询结果的并集 {文档ID: 最高相似度}
+    """
+    doc_scores = {}
+    if len(query_embeddings) == 0:
+        return doc_scores
+    scores, indices = summary_index.search(query_embeddings, top_k * SUB_QUERY_OVERFETCH)
+
+    for row_scores, row_indices in zip(scores, indices):
+        # 根据top_p进行过滤，每个子查询只保留top_k个结果
+        if row_scores.size == 0:
+            continue
+        threshold = row_scores[0] * top_p
+        results = [(int(doc_idx), float(score)) for score, doc_idx in zip(row_scores, row_indices)
+                   if score >= threshold and documents.is_alive(doc_idx)]
+        doc_scores = merge_scores(doc_scores, dict(results[:top_k]))
+    return doc_scores
+
+
+def search_tags(tag_index, metadata, documents, key_query_embedding: np.ndarray) -> Dict[int, float]:
+    """第二阶段：关键查询与标签的相似度检索，返回命中标签关联的文档 {文档ID: 标签最高相似度}"""
+    matched_tags = []
+    tag_top_k = min(tag_index.ntotal, KEY_QUERY_TOP_K * 3)
+    if tag_top_k > 0:
+        tag_scores, tag_indices = tag_index.search(key_query_embedding, tag_top_k)
+
+        # 根据key_query_top_p过滤标签
+        tag_threshold = tag_scores[0][0] * KEY_QUERY_TOP_P
+        matched_tags = [(tag_idx, score) for score, tag_idx in zip(tag_scores[0], tag_indices[0])
+                        if score >= tag_threshold and tag_idx >= 0]
+
+    # 合并命中标签的倒排表
+    return {doc_idx: score for doc_idx, score in get_tag_doc_scores(metadata, matched_tags).items()
+            if documents.is_alive(doc_idx)}
+
+
+def search_contents(kb_data: Dict[str, Any], query_embeddings: np.ndarray):
+    """
+    子查询与文档内容的相似度检索，补充只出现在内容中、总结里没有的细节
+
+    返回:
+        {文档ID: 最高相似度}，知识库没有内容索引时返回None
+    """
+    content_index = kb_data.get("content_index")
+    if content_index is None:
+        return None
+    return search_summaries(content_index, kb_data["documents"], query_embeddings,
+                            CONTENT_QUERY_TOP_K, CONTENT_QUERY_TOP_P)
+
+
+def search_bm25(kb_data: Dict[str, Any], query: str):
+    """
+    用原始查询做BM25检索，补充向量检索不擅长的精确词匹配（型号、版本号等）
+
+    返回:
+        {文档ID: BM25得分}，知识库没有BM25索引时返回None
+    """
+    bm25 = kb_data.get("bm25")
+    if bm25 is None:
+        return None
+    documents = kb_data["documents"]
+    bm25_scores = {doc_idx: score for doc_idx, score in bm25.search(query, BM25_TOP_K).items()
+                   if documents.is_alive(doc_idx)}
+    print(f"BM25检索完成，找到{len(bm25_scores)}个候选文档")
+    return bm25_scores
+
+
+def embed_rewritten_queries(sub_queries: List[str], key_query: str,
+                            known: Dict[str, np.ndarray] = None):
+    """
+    所有子查询和关键查询一次性批量嵌入，去重后只请求一次嵌入服务
+
+    参数:
+        known: 已经生成过的 文本 -> 向量，不再重复请求
+
+    返回:
+        (子查询向量矩阵, 形状为(1, d)的关键查询向量)
+    """
+    known = known or {}
+    query_texts = list(dict.fromkeys(sub_queries + [key_query]))
+    missing = [text for text in query_texts if text not in known]
+    vectors = dict(known)
+    if missing:
+        vectors.update(zip(missing, get_embeddings(missing)))
+    sub_query_embeddings = np.array([vectors[q] for q in sub_queries], dtype=np.float32).reshape(-1, EMBEDDING_DIMENSION)
+    key_query_embedding = np.asarray(vectors[key_query], dtype=np.float32).reshape(1, -1)
+    return sub_query_embeddings, key_query_embedding
+
+
 def retrieve_from_knowledge_base(kb_name: str,
                                  query: str,
-                                 do_rerank: bool = True) -> Dict[str, Any]:
+                                 do_rerank: bool = True,
+                                 pipelined: bool = RETRIEVAL_PIPELINED,
+                                 query_embedding: np.ndarray = None,
+                                 rerank_mode: str = None) -> Dict[str, Any]:
     """
     从知识库中检索相关文档，并返回查询信息和检索结果
 
     参数:
-        kb_name: 知识库名称
+        kb_name: 知识库名称，虚拟知识库（如All）会对其成员联合检索
         query: 用户原始查询
         do_rerank: 是否进行重排序
+        pipelined: 是否流水线执行，查询重写期间并行加载知识库并用原始查询先行检索，
+                   重写返回后两个阶段并发检索，原始查询的结果一并参与合并
+        query_embedding: 已生成的原始查询向量（如检索路由中生成的），避免重复请求嵌入服务
+        rerank_mode: 排序方式，model/rrf/weighted/none，为None时do_rerank为True使用RERANK_MODE，否则为none
 
     返回:
         包含查询信息和检索结果的字典
     """
-    # 获取重写的查询
-    print(f"重写查询: {query}")
-    rewritten_query_str = rewrite_query(query)
-    rewritten_query = process_json_response(rewritten_query_str)
+    if rerank_mode is None:
+        rerank_mode = RERANK_MODE if do_rerank else "none"
+
+    members = get_kb_members(kb_name)
+    if members is not None:
+        # 虚拟知识库对成员联合检索；federated模块依赖本模块，因此在这里导入
+        from RAG.retrieval.federated import federated_retrieve
+        return federated_retrieve(members, query, rerank_mode=rerank_mode,
+                                  query_embedding=query_embedding, kb_label=kb_name)
+
+    # 先查语义缓存，命中时跳过重写、检索和重排序
+    if SEMANTIC_CACHE_ENABLED:
+        kb_signature = kb_registry.signature(kb_name)
+        if query_embedding is None:
+            query_embedding = get_embeddings([query])[0]
+    # 嵌入失败时为零向量，不参与缓存和检索
+    if query_embedding is not None and not np.any(query_embedding):
+        query_embedding = None
+    if SEMANTIC_CACHE_ENABLED and query_embedding is not None:
+        cached = semantic_cache.lookup(kb_name, kb_signature, query_embedding, rerank_mode)
+        if cached is not None:
+            print(f"命中语义缓存，相似查询: {cached['query']}（相似度{cached['similarity']:.3f}）")
+            result = cached["result"]
+            result["query_info"]["原始查询"] = query
+            result["query_info"]["相似查询"] = cached["query"]
+            return result
+
+    start_time = time.time()
+    if pipelined:
+        score_lists, rewritten_query, documents = \
+            _retrieve_pipelined(kb_name, query, query_embedding)
+    else:
+        score_lists, rewritten_query, documents = \
+            _retrieve_serial(kb_name, query, query_embedding)
+    key_query = rewritten_query.get("关键查询", query)
+    sub_queries = rewritten_query.get("子查询序列", [query])
+
+    # 查询重写判断无需检索（如闲聊）时score_lists为空，不返回文档
+    final_doc_indices = set().union(*score_lists.values())
 
+    # 准备结果文档，只物化命中的文档
+    retrieve_results = [documents.get(doc_idx) for doc_idx in final_doc_indices]
+
+    # 对结果进行排序，重排序模型不可用或超出时延预算时改用得分融合
+    if retrieve_results:
+        print(f"对检索结果进行排序（{rerank_mode}）...")
+    final_docs, used_rerank_mode = rank_documents(
+        query, retrieve_results, score_lists, rerank_mode)
+
+    print(f"检索完成，用时{time.time() - start_time:.2f}秒，返回{len(final_docs)}条结果")
+
+    # 返回包含查询信息和检索结果的字典
+    result = {
+        "query_info": {
+            "原始查询": query,
+            "关键查询": key_query,
+            "子查询序列": sub_queries,
+            "是否检索": need_retrieval(rewritten_query),
+            "排序方式": used_rerank_mode
+        },
+        "retrieved_docs": final_docs
+    }
+    # 重排序降级（超时、出错、队列已满或熔断）时的结果不写入缓存，避免重排序恢复后仍以降级结果作为该排序方式的结果
+    # 查询重写失败时的结果同样不写入缓存，避免相似查询在有效期内都使用未经重写的检索结果
+    degraded = used_rerank_mode != planned_rerank_mode(rerank_mode, len(retrieve_results)) \
+        or rewrite_failed(rewritten_query)
+    if SEMANTIC_CACHE_ENABLED and query_embedding is not None and not degraded:
+        semantic_cache.add(kb_name, kb_signature, query_embedding, result, rerank_mode)
+    return result
+
+
+def need_retrieval(rewritten_query: Dict[str, Any]) -> bool:
+    """查询重写结果中的"是否检索"，缺失时默认检索；兼容模型输出字符串的情况"""
+    flag = rewritten_query.get("是否检索", True)
+    if isinstance(flag, str):
+        return flag.strip().lower() not in ("false", "否", "no", "0")
+    return bool(flag)
+
+
+def _print_rewritten_query(rewritten_query: Dict[str, Any], query: str):
     print("查询重写结果:")
     print(f"原始查询: {rewritten_query.get('原始查询', query)}")
     print(f"子查询序列: {rewritten_query.get('子查询序列', [])}")
     print(f"关键查询: {rewritten_query.get('关键查询', '')}")
     print(f"是否检索: {rewritten_query.get('是否检索')}")
 
-    # 提取查询信息
-    original_query = query
+
+def _retrieve_serial(kb_name: str, query: str, query_embedding: np.ndarray = None):
+    """
+    依次执行查询重写、加载知识库、第一阶段和第二阶段检索
+
+    查询重写判断无需检索时不加载知识库，直接返回空的得分；
+    query_embedding为查语义缓存时生成的原始查询向量，子查询与原始查询相同时直接复用
+    """
+    # 获取重写的查询
+    print(f"重写查询: {query}")
+    rewritten_query = get_rewritten_query(query)
+    _print_rewritten_query(rewritten_query, query)
+    if not need_retrieval(rewritten_query):
+        print("查询重写判断无需检索")
+        return {}, rewritten_query, None
     key_query = rewritten_query.get("关键查询", query)
     sub_queries = rewritten_query.get("子查询序列", [query])
 
     # 加载知识库
     print(f"加载知识库: {kb_name}")
     kb_data = load_knowledge_base(kb_name)
-    metadata = kb_data["metadata"]
-    summary_index = kb_data["summary_index"]
-    tag_index = kb_data["tag_index"]
-    documents = metadata["documents"]
-    all_tags = metadata["all_tags"]
-    tag_to_doc_map = metadata["tag_to_doc_map"]
-
-    # 开始双层检索
-    start_time = time.time()
+    documents = kb_data["documents"]
 
-    # 第一阶段: 基于子查询与摘要的相似度
-    first_stage_results = set()
-    sub_queries = rewritten_query.get("子查询序列", [query])
+    known = {query: query_embedding} if query_embedding is not None else None
+    sub_query_embeddings, key_query_embedding = embed_rewritten_queries(sub_queries, key_query, known=known)
+    score_lists = search_knowledge_base(kb_data, query, sub_query_embeddings, key_query_embedding)
+    return score_lists, rewritten_query, documents
 
-    def process_sub_query(sub_query, top_k):
-        # 对单个子查询进行嵌入和检索
-        sub_query_embedding = get_embedding(sub_query)
-        scores, indices = summary_index.search(sub_query_embedding, top_k * 2)
 
-        # 根据top_p进行过滤
-        results = []
-        if scores[0].size > 0:
-            max_score = scores[0][0]
-            threshold = max_score * SUB_QUERY_TOP_P
+def search_knowledge_base(kb_data: Dict[str, Any], query: str, sub_query_embeddings: np.ndarray,
+                          key_query_embedding: np.ndarray) -> Dict[str, Dict[int, float]]:
+    """
+    在单个知识库中执行所有检索阶段
 
-            for score, doc_idx in zip(scores[0], indices[0]):
-                if score >= threshold and doc_idx < len(documents):
-                    results.append((doc_idx, score))
+    返回:
+        各路召回的得分 {来源: {文档ID: 得分}}，来源包括summary、tag，以及知识库具备相应索引时的content、bm25
+    """
+    documents = kb_data["documents"]
+    summary_scores = search_summaries(kb_data["summary_index"], documents, sub_query_embeddings)
+    print(f"第一阶段检索完成，找到{len(summary_scores)}个候选文档")
 
-        # 只返回top_k个结果
-        return results[:top_k]
+    tag_scores = search_tags(kb_data["tag_index"], kb_data["metadata"], documents, key_query_embedding)
+    print(f"第二阶段检索完成，找到{len(tag_scores)}个标签匹配的文档")
 
-    # 并行处理每个子查询
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = [executor.submit(process_sub_query, query, SUB_QUERY_TOP_K)
-                   for query in sub_queries]
+    score_lists = {"summary": summary_scores, "tag": tag_scores}
+    content_scores = search_contents(kb_data, sub_query_embeddings)
+    if content_scores is not None:
+        score_lists["content"] = content_scores
+        print(f"内容检索完成，找到{len(content_scores)}个候选文档")
+    bm25_scores = search_bm25(kb_data, query)
+    if bm25_scores is not None:
+        score_lists["bm25"] = bm25_scores
+    return score_lists
 
-        for future in concurrent.futures.as_completed(futures):
-            for doc_idx, score in future.result():
-                first_stage_results.add(doc_idx)
 
-    print(f"第一阶段检索完成，找到{len(first_stage_results)}个候选文档")
+def _retrieve_pipelined(kb_name: str, query: str, query_embedding: np.ndarray = None):
+    """
+    流水线检索
 
-    # 第二阶段: 基于关键查询与标签的相似度
+    查询重写（远程大模型）在后台执行，同时加载知识库并用原始查询检索总结；
+    重写返回后第一阶段和第二阶段并发检索（faiss检索时释放GIL）。
+    总耗时约为 max(重写, 加载+原始查询检索) + 两阶段中较慢者；
+    重写判断无需检索时跳过两阶段检索，返回空的得分
+    """
+    print(f"重写查询: {query}（流水线模式）")
+    rewrite_future = _pipeline_executor.submit(get_rewritten_query, query)
+    kb_future = _pipeline_executor.submit(load_knowledge_base, kb_name)
+
+    if query_embedding is None:
+        query_embedding = get_embeddings([query])[0]
+    kb_data = kb_future.result()
+    documents = kb_data["documents"]
+    raw_query_results = {}
+    if np.any(query_embedding):
+        raw_query_results = search_summaries(kb_data["summary_index"], documents, query_embedding.reshape(1, -1))
+    print(f"原始查询检索完成，找到{len(raw_query_results)}个候选文档")
+    # 原始查询的BM25检索同样不依赖重写结果
+    bm25_scores = search_bm25(kb_data, query)
+
+    rewritten_query = rewrite_future.result()
+    _print_rewritten_query(rewritten_query, query)
+    if not need_retrieval(rewritten_query):
+        print("查询重写判断无需检索")
+        return {}, rewritten_query, documents
     key_query = rewritten_query.get("关键查询", query)
-    key_query_embedding = get_embedding(key_query)
-
-    # 对标签进行搜索
-    tag_scores, tag_indices = tag_index.search(key_query_embedding,
-                                               min(len(all_tags), KEY_QUERY_TOP_K * 3))
-
-    # 根据key_query_top_p过滤标签
-    relevant_docs_from_tags = set()
-    if tag_scores[0].size > 0:
-        max_tag_score = tag_scores[0][0]
-        tag_threshold = max_tag_score * KEY_QUERY_TOP_P
-
-        for score, tag_idx in zip(tag_scores[0], tag_indices[0]):
-            if score >= tag_threshold and tag_idx < len(all_tags):
-                # 如果标签存在于映射中，添加关联文档
-                if tag_idx in tag_to_doc_map:
-                    relevant_docs_from_tags.update(tag_to_doc_map[tag_idx])
-
-    print(f"第二阶段检索完成，找到{len(relevant_docs_from_tags)}个标签匹配的文档")
-
-    # 取两个阶段的并集，并去重
-    final_doc_indices = first_stage_results.union(relevant_docs_from_tags)
-
-    # 准备结果文档
-    retrieve_results = []
-    for doc_idx in list(final_doc_indices):
-        if doc_idx < len(documents):
-            doc = documents[doc_idx].copy()
-            retrieve_results.append(doc)
-
-    # 对结果进行重排序
-    if do_rerank and retrieve_results:
-        print("对检索结果进行重排序...")
-        final_docs = reranker(query, retrieve_results)
-        # 限制返回数量
-        final_docs = final_docs[:FINAL_DOCS_TOP_K]
-    else:
-        # 如果不进行重排序，直接限制返回数量
-        final_docs = retrieve_results[:FINAL_DOCS_TOP_K]
+    sub_queries = rewritten_query.get("子查询序列", [query])
 
-    print(f"检索完成，用时{time.time() - start_time:.2f}秒，返回{len(final_docs)}条结果")
+    sub_query_embeddings, key_query_embedding = embed_rewritten_queries(
+        sub_queries, key_query, known={query: query_embedding})
 
-    # 返回包含查询信息和检索结果的字典
-    return {
-        "query_info": {
-            "原始查询": original_query,
-            "关键查询": key_query,
-            "子查询序列": sub_queries
-        },
-        "retrieved_docs": final_docs
-    }
+    summary_future = _pipeline_executor.submit(
+        search_summaries, kb_data["summary_index"], documents, sub_query_embeddings)
+    tag_future = _pipeline_executor.submit(
+        search_tags, kb_data["tag_index"], kb_data["metadata"], documents, key_query_embedding)
+    content_future = _pipeline_executor.submit(search_contents, kb_data, sub_query_embeddings)
+    summary_scores = merge_scores(summary_future.result(), raw_query_results)
+    tag_scores = tag_future.result()
+    print(f"第一阶段检索完成，找到{len(summary_scores)}个候选文档")
+    print(f"第二阶段检索完成，找到{len(tag_scores)}个标签匹配的文档")
 
+    score_lists = {"summary": summary_scores, "tag": tag_scores}
+    content_scores = content_future.result()
+    if content_scores is not None:
+        score_lists["content"] = content_scores
+        print(f"内容检索完成，找到{len(content_scores)}个候选文档")
+    if bm25_scores is not None:
+        score_lists["bm25"] = bm25_scores
+    return score_lists, rewritten_query, documents
+
+
+# (文件签名, 映射)，签名与kb_registry一样取修改时间和大小
+_kb_mapping_cache = (None, {})
 
-def list_knowledge_bases() -> List[str]:
 
+def get_kb_mapping() -> Dict[str, Any]:
+    """
+    读取知识库映射文件
+
+    每次检索都会调用，映射按文件的修改时间和大小缓存，文件未变化时只做一次stat；
+    返回的字典是共享的，调用方不要修改
+    """
+    global _kb_mapping_cache
     kb_mapping_path = os.path.join(KNOWLEDGE_BASE_ROOT, "kb_mapping.json")
 
-    if not os.path.exists(kb_mapping_path):
-        return []
+    try:
+        stat = os.stat(kb_mapping_path)
+    except FileNotFoundError:
+        return {}
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached_signature, kb_mapping = _kb_mapping_cache
+    if cached_signature == signature:
+        return kb_mapping
 
     with open(kb_mapping_path, 'r', encoding='utf-8') as f:
         kb_mapping = json.load(f)
+    _kb_mapping_cache = (signature, kb_mapping)
+    return kb_mapping
 
-    return list(kb_mapping.keys())
 
+def list_knowledge_bases() -> List[str]:
+    return list(get_kb_mapping().keys())
 
-def reranker(query: str, documents: List[Dict[str, Any]]
-            ) -> List[Dict[str, Any]]:
-    if not documents:
-        return []
 
-    try:
-        # 连接到重排序服务
-        client = Client(RERANKER_API_URL)
-        model = client.get_model(RERANKER_MODEL_UID)
-
-        # 准备语料库，提取文档的摘要或内容
-        corpus = [doc.get('内容', '')  for doc in documents]
-        # 调用重排序模型
-        rerank_result = model.rerank(corpus, query)
-
-        # 处理重排序结果
-        if 'results' not in rerank_result:
-            print("重排序结果格式不正确")
-            return documents
-
-        # 根据相关性得分重新排序文档
-        reranked_docs = []
-        for item in sorted(rerank_result['results'], key=lambda x: x['relevance_score'], reverse=True):
-            idx = item['index']
-            if 0 <= idx < len(documents):
-                # 将相关性得分添加到文档中
-                doc = documents[idx].copy()
-                doc['relevance_score'] = item['relevance_score']
-                reranked_docs.append(doc)
-
-        return reranked_docs
+def get_kb_members(kb_name: str):
+    """
+    虚拟知识库的成员
 
-    except Exception as e:
-        print(f"重排序过程出错: {e}")
-        return documents  # 出错时返回原始文档列表
+    映射中带members的条目为虚拟知识库，检索时对成员联合检索；
+    FEDERATED_ALL_KB_NAME在没有对应目录时表示所有实体知识库
+
+    返回:
+        成员知识库名称列表，kb_name是实体知识库时返回None
+    """
+    kb_mapping = get_kb_mapping()
+    entry = kb_mapping.get(kb_name) or {}
+    if entry.get("members"):
+        return list(entry["members"])
+    if kb_name == FEDERATED_ALL_KB_NAME and not os.path.isdir(kb_registry.kb_dir(kb_name)):
+        return [name for name, item in kb_mapping.items() if not item.get("members")]
+    return None
+
+
+def get_rerank_cache_stats() -> Dict[str, Any]:
+    """返回重排序得分缓存的命中统计"""
+    return rerank_service.stats()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,151 @@
+# coding:utf-8
+# @File  : federated.py
+# @Author: ganchun
+# @Date  :  2025/06/25
+# @Description: 多知识库联合检索，查询只重写、嵌入一次，各知识库并发检索后合并排序
+
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+
+from RAG.retrieval.contextual_rewrite import (get_rewritten_query, get_embeddings, embed_rewritten_queries,
+                                              load_knowledge_base, search_knowledge_base, need_retrieval,
+                                              rewrite_failed, _print_rewritten_query, kb_registry, semantic_cache,
+                                              _pipeline_executor)
+from RAG.retrieval.fusion import rank_documents, reciprocal_rank_fusion, planned_rerank_mode
+from config import RERANK_MODE, SEMANTIC_CACHE_ENABLED, FUSION_WEIGHTS, FEDERATED_MAX_CANDIDATES
+
+# 各知识库的BM25词频统计不同，得分不可直接比较，按知识库内最高分归一化；
+# 向量检索得分为同一嵌入模型下的余弦相似度，保持原值
+PER_KB_NORMALIZED_SOURCES = ("bm25",)
+
+
+def merge_kb_scores(kb_score_lists: Dict[str, Dict[str, Dict[int, float]]]) -> Dict[str, Dict[tuple, float]]:
+    """
+    合并各知识库的召回得分
+
+    参数:
+        kb_score_lists: {知识库: {来源: {文档ID: 得分}}}
+
+    返回:
+        {来源: {(知识库, 文档ID): 得分}}
+    """
+    merged = {}
+    for kb_name, score_lists in kb_score_lists.items():
+        for source, scores in score_lists.items():
+            if not scores:
+                merged.setdefault(source, {})
+                continue
+            scale = 1.0
+            if source in PER_KB_NORMALIZED_SOURCES:
+                high = max(scores.values())
+                scale = 1.0 / high if high > 0 else 1.0
+            target = merged.setdefault(source, {})
+            for doc_id, score in scores.items():
+                target[(kb_name, doc_id)] = score * scale
+    return merged
+
+
+def federated_retrieve(kb_names: List[str], query: str, do_rerank: bool = True,
+                       rerank_mode: str = None, query_embedding: np.ndarray = None,
+                       kb_label: str = None) -> Dict[str, Any]:
+    """
+    在多个知识库中联合检索，返回格式与retrieve_from_knowledge_base一致
+
+    查询重写与知识库加载并行，各知识库的检索并发执行；知识库通过kb_registry加载，与单库检索共用缓存。
+    合并后的候选超过FEDERATED_MAX_CANDIDATES时先按rrf融合截断，再统一排序。
+    返回的文档带kb_name字段
+
+    参数:
+        kb_names: 参与检索的知识库名称
+        query: 用户原始查询
+        do_rerank: 是否进行重排序
+        rerank_mode: 排序方式，为None时do_rerank为True使用RERANK_MODE，否则为none
+        query_embedding: 已生成的原始查询向量
+        kb_label: 语义缓存中使用的名称（如虚拟知识库名称），为None时由kb_names拼接
+
+    返回:
+        包含查询信息和检索结果的字典，query_info中的"知识库"为参与检索的知识库列表
+    """
+    if not kb_names:
+        raise ValueError("联合检索至少需要一个知识库")
+    if rerank_mode is None:
+        rerank_mode = RERANK_MODE if do_rerank else "none"
+    kb_names = list(dict.fromkeys(kb_names))
+    kb_label = kb_label or "+".join(sorted(kb_names))
+
+    # 任一成员知识库变化都使缓存失效
+    if SEMANTIC_CACHE_ENABLED:
+        kb_signature = tuple((kb_name, kb_registry.signature(kb_name)) for kb_name in kb_names)
+        if query_embedding is None:
+            query_embedding = get_embeddings([query])[0]
+    if query_embedding is not None and not np.any(query_embedding):
+        query_embedding = None
+    if SEMANTIC_CACHE_ENABLED and query_embedding is not None:
+        cached = semantic_cache.lookup(kb_label, kb_signature, query_embedding, rerank_mode)
+        if cached is not None:
+            print(f"命中语义缓存，相似查询: {cached['query']}（相似度{cached['similarity']:.3f}）")
+            result = cached["result"]
+            result["query_info"]["原始查询"] = query
+            result["query_info"]["相似查询"] = cached["query"]
+            return result
+
+    start_time = time.time()
+    print(f"联合检索知识库: {', '.join(kb_names)}")
+    rewrite_future = _pipeline_executor.submit(get_rewritten_query, query)
+    kb_futures = {kb_name: _pipeline_executor.submit(load_knowledge_base, kb_name) for kb_name in kb_names}
+
+    rewritten_query = rewrite_future.result()
+    _print_rewritten_query(rewritten_query, query)
+    key_query = rewritten_query.get("关键查询", query)
+    sub_queries = rewritten_query.get("子查询序列", [query])
+    kb_datas = {kb_name: future.result() for kb_name, future in kb_futures.items()}
+
+    retrieve_results = []
+    score_lists = {}
+    if need_retrieval(rewritten_query):
+        known = {query: query_embedding} if query_embedding is not None else None
+        sub_query_embeddings, key_query_embedding = embed_rewritten_queries(sub_queries, key_query, known=known)
+        search_futures = {
+            kb_name: _pipeline_executor.submit(search_knowledge_base, kb_data, query,
+                                               sub_query_embeddings, key_query_embedding)
+            for kb_name, kb_data in kb_datas.items()
+        }
+        score_lists = merge_kb_scores({kb_name: future.result() for kb_name, future in search_futures.items()})
+
+        candidates = set().union(*score_lists.values())
+        if len(candidates) > FEDERATED_MAX_CANDIDATES:
+            fused = reciprocal_rank_fusion(score_lists, weights=FUSION_WEIGHTS)
+            candidates = sorted(candidates, key=lambda key: fused[key], reverse=True)[:FEDERATED_MAX_CANDIDATES]
+            print(f"合并后候选过多，按rrf融合保留前{FEDERATED_MAX_CANDIDATES}个")
+
+        for kb_name, doc_id in candidates:
+            doc = dict(kb_datas[kb_name]["documents"].get(doc_id))
+            doc["kb_name"] = kb_name
+            retrieve_results.append(doc)
+    else:
+        print("查询重写判断无需检索")
+
+    if retrieve_results:
+        print(f"对{len(retrieve_results)}个候选文档进行排序（{rerank_mode}）...")
+    final_docs, used_rerank_mode = rank_documents(query, retrieve_results, score_lists, rerank_mode)
+    print(f"联合检索完成，用时{time.time() - start_time:.2f}秒，返回{len(final_docs)}条结果")
+
+    result = {
+        "query_info": {
+            "原始查询": query,
+            "关键查询": key_query,
+            "子查询序列": sub_queries,
+            "是否检索": need_retrieval(rewritten_query),
+            "排序方式": used_rerank_mode,
+            "知识库": kb_names
+        },
+        "retrieved_docs": final_docs
+    }
+    # 排序降级或查询重写失败时不写入缓存
+    degraded = used_rerank_mode != planned_rerank_mode(rerank_mode, len(retrieve_results)) \
+        or rewrite_failed(rewritten_query)
+    if SEMANTIC_CACHE_ENABLED and query_embedding is not None and not degraded:
+        semantic_cache.add(kb_label, kb_signature, query_embedding, result, rerank_mode)
+    return result
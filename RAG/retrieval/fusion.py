@@ -0,0 +1,131 @@
+# coding:utf-8
+# @File  : fusion.py
+# @Author: ganchun
+# @Date  :  2025/06/22
+# @Description: 多路召回得分融合（RRF/加权），以及带时延预算的重排序降级
+
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Dict, Hashable, List
+
+from RAG.retrieval.rerank_service import rerank_service, RerankUnavailable
+from config import (FINAL_DOCS_TOP_K, RERANK_MODE, RERANK_LATENCY_BUDGET, RERANK_EARLY_EXIT,
+                    RRF_K, FUSION_WEIGHTS)
+
+RERANK_MODES = ("model", "rrf", "weighted", "none")
+
+
+def reciprocal_rank_fusion(score_lists: Dict[str, Dict[int, float]], k: int = RRF_K,
+                           weights: Dict[str, float] = None) -> Dict[int, float]:
+    """
+    倒数排名融合：每路召回按得分排序，文档得分为 sum(weight / (k + rank))
+
+    只依赖排名，不同来源的得分尺度不一致也可以直接融合
+    """
+    weights = weights or {}
+    fused = {}
+    for source, scores in score_lists.items():
+        weight = weights.get(source, 1.0)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        for rank, (doc_id, _) in enumerate(ranked, start=1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + weight / (k + rank)
+    return fused
+
+
+def weighted_score_fusion(score_lists: Dict[str, Dict[int, float]],
+                          weights: Dict[str, float] = None) -> Dict[int, float]:
+    """加权得分融合：每路得分min-max归一化到[0, 1]后加权求和，未被某路召回的文档该路记0分"""
+    weights = weights or {}
+    fused = {}
+    for source, scores in score_lists.items():
+        if not scores:
+            continue
+        weight = weights.get(source, 1.0)
+        low, high = min(scores.values()), max(scores.values())
+        span = high - low
+        for doc_id, score in scores.items():
+            normalized = (score - low) / span if span > 0 else 1.0
+            fused[doc_id] = fused.get(doc_id, 0.0) + weight * normalized
+    return fused
+
+
+def doc_key(doc: Dict[str, Any]) -> Hashable:
+    """文档在得分表中的键：单知识库为doc_id，联合检索时为(知识库, doc_id)"""
+    if "kb_name" in doc:
+        return doc["kb_name"], doc.get("doc_id")
+    return doc.get("doc_id")
+
+
+def fuse_documents(documents: List[Dict[str, Any]], score_lists: Dict[str, Dict[Hashable, float]],
+                   mode: str = "rrf") -> List[Dict[str, Any]]:
+    """按融合得分对文档排序，结果带fusion_score字段；得分表的键见doc_key"""
+    if mode == "weighted":
+        fused = weighted_score_fusion(score_lists, FUSION_WEIGHTS)
+    else:
+        fused = reciprocal_rank_fusion(score_lists, weights=FUSION_WEIGHTS)
+    fused_docs = []
+    for doc in documents:
+        doc = doc.copy()
+        doc['fusion_score'] = fused.get(doc_key(doc), 0.0)
+        fused_docs.append(doc)
+    fused_docs.sort(key=lambda doc: doc['fusion_score'], reverse=True)
+    return fused_docs
+
+
+def planned_rerank_mode(rerank_mode: str, num_documents: int, top_k: int = FINAL_DOCS_TOP_K) -> str:
+    """
+    重排序模型正常时rank_documents实际使用的排序方式
+
+    没有候选时为none，model模式下候选数不超过top_k且开启RERANK_EARLY_EXIT时为rrf；
+    rank_documents返回的排序方式与之不同说明发生了降级
+    """
+    if not num_documents or rerank_mode == "none":
+        return "none"
+    if rerank_mode == "model" and RERANK_EARLY_EXIT and num_documents <= top_k:
+        return "rrf"
+    return rerank_mode
+
+
+def rank_documents(query: str, documents: List[Dict[str, Any]],
+                   score_lists: Dict[str, Dict[int, float]],
+                   rerank_mode: str = RERANK_MODE,
+                   latency_budget: float = RERANK_LATENCY_BUDGET,
+                   top_k: int = FINAL_DOCS_TOP_K):
+    """
+    对候选文档排序并截取top_k
+
+    参数:
+        query: 用户查询
+        documents: 候选文档，需带doc_id
+        score_lists: 各路召回的得分 {来源: {文档ID: 得分}}，如summary、tag、bm25
+        rerank_mode: model使用重排序模型，rrf/weighted使用得分融合，none保持原顺序；
+                     model模式下候选数不超过top_k且开启RERANK_EARLY_EXIT时直接使用rrf
+        latency_budget: 重排序模型的时延预算（秒），超时、出错、排队已满或熔断时自动改用rrf融合，为None时不限时
+        top_k: 返回数量
+
+    返回:
+        (排序后的文档, 实际使用的排序方式)
+    """
+    if rerank_mode not in RERANK_MODES:
+        raise ValueError(f"不支持的排序方式: {rerank_mode}，可选: {', '.join(RERANK_MODES)}")
+    # 全部候选都会返回时用融合得分排序即可，不必调用重排序模型
+    rerank_mode = planned_rerank_mode(rerank_mode, len(documents), top_k)
+    if rerank_mode == "none":
+        return documents[:top_k], "none"
+
+    if rerank_mode == "model":
+        start_time = time.time()
+        try:
+            reranked = rerank_service.rerank_with_budget(query, documents, latency_budget)
+            return reranked[:top_k], "model"
+        except FutureTimeoutError:
+            # 超时的请求已取消，不再占用重排序线程
+            print(f"重排序超过时延预算{latency_budget}秒，改用rrf融合排序")
+        except RerankUnavailable as e:
+            print(f"{e}，改用rrf融合排序")
+        except Exception as e:
+            print(f"重排序过程出错({e})，改用rrf融合排序")
+        rerank_mode = "rrf"
+        print(f"重排序等待用时{time.time() - start_time:.2f}秒")
+
+    return fuse_documents(documents, score_lists, rerank_mode)[:top_k], rerank_mode
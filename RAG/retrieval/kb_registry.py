@@ -0,0 +1,179 @@
+# coding:utf-8
+# @File  : kb_registry.py
+# @Author: ganchun
+# @Date  :  2025/06/10
+# @Description: 进程内知识库缓存，LRU淘汰 + 内存预算 + 文件修改时间失效
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# 只通过内存映射按需读取少量行的文件（重打分用的原始向量），不计入缓存内存预算
+MMAP_ONLY_SUFFIXES = ("_vectors.npy",)
+# 淘汰或重新加载后延迟关闭旧数据的秒数，等待仍在使用旧数据的检索结束
+CLOSE_DELAY = 60
+
+
+def kb_signature(kb_dir: str) -> Tuple[Tuple[str, int, int], ...]:
+    """
+    计算知识库目录的文件签名
+
+    返回:
+        由(文件名, 修改时间, 文件大小)组成的有序元组，任何文件变化都会改变签名；
+        子目录（如文档存储的版本目录）中的文件名为"子目录/文件名"
+    """
+    signature = []
+    with os.scandir(kb_dir) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                signature.append((entry.name, stat.st_mtime_ns, stat.st_size))
+            elif entry.is_dir():
+                with os.scandir(entry.path) as sub_entries:
+                    for sub_entry in sub_entries:
+                        if sub_entry.is_file():
+                            stat = sub_entry.stat()
+                            signature.append((f"{entry.name}/{sub_entry.name}", stat.st_mtime_ns, stat.st_size))
+    return tuple(sorted(signature))
+
+
+class KnowledgeBaseRegistry:
+    """
+    进程级知识库注册表
+
+    - 按知识库名称缓存加载结果，多次检索共享同一份索引和元数据
+    - 目录内文件的修改时间或大小变化时自动重新加载
+    - 缓存总大小超过内存预算时按LRU顺序淘汰
+    - 被淘汰、重新加载替换或手动失效的数据在CLOSE_DELAY秒后调用closer释放文件映射和句柄
+    - 统计命中、未命中、加载耗时等指标
+    """
+
+    def __init__(self, loader: Callable[[str], Dict[str, Any]], root: str, max_bytes: int,
+                 closer: Optional[Callable[[Dict[str, Any]], None]] = None, close_delay: float = CLOSE_DELAY):
+        """
+        参数:
+            loader: 从知识库目录加载数据的函数，参数为知识库目录
+            root: 知识库根目录
+            max_bytes: 缓存内存预算（以知识库文件大小近似）
+            closer: 释放知识库数据的函数，为None时只丢弃引用
+            close_delay: 延迟关闭的秒数
+        """
+        self._loader = loader
+        self._closer = closer
+        self.close_delay = close_delay
+        self._root = root
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # kb_name -> (signature, kb_data, nbytes)
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "reloads": 0,
+            "evictions": 0,
+            "load_count": 0,
+            "load_time": 0.0
+        }
+
+    def kb_dir(self, kb_name: str) -> str:
+        return os.path.join(self._root, kb_name)
+
+    def signature(self, kb_name: str) -> Tuple[Tuple[str, int, int], ...]:
+        """返回知识库当前的文件签名，知识库不存在时抛出ValueError"""
+        kb_dir = self.kb_dir(kb_name)
+        if not os.path.exists(kb_dir):
+            raise ValueError(f"知识库 '{kb_name}' 不存在")
+        return kb_signature(kb_dir)
+
+    def get(self, kb_name: str) -> Dict[str, Any]:
+        """获取知识库数据，缓存失效时重新加载"""
+        kb_dir = self.kb_dir(kb_name)
+        if not os.path.exists(kb_dir):
+            raise ValueError(f"知识库 '{kb_name}' 不存在")
+
+        signature = kb_signature(kb_dir)
+        with self._lock:
+            entry = self._entries.get(kb_name)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(kb_name)
+                self._stats["hits"] += 1
+                return entry[1]
+            load_lock = self._load_locks.setdefault(kb_name, threading.Lock())
+
+        # 同一知识库只允许一个线程加载，其他线程等待后直接复用结果
+        with load_lock:
+            signature = kb_signature(kb_dir)
+            with self._lock:
+                entry = self._entries.get(kb_name)
+                if entry is not None and entry[0] == signature:
+                    self._entries.move_to_end(kb_name)
+                    self._stats["hits"] += 1
+                    return entry[1]
+                self._stats["misses"] += 1
+                if entry is not None:
+                    self._stats["reloads"] += 1
+
+            start_time = time.time()
+            kb_data = self._loader(kb_dir)
+            load_time = time.time() - start_time
+            nbytes = sum(size for name, _, size in signature if not name.endswith(MMAP_ONLY_SUFFIXES))
+
+            with self._lock:
+                self._stats["load_count"] += 1
+                self._stats["load_time"] += load_time
+                old_entry = self._entries.pop(kb_name, None)
+                if old_entry is not None:
+                    self._retire(old_entry[1])
+                self._entries[kb_name] = (signature, kb_data, nbytes)
+                self._evict()
+
+            print(f"知识库 '{kb_name}' 加载完成，用时{load_time:.2f}秒")
+            return kb_data
+
+    def _evict(self):
+        """超出内存预算时淘汰最久未使用的知识库，至少保留最近一个"""
+        total = sum(entry[2] for entry in self._entries.values())
+        while total > self.max_bytes and len(self._entries) > 1:
+            kb_name, (_, kb_data, nbytes) = self._entries.popitem(last=False)
+            self._retire(kb_data)
+            total -= nbytes
+            self._stats["evictions"] += 1
+            print(f"知识库缓存超出预算，淘汰: {kb_name}")
+
+    def invalidate(self, kb_name: str = None):
+        """手动失效指定知识库，kb_name为None时清空全部缓存"""
+        with self._lock:
+            if kb_name is None:
+                entries = list(self._entries.values())
+                self._entries.clear()
+            else:
+                entries = [self._entries.pop(kb_name)] if kb_name in self._entries else []
+            for entry in entries:
+                self._retire(entry[1])
+
+    def _retire(self, kb_data: Dict[str, Any]):
+        """延迟释放不再缓存的知识库数据，进行中的检索仍持有引用，不能立即关闭"""
+        if self._closer is None:
+            return
+        timer = threading.Timer(self.close_delay, self._close, args=(kb_data,))
+        timer.daemon = True
+        timer.start()
+
+    def _close(self, kb_data: Dict[str, Any]):
+        try:
+            self._closer(kb_data)
+        except Exception as e:
+            print(f"释放知识库数据出错: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        """返回缓存统计信息"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["cached"] = list(self._entries.keys())
+            stats["cached_bytes"] = sum(entry[2] for entry in self._entries.values())
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        stats["avg_load_time"] = stats["load_time"] / stats["load_count"] if stats["load_count"] else 0.0
+        return stats
@@ -8,74 +8,90 @@ import os
 import time
 from typing import List, Dict, Any
 
+import numpy as np
+
 # 从contextual_rewrite.py导入必要函数
 from RAG.retrieval.contextual_rewrite import (
     get_embedding,
     load_knowledge_base,
     list_knowledge_bases,
-    reranker
+    get_kb_members
 )
-from config import SUB_QUERY_TOP_K, SUB_QUERY_TOP_P, FINAL_DOCS_TOP_K
+from RAG.retrieval.fusion import rank_documents, doc_key
+from config import SUB_QUERY_TOP_K, SUB_QUERY_TOP_P, SUB_QUERY_OVERFETCH, RERANK_MODE
+
+
+def search_summary_index(kb_name: str, query_embedding: np.ndarray, top_k: int) -> List[Dict[str, Any]]:
+    """在单个知识库的摘要索引中检索，返回按相似度降序、带relevance_score的文档"""
+    print(f"加载知识库: {kb_name}")
+    kb_data = load_knowledge_base(kb_name)
+    summary_index = kb_data["summary_index"]
+    documents = kb_data["documents"]
+
+    scores, indices = summary_index.search(query_embedding, top_k * SUB_QUERY_OVERFETCH)
+    results = []
+    for score, doc_idx in zip(scores[0], indices[0]):
+        if doc_idx >= 0 and documents.is_alive(doc_idx):
+            doc = documents.get(doc_idx)
+            doc['relevance_score'] = float(score)
+            results.append(doc)
+    return results
 
 
 def naive_retrieve_from_knowledge_base(kb_name: str,
                                        query: str,
                                        top_k: int = SUB_QUERY_TOP_K,
                                        top_p: float = SUB_QUERY_TOP_P,
-                                       do_rerank: bool = True) -> List[Dict[str, Any]]:
+                                       do_rerank: bool = True,
+                                       query_embedding: np.ndarray = None,
+                                       rerank_mode: str = None) -> List[Dict[str, Any]]:
     """
     朴素检索函数，直接对原始查询进行嵌入并检索
 
     参数:
-        kb_name: 知识库名称
+        kb_name: 知识库名称，虚拟知识库会检索所有成员并按相似度合并
         query: 用户查询
         top_k: 检索返回的结果数量
         top_p: 检索保留的结果比例
         do_rerank: 是否进行重排序
+        query_embedding: 已生成的查询向量，为None时请求嵌入服务
+        rerank_mode: 排序方式，为None时do_rerank为True使用RERANK_MODE，否则为none
 
     返回:
         检索到的文档列表
     """
-    # 加载知识库
-    print(f"加载知识库: {kb_name}")
-    kb_data = load_knowledge_base(kb_name)
-    metadata = kb_data["metadata"]
-    summary_index = kb_data["summary_index"]
-    documents = metadata["documents"]
-
     # 开始检索
     start_time = time.time()
 
     # 对原始查询进行嵌入
-    query_embedding = get_embedding(query)
+    if query_embedding is None:
+        query_embedding = get_embedding(query)
+    query_embedding = np.asarray(query_embedding, dtype=np.float32).reshape(1, -1)
 
-    # 检索摘要
-    scores, indices = summary_index.search(query_embedding, top_k * 2)
+    members = get_kb_members(kb_name)
+    if members is None:
+        retrieve_results = search_summary_index(kb_name, query_embedding, top_k)
+    else:
+        # 各成员知识库使用同一嵌入模型，摘要相似度可以直接比较
+        retrieve_results = []
+        for member in members:
+            for doc in search_summary_index(member, query_embedding, top_k):
+                doc['kb_name'] = member
+                retrieve_results.append(doc)
+        retrieve_results.sort(key=lambda doc: doc['relevance_score'], reverse=True)
 
     # 根据top_p过滤结果
-    retrieve_results = []
-    if scores[0].size > 0:
-        max_score = scores[0][0]
-        threshold = max_score * top_p
-
-        for score, doc_idx in zip(scores[0], indices[0]):
-            if score >= threshold and doc_idx < len(documents):
-                doc = documents[doc_idx].copy()
-                doc['relevance_score'] = float(score)
-                retrieve_results.append(doc)
+    if retrieve_results:
+        threshold = retrieve_results[0]['relevance_score'] * top_p
+        retrieve_results = [doc for doc in retrieve_results if doc['relevance_score'] >= threshold]
 
     # 限制结果数量
     retrieve_results = retrieve_results[:top_k]
 
-    # 对结果进行重排序
-    if do_rerank and retrieve_results:
-        print("对检索结果进行重排序...")
-        final_docs = reranker(query, retrieve_results)
-        # 限制返回数量
-        final_docs = final_docs[:FINAL_DOCS_TOP_K]
-    else:
-        # 如果不进行重排序，直接限制返回数量
-        final_docs = retrieve_results[:FINAL_DOCS_TOP_K]
+    # 对结果进行排序，重排序模型不可用或超出时延预算时按检索得分排序
+    summary_scores = {doc_key(doc): doc["relevance_score"] for doc in retrieve_results}
+    final_docs, _ = rank_documents(query, retrieve_results, {"summary": summary_scores},
+                                   rerank_mode or (RERANK_MODE if do_rerank else "none"))
 
     print(f"检索完成，用时{time.time() - start_time:.2f}秒，返回{len(final_docs)}条结果")
 
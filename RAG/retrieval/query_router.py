@@ -0,0 +1,189 @@
+# coding:utf-8
+# @File  : query_router.py
+# @Author: ganchun
+# @Date  :  2025/06/20
+# @Description: 本地检索路由，决定查询是否检索、走朴素检索还是查询重写+双层检索
+
+import re
+import json
+import time
+import threading
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from RAG.retrieval.contextual_rewrite import get_embeddings, retrieve_from_knowledge_base
+from RAG.retrieval.naive import naive_retrieve_from_knowledge_base
+from config import ROUTER_ENABLED, ROUTER_SHORT_QUERY_LEN, ROUTER_MIN_MARGIN, ROUTER_EXAMPLES_PATH
+
+ROUTE_NONE = "none"  # 不检索，直接由大模型回答
+ROUTE_NAIVE = "naive"  # 原始查询直接检索，不调用远程大模型重写
+ROUTE_CONTEXTUAL = "contextual"  # 查询重写+双层检索
+ROUTES = (ROUTE_NONE, ROUTE_NAIVE, ROUTE_CONTEXTUAL)
+
+# 闲聊、问候等无需检索的表达
+CHITCHAT_PATTERN = re.compile(
+    r"^(你好|您好|嗨|哈喽|hi|hello|hey|谢谢|多谢|感谢|thanks|thank you|再见|拜拜|bye|好的|好|嗯|ok|收到|"
+    r"早上好|晚上好|下午好|你是谁|你叫什么)[呀啊吗呢哦!！。.,，~～\s]*$",
+    re.IGNORECASE
+)
+# 多意图、比较、指代上下文等需要查询重写的标志
+COMPLEX_PATTERN = re.compile(r"比较|对比|区别|差异|异同|分别|以及|并且|同时|和.+的|与.+的|哪些|为什么|如何|怎么|它|这个|那个|上述|上面")
+
+# 最近质心分类器的默认样例，可通过ROUTER_EXAMPLES_PATH指定的JSON文件覆盖
+DEFAULT_ROUTE_EXAMPLES = {
+    ROUTE_NONE: [
+        "你好", "谢谢你的帮助", "你是谁", "今天心情不错", "再见", "帮我写一首诗", "讲个笑话"
+    ],
+    ROUTE_NAIVE: [
+        "变压器的额定容量是什么", "什么是继电保护", "断路器的作用", "Qwen2.5的参数量",
+        "电力系统的频率标准", "什么是无功功率", "光伏发电的原理"
+    ],
+    ROUTE_CONTEXTUAL: [
+        "比较Qwen2.5和Qwen1.5模型架构", "变压器和电抗器在结构和用途上有什么区别",
+        "为什么线路过载会导致保护动作，应该如何处理", "上面提到的方法有哪些缺点",
+        "分别介绍风电和光伏并网对电网稳定性的影响", "它的工作原理和适用场景是什么"
+    ]
+}
+
+
+class QueryRouter:
+    """
+    检索路由器
+
+    先用规则处理明确的情况（闲聊不检索、多意图走重写），
+    其余查询用嵌入向量的最近质心分类，置信度不足时按长度回退到规则。
+    同时统计每条路由的请求数、耗时和有结果的比例
+    """
+
+    def __init__(self, examples: Dict[str, List[str]] = None):
+        self.examples = examples or DEFAULT_ROUTE_EXAMPLES
+        self._centroids = None
+        self._lock = threading.Lock()
+        self._stats = {route: {"count": 0, "total_time": 0.0, "non_empty": 0} for route in ROUTES}
+
+    def _get_centroids(self) -> Optional[np.ndarray]:
+        """首次使用时嵌入样例并计算各路由的质心，嵌入服务不可用时返回None"""
+        with self._lock:
+            if self._centroids is None:
+                centroids = []
+                for route in ROUTES:
+                    vectors = get_embeddings(self.examples.get(route, []))
+                    vectors = vectors[np.any(vectors != 0, axis=1)]
+                    if len(vectors) == 0:
+                        return None
+                    centroid = vectors.mean(axis=0)
+                    centroids.append(centroid / np.linalg.norm(centroid))
+                self._centroids = np.stack(centroids).astype(np.float32)
+            return self._centroids
+
+    def route(self, query: str, query_embedding: np.ndarray = None) -> str:
+        """
+        为查询选择检索路由
+
+        参数:
+            query: 用户查询
+            query_embedding: 已归一化的查询向量，为None时按需生成
+
+        返回:
+            ROUTES中的一个
+        """
+        text = query.strip()
+        if not text or CHITCHAT_PATTERN.match(text):
+            return ROUTE_NONE
+        if COMPLEX_PATTERN.search(text) or len(re.findall(r"[?？]", text)) > 1:
+            return ROUTE_CONTEXTUAL
+
+        fallback = ROUTE_NAIVE if len(text) <= ROUTER_SHORT_QUERY_LEN else ROUTE_CONTEXTUAL
+        centroids = self._get_centroids()
+        if centroids is None:
+            return fallback
+        if query_embedding is None:
+            query_embedding = get_embeddings([text])[0]
+        if not np.any(query_embedding):
+            return fallback
+
+        similarities = centroids @ query_embedding.reshape(-1)
+        order = np.argsort(-similarities)
+        if similarities[order[0]] - similarities[order[1]] < ROUTER_MIN_MARGIN:
+            return fallback
+        return ROUTES[order[0]]
+
+    def record(self, route: str, elapsed: float, non_empty: bool):
+        with self._lock:
+            stats = self._stats[route]
+            stats["count"] += 1
+            stats["total_time"] += elapsed
+            stats["non_empty"] += int(non_empty)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回每条路由的请求占比、平均耗时和有结果的比例"""
+        with self._lock:
+            stats = {route: dict(values) for route, values in self._stats.items()}
+        total = sum(values["count"] for values in stats.values())
+        for values in stats.values():
+            count = values["count"]
+            values["share"] = count / total if total else 0.0
+            values["avg_time"] = values["total_time"] / count if count else 0.0
+            values["non_empty_rate"] = values["non_empty"] / count if count else 0.0
+        return stats
+
+
+def load_route_examples(path: str) -> Dict[str, List[str]]:
+    """读取路由样例，格式为 {"none": [...], "naive": [...], "contextual": [...]}"""
+    with open(path, 'r', encoding='utf-8') as f:
+        examples = json.load(f)
+    unknown = set(examples) - set(ROUTES)
+    if unknown:
+        raise ValueError(f"未知的路由: {', '.join(unknown)}，可选: {', '.join(ROUTES)}")
+    return examples
+
+
+query_router = QueryRouter(load_route_examples(ROUTER_EXAMPLES_PATH) if ROUTER_EXAMPLES_PATH else None)
+
+
+def routed_retrieve(kb_name: str, query: str, do_rerank: bool = True, rerank_mode: str = None,
+                    query_embedding: np.ndarray = None) -> Dict[str, Any]:
+    """
+    按路由结果检索，返回格式与retrieve_from_knowledge_base一致，对话和RAG服务都通过该函数检索
+
+    query_info中的"检索路由"记录实际使用的路由；
+    完整路由中查询重写判断无需检索时，"检索路由"仍为contextual，结果为空；
+    ROUTER_ENABLED为False时直接走完整路由
+
+    参数:
+        kb_name: 知识库名称，支持虚拟知识库
+        query: 用户查询
+        do_rerank: 是否进行重排序
+        rerank_mode: 排序方式，为None时由do_rerank决定
+        query_embedding: 已生成的查询向量（如RAG服务批量嵌入的），为None时按需生成
+    """
+    if not ROUTER_ENABLED:
+        return retrieve_from_knowledge_base(kb_name, query, do_rerank=do_rerank, rerank_mode=rerank_mode,
+                                            query_embedding=query_embedding)
+
+    start_time = time.time()
+    # 查询向量在路由和后续检索中复用，闲聊不需要
+    if query_embedding is None and not CHITCHAT_PATTERN.match(query.strip()):
+        query_embedding = get_embeddings([query])[0]
+    route = query_router.route(query, query_embedding)
+    print(f"检索路由: {route}")
+
+    if route == ROUTE_NONE:
+        result = {"query_info": {"原始查询": query}, "retrieved_docs": []}
+    elif route == ROUTE_NAIVE:
+        docs = naive_retrieve_from_knowledge_base(kb_name, query, do_rerank=do_rerank,
+                                                  query_embedding=query_embedding, rerank_mode=rerank_mode)
+        result = {"query_info": {"原始查询": query}, "retrieved_docs": docs}
+    else:
+        result = retrieve_from_knowledge_base(kb_name, query, do_rerank=do_rerank, rerank_mode=rerank_mode,
+                                              query_embedding=query_embedding)
+
+    result["query_info"]["检索路由"] = route
+    query_router.record(route, time.time() - start_time, bool(result["retrieved_docs"]))
+    return result
+
+
+def get_router_stats() -> Dict[str, Any]:
+    """返回各检索路由的统计信息"""
+    return query_router.stats()
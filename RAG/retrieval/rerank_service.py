@@ -0,0 +1,208 @@
+# coding:utf-8
+# @File  : rerank_service.py
+# @Author: ganchun
+# @Date  :  2025/06/21
+# @Description: 重排序服务，文档截断 + 分批并发请求 + (查询, 文档)得分缓存 + 限时等待、排队上限和熔断
+
+import time
+import hashlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, CancelledError
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Dict, List, Optional
+
+from RAG.cache import TTLCache
+from RAG.clients import get_reranker_model, reset_reranker_model
+from config import (RERANK_MAX_DOC_CHARS, RERANK_BATCH_SIZE,
+                    RERANK_MAX_CONCURRENCY, RERANK_CACHE_SIZE, RERANK_MAX_PENDING,
+                    RERANK_BREAKER_FAILURES, RERANK_BREAKER_COOLDOWN)
+
+
+def _hash(text: str) -> str:
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+class RerankUnavailable(RuntimeError):
+    """重排序请求排队已满或处于熔断期间，调用方应直接降级"""
+
+
+class RerankService:
+    """
+    重排序服务
+
+    - 文档内容截断到max_doc_chars，避免长文本拖慢重排序模型
+    - 未缓存的候选按batch_size分批，最多max_concurrency批同时请求
+    - 得分按(查询哈希, 截断后文本哈希)缓存，同一问题短时间内重复检索不再重复打分；
+      使用文本哈希而不是文档ID，不同知识库或重建后ID复用也不会取到错误的得分
+    - 限时等待超时后取消请求：排队中的直接取消，进行中的不再发出剩余批次，避免模型变慢时超时请求占满线程；
+      排队和进行中的请求超过max_pending时不再提交，连续失败breaker_failures次后熔断breaker_cooldown秒
+    """
+
+    def __init__(self, max_doc_chars: int = RERANK_MAX_DOC_CHARS, batch_size: int = RERANK_BATCH_SIZE,
+                 max_concurrency: int = RERANK_MAX_CONCURRENCY, cache_size: int = RERANK_CACHE_SIZE,
+                 max_pending: int = RERANK_MAX_PENDING, breaker_failures: int = RERANK_BREAKER_FAILURES,
+                 breaker_cooldown: float = RERANK_BREAKER_COOLDOWN):
+        self.max_doc_chars = max_doc_chars
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+        self.score_cache = TTLCache(cache_size)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._failures = 0  # 连续失败次数
+        self._open_until = 0.0  # 熔断结束时间
+        self._stats = {"timeouts": 0, "errors": 0, "rejected": 0}
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="rerank")
+        # 整次重排序请求在单独的线程池中执行，调用方可以限时等待；
+        # 与分批请求的线程池分开，避免外层任务占满线程后等待内层任务造成死锁
+        self._dispatcher = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="rerank-request")
+
+    def _score_batch(self, query: str, corpus: List[str]) -> List[float]:
+        """对一批文本打分，返回与corpus顺序一致的得分"""
+        model = get_reranker_model()
+        rerank_result = model.rerank(corpus, query)
+        if 'results' not in rerank_result:
+            raise ValueError("重排序结果格式不正确")
+        scores = [None] * len(corpus)
+        for item in rerank_result['results']:
+            idx = item['index']
+            if 0 <= idx < len(corpus):
+                scores[idx] = item['relevance_score']
+        if any(score is None for score in scores):
+            raise ValueError("重排序结果缺少部分文档的得分")
+        return scores
+
+    def score(self, query: str, texts: List[str], cancelled: Optional[threading.Event] = None) -> List[float]:
+        """
+        计算查询与每个文本的相关性得分，优先使用缓存
+
+        出错时抛出异常并丢弃缓存的模型句柄，由调用方决定如何降级；
+        cancelled被设置后不再发出尚未开始的批次，抛出CancelledError
+        """
+        query_hash = _hash(query)
+        texts = [text[:self.max_doc_chars] for text in texts]
+        keys = [(query_hash, _hash(text)) for text in texts]
+        scores = [self.score_cache.get(key) for key in keys]
+
+        # 相同文本只打分一次
+        missing = list(dict.fromkeys(text for text, score in zip(texts, scores) if score is None))
+        if missing:
+            batches = [missing[start:start + self.batch_size]
+                       for start in range(0, len(missing), self.batch_size)]
+
+            def score_batch(batch):
+                if cancelled is not None and cancelled.is_set():
+                    raise CancelledError()
+                return self._score_batch(query, batch)
+
+            try:
+                batch_scores = list(self._executor.map(score_batch, batches))
+            except CancelledError:
+                raise
+            except Exception:
+                reset_reranker_model()
+                raise
+            new_scores = {}
+            for batch, values in zip(batches, batch_scores):
+                new_scores.update(zip(batch, values))
+            for i, text in enumerate(texts):
+                if scores[i] is None:
+                    scores[i] = new_scores[text]
+                    self.score_cache.set(keys[i], scores[i])
+        return scores
+
+    def rerank(self, query: str, documents: List[Dict[str, Any]],
+               cancelled: Optional[threading.Event] = None) -> List[Dict[str, Any]]:
+        """
+        按相关性得分对文档排序
+
+        候选数较少时是否跳过重排序由fusion.rank_documents决定（改用融合得分排序），这里总是调用模型
+
+        参数:
+            query: 用户查询
+            documents: 候选文档
+            cancelled: 取消标志，见score
+
+        返回:
+            按得分降序排列、带relevance_score字段的文档副本
+        """
+        if not documents:
+            return []
+
+        scores = self.score(query, [doc.get('内容', '') for doc in documents], cancelled)
+        reranked_docs = []
+        for doc, score in zip(documents, scores):
+            doc = doc.copy()
+            doc['relevance_score'] = score
+            reranked_docs.append(doc)
+        reranked_docs.sort(key=lambda doc: doc['relevance_score'], reverse=True)
+        return reranked_docs
+
+    def submit(self, query: str, documents: List[Dict[str, Any]],
+               cancelled: Optional[threading.Event] = None) -> Future:
+        """
+        异步执行rerank，返回Future
+
+        排队已满或处于熔断期间时抛出RerankUnavailable
+        """
+        with self._lock:
+            if time.time() < self._open_until:
+                self._stats["rejected"] += 1
+                raise RerankUnavailable("重排序模型熔断中")
+            if self._pending >= self.max_pending:
+                self._stats["rejected"] += 1
+                raise RerankUnavailable(f"重排序请求排队已达上限{self.max_pending}")
+            self._pending += 1
+        future = self._dispatcher.submit(self.rerank, query, documents, cancelled)
+        # 正常完成、出错和被取消时都会调用
+        future.add_done_callback(self._release)
+        return future
+
+    def rerank_with_budget(self, query: str, documents: List[Dict[str, Any]],
+                           latency_budget: Optional[float]) -> List[Dict[str, Any]]:
+        """
+        在时延预算内完成重排序
+
+        超时后取消请求并抛出TimeoutError；超时和出错计入熔断，成功时清零
+        """
+        cancelled = threading.Event()
+        future = self.submit(query, documents, cancelled)
+        try:
+            reranked = future.result(timeout=latency_budget)
+        except FutureTimeoutError:
+            cancelled.set()
+            future.cancel()
+            self._record_failure("timeouts")
+            raise
+        except Exception:
+            self._record_failure("errors")
+            raise
+        with self._lock:
+            self._failures = 0
+        return reranked
+
+    def _release(self, future: Future):
+        with self._lock:
+            self._pending -= 1
+
+    def _record_failure(self, kind: str):
+        with self._lock:
+            self._stats[kind] += 1
+            self._failures += 1
+            # 熔断结束后的试探请求再次失败时，连续失败数仍不低于阈值，立即重新熔断
+            if self._failures >= self.breaker_failures:
+                if time.time() >= self._open_until:
+                    print(f"重排序连续失败{self._failures}次，熔断{self.breaker_cooldown}秒")
+                self._open_until = time.time() + self.breaker_cooldown
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self.score_cache.stats()
+        with self._lock:
+            stats.update(self._stats)
+            stats["pending"] = self._pending
+            stats["breaker_open"] = time.time() < self._open_until
+        return stats
+
+
+rerank_service = RerankService()
@@ -0,0 +1,125 @@
+# coding:utf-8
+# @File  : semantic_cache.py
+# @Author: ganchun
+# @Date  :  2025/06/19
+# @Description: 语义检索缓存，与近期查询向量足够相似的问题直接复用完整检索结果
+
+import copy
+import time
+import threading
+from typing import Any, Dict, Hashable, Optional
+
+import numpy as np
+
+
+class SemanticCache:
+    """
+    按知识库分组的语义缓存
+
+    每个知识库维护一个近期查询向量矩阵，查询向量与缓存向量的内积（已归一化即余弦相似度）
+    超过阈值时返回对应的检索结果。
+
+    - 条目超过ttl秒后失效
+    - 所有知识库的条目总数超过max_entries时淘汰最早写入的条目
+    - 知识库签名变化（重建或增量更新）时清空该知识库的条目
+    """
+
+    def __init__(self, max_entries: int, ttl: Optional[float], threshold: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        # kb_name -> {"signature", "embeddings": (n, d)矩阵, "entries": [(写入时间, 变体, 结果)]}
+        self._kbs = {}
+        self._stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def _drop(self, kb, keep):
+        kb["embeddings"] = kb["embeddings"][keep]
+        kb["entries"] = [kb["entries"][i] for i in np.flatnonzero(keep)]
+
+    def _expire(self, kb):
+        if self.ttl is None or not kb["entries"]:
+            return
+        now = time.time()
+        keep = np.array([now - entry[0] <= self.ttl for entry in kb["entries"]])
+        if not keep.all():
+            self._drop(kb, keep)
+
+    def _kb(self, kb_name: str, signature: Hashable):
+        kb = self._kbs.get(kb_name)
+        if kb is not None and kb["signature"] != signature:
+            self._stats["invalidations"] += 1
+            kb = None
+        if kb is None:
+            kb = {"signature": signature, "embeddings": None, "entries": []}
+            self._kbs[kb_name] = kb
+        return kb
+
+    def lookup(self, kb_name: str, signature: Hashable, embedding: np.ndarray,
+               variant: Hashable = None) -> Optional[Dict[str, Any]]:
+        """
+        查找相似查询的缓存结果
+
+        参数:
+            kb_name: 知识库名称
+            signature: 知识库当前签名，与写入时不同则视为失效
+            embedding: 已归一化的查询向量
+            variant: 影响结果的其他检索参数（如是否重排序），需完全一致
+
+        返回:
+            命中时返回{"query": 缓存的原始查询, "similarity": 相似度, "result": 结果副本}，否则返回None
+        """
+        with self._lock:
+            kb = self._kb(kb_name, signature)
+            self._expire(kb)
+            if kb["entries"]:
+                similarities = kb["embeddings"] @ embedding.reshape(-1)
+                for i in np.argsort(-similarities):
+                    if similarities[i] < self.threshold:
+                        break
+                    _, entry_variant, result = kb["entries"][i]
+                    if entry_variant == variant:
+                        self._stats["hits"] += 1
+                        return {"query": result["query_info"].get("原始查询"),
+                                "similarity": float(similarities[i]),
+                                "result": copy.deepcopy(result)}
+            self._stats["misses"] += 1
+            return None
+
+    def add(self, kb_name: str, signature: Hashable, embedding: np.ndarray,
+            result: Dict[str, Any], variant: Hashable = None):
+        """写入一次检索结果"""
+        embedding = np.asarray(embedding, dtype=np.float32).reshape(1, -1)
+        with self._lock:
+            kb = self._kb(kb_name, signature)
+            kb["embeddings"] = embedding if kb["embeddings"] is None else np.vstack([kb["embeddings"], embedding])
+            kb["entries"].append((time.time(), variant, copy.deepcopy(result)))
+            self._evict()
+
+    def _evict(self):
+        """总条目数超限时，淘汰所有知识库中最早写入的条目"""
+        total = sum(len(kb["entries"]) for kb in self._kbs.values())
+        while total > self.max_entries:
+            oldest = min((kb for kb in self._kbs.values() if kb["entries"]),
+                         key=lambda kb: kb["entries"][0][0])
+            keep = np.ones(len(oldest["entries"]), dtype=bool)
+            keep[0] = False
+            self._drop(oldest, keep)
+            total -= 1
+
+    def invalidate(self, kb_name: str = None):
+        """清空指定知识库或全部知识库的条目"""
+        with self._lock:
+            if kb_name is None:
+                self._kbs.clear()
+            else:
+                self._kbs.pop(kb_name, None)
+            self._stats["invalidations"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = sum(len(kb["entries"]) for kb in self._kbs.values())
+        total = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / total if total else 0.0
+        return stats
@@ -5,6 +5,7 @@
 # @Description: 实现知识库检索和API调用等功能
 
 import os
+import sys
 import time
 import faiss
 import pickle
@@ -12,9 +13,13 @@ import numpy as np
 from datetime import datetime
 from tqdm import tqdm
 from typing import List, Dict, Tuple
-from openai import OpenAI
 import re
 
+# WebUI从自身目录启动，需要把项目根目录加入搜索路径以使用共享客户端
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from RAG.clients import get_openai_client
+from RAG.index_factory import apply_search_params, load_rescore_vectors, RescoringIndex
+
 # 配置
 EMBEDDING_API_URL = "http://localhost:9997/v1"
 EMBEDDING_MODEL_UID = "bge-m3"
@@ -22,11 +27,12 @@ KNOWLEDGE_BASE_ROOT = r"F:\StrivingRendersMeCozy\DeepLearning\ERAG\Data\Knowledg
 VECTOR_DIMENSION = 1024
 API_KEY = ""
 LLM_MODEL = "qwen3-32b"
+LLM_API_URL = "https://dashscope.aliyuncs.com/compatible-mode/v1"
 
 
 def get_embeddings(texts: List[str]) -> np.ndarray:
     """使用本地API获取文本的嵌入向量"""
-    client = OpenAI(api_key="not empty", base_url=EMBEDDING_API_URL)
+    client = get_openai_client(EMBEDDING_API_URL)
 
     batch_size = 32
     all_embeddings = []
@@ -67,7 +73,11 @@ def search_knowledge_base(query: str, kb_name: str, top_k: int = 2) -> List[Dict
         print(f"索引文件 {index_path} 不存在")
         return []
 
-    index = faiss.read_index(index_path)
+    index = apply_search_params(faiss.read_index(index_path))
+    # 有损压缩索引带有原始向量文件，检索结果用原始向量重打分
+    rescore_vectors = load_rescore_vectors(kb_dir, "index")
+    if rescore_vectors is not None:
+        index = RescoringIndex(index, rescore_vectors)
 
     # 加载元数据
     metadata_path = os.path.join(kb_dir, "metadata.pkl")
@@ -108,10 +118,7 @@ def search_knowledge_base(query: str, kb_name: str, top_k: int = 2) -> List[Dict
 
 def call_qwen3_api(query: str, context: List[Dict]) -> str:
     """调用Qwen3 API生成回答"""
-    client = OpenAI(
-        api_key=API_KEY,
-        base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
-    )
+    client = get_openai_client(LLM_API_URL, API_KEY)
 
     # 构建系统提示词，包含知识库内容
     system_prompt = "你是一个基于知识库的智能助手，请根据提供的知识回答用户问题。"
@@ -29,6 +29,25 @@ EMBEDDING_DIMENSION = 1024  # bge-m3的维度
 RERANKER_API_URL = "http://localhost:9997"
 RERANKER_MODEL_UID = "bge-reranker-v2-m3"
 
+# http client
+HTTP_TIMEOUT = 60  # 请求超时时间（秒）
+HTTP_CONNECT_TIMEOUT = 5  # 建立连接的超时时间（秒）
+HTTP_MAX_CONNECTIONS = 32  # 每个端点的最大连接数
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 16  # 每个端点保持的长连接数
+HTTP_MAX_RETRIES = 2  # 请求失败时的重试次数
+
+# ingest
+SEGMENT_CONCURRENCY = 8  # 语义分块同时进行的API请求数
+SEGMENT_RATE_LIMIT = 5.0  # 语义分块每秒最多发起的请求数
+SEGMENT_RATE_BURST = 10  # 令牌桶容量，允许的瞬时突发请求数
+SEGMENT_MAX_RETRIES = 5  # 单行分块失败后的最大重试次数
+SEGMENT_RETRY_BASE_DELAY = 1.0  # 重试退避的初始等待时间（秒），每次翻倍
+BI_INTENT_WORKERS = 8  # 生成总结和标签的并发线程数
+BI_INTENT_RATE_LIMIT = 5.0  # 生成总结和标签每秒最多发起的请求数
+BI_INTENT_MAX_RETRIES = 3  # 单行生成失败后的最大尝试次数
+BI_INTENT_RATE_BURST = 10  # 生成总结和标签的令牌桶容量，允许的瞬时突发请求数
+BI_INTENT_RETRY_BASE_DELAY = 1.0  # 生成总结和标签重试退避的初始等待时间（秒），每次翻倍
+
 # retrieval
 KNOWLEDGE_BASE_ROOT = r"F:\ERAG\Data\Knowledge_Base"
 SUB_QUERY_TOP_K = 5  # 子查询返回的结果数量
@@ -36,6 +55,60 @@ SUB_QUERY_TOP_P = 0.85  # 子查询保留的得分比例
 KEY_QUERY_TOP_K = 5  # 关键查询返回的结果数量
 KEY_QUERY_TOP_P = 0.8  # 关键查询保留的得分比例
 FINAL_DOCS_TOP_K = 15 # 最终返回的结果数量
+RERANK_MAX_DOC_CHARS = 1024  # 重排序时每个文档保留的最大字符数
+RERANK_BATCH_SIZE = 16  # 每次重排序请求的文档数
+RERANK_MAX_CONCURRENCY = 4  # 同时进行的重排序请求数
+RERANK_CACHE_SIZE = 8192  # 缓存的(查询, 文档)得分数量
+RERANK_EARLY_EXIT = True  # 候选文档数不超过FINAL_DOCS_TOP_K时不调用重排序模型，改用得分融合排序
+RERANK_MODE = "model"  # 默认排序方式: model/rrf/weighted/none
+RERANK_LATENCY_BUDGET = 2.0  # 重排序模型的时延预算（秒），超时或出错时改用rrf融合，为None时不限时
+RERANK_MAX_PENDING = 32  # 排队和进行中的重排序请求数上限，超出时直接改用rrf融合
+RERANK_BREAKER_FAILURES = 3  # 重排序连续超时或出错该次数后熔断，熔断期间不再提交请求
+RERANK_BREAKER_COOLDOWN = 30  # 熔断持续时间（秒），之后放行请求试探，再次失败则重新熔断
+RERANK_HTTP_TIMEOUT = 10  # 单批重排序请求的超时时间（秒），超出时延预算后仍在进行的请求最多占用线程这么久
+RRF_K = 60  # 倒数排名融合的平滑常数
+FUSION_WEIGHTS = {"summary": 1.0, "tag": 0.8, "content": 1.0, "bm25": 1.0}  # 得分融合时各路召回的权重
+SUB_QUERY_OVERFETCH = 2  # 向量检索多取top_k的倍数，再按top_p过滤；启用BM25后可适当调低
+BM25_ENABLED = True  # 构建知识库时生成BM25索引，检索时与向量检索结果融合
+BM25_TOP_K = 10  # BM25返回的结果数量
+BM25_K1 = 1.5  # BM25词频饱和参数
+BM25_B = 0.75  # BM25文档长度归一化参数
+CONTENT_INDEX_ENABLED = False  # 构建知识库时额外为文档内容建立向量索引
+CONTENT_INDEX_TYPE = "auto"  # 内容索引的类型，内容索引通常最大，数据量大时可设为sq_int8或ivf_pq压缩
+CONTENT_QUERY_TOP_K = 5  # 子查询在内容索引中返回的结果数量
+CONTENT_QUERY_TOP_P = 0.85  # 子查询在内容索引中保留的得分比例
+KB_CACHE_MAX_BYTES = 4 * 1024 ** 3  # 进程内知识库缓存的内存预算（字节）
+DOC_STORE_MMAP = True  # 以内存映射方式读取文档存储，关闭时整体读入内存并立即释放文件句柄
+REWRITE_CACHE_SIZE = 2048  # 进程内缓存的查询重写结果条数
+REWRITE_CACHE_TTL = 24 * 3600  # 查询重写结果的有效期（秒）
+REWRITE_CACHE_PATH = None  # 查询重写结果的SQLite文件路径，设置后多个工作进程共享，为None时只用进程内缓存
+SEMANTIC_CACHE_ENABLED = True  # 是否对相似查询直接复用检索结果
+SEMANTIC_CACHE_THRESHOLD = 0.95  # 查询向量余弦相似度达到该值视为同一问题
+SEMANTIC_CACHE_SIZE = 1024  # 语义缓存的最大条目数（所有知识库合计）
+SEMANTIC_CACHE_TTL = 3600  # 语义缓存条目的有效期（秒）
+RETRIEVAL_PIPELINED = False  # 查询重写期间并行加载知识库并用原始查询先行检索，两阶段检索并发执行
+RETRIEVAL_PIPELINE_WORKERS = 8  # 流水线检索的线程数
+ROUTER_ENABLED = True  # 对话和RAG服务经检索路由检索：闲聊不检索、简单查询走朴素检索，关闭时始终查询重写+双层检索
+ROUTER_SHORT_QUERY_LEN = 16  # 检索路由：不超过该长度的单意图查询走朴素检索
+ROUTER_MIN_MARGIN = 0.05  # 检索路由：最近质心与次近质心的相似度差低于该值时按规则回退
+ROUTER_EXAMPLES_PATH = None  # 检索路由样例JSON文件，为None时使用内置样例
+FEDERATED_ALL_KB_NAME = "All"  # 虚拟全库知识库名称，检索时对所有知识库联合检索，为None时按普通知识库构建All.csv
+FEDERATED_MAX_CANDIDATES = 100  # 联合检索合并后进入排序的最大候选数
+
+# vector index
+INDEX_TYPE = "auto"  # 索引类型: auto/flat/ivf_flat/ivf_pq/hnsw/sq_fp16/sq_int8，auto在数据量较大时使用ivf_flat，sq_fp16/sq_int8内存约为flat的1/2、1/4
+INDEX_FLAT_THRESHOLD = 50000  # 向量数量低于该值时始终使用flat精确检索
+IVF_NLIST = 4096  # IVF聚类中心数上限，实际值随数据量调整
+IVF_PQ_M = 64  # PQ子空间数量，需要整除向量维度
+IVF_PQ_NBITS = 8  # 每个子空间的编码位数
+HNSW_M = 32  # HNSW每个节点的邻居数
+HNSW_EF_CONSTRUCTION = 200  # HNSW构建时的搜索宽度
+IVF_NPROBE = 32  # 检索时访问的IVF聚类数，越大召回越高、速度越慢
+HNSW_EF_SEARCH = 128  # HNSW检索时的搜索宽度
+RESCORE_FACTOR = 4  # 有损压缩索引（sq_fp16/sq_int8/ivf_pq）先取top_k*该值个候选，再用原始向量重打分
+RECALL_EVAL_QUERIES = 200  # 构建有损压缩索引时评估召回率的抽样查询数
+RECALL_EVAL_K = 10  # 召回率评估的k
+INDEX_MMAP = False  # 以内存映射方式读取FAISS索引，多进程服务时通过页缓存共享；Windows下被映射的文件无法在重建时替换
 
 # fine-tune
 MODEL_PATH = r"ERAG\Model\Qwen2.5-Chat"
@@ -47,3 +120,34 @@ EPOCHS = 1
 # chat history
 CHAT_HISTORY_DIR = r"F:\StrivingRendersMeCozy\DeepLearning\ERAG\Data\Conversation"
 MAX_HISTORY_TURNS = 5  # 最大对话历史轮次
+HISTORY_FLUSH_INTERVAL = 1.0  # 对话历史缓冲写入文件的间隔（秒）
+HISTORY_FLUSH_SIZE = 64  # 缓冲的消息达到该数量时立即写入
+
+# context
+CONTEXT_TOKENIZER = None  # 计算token数使用的分词器，设为对话模型的transformers目录或名称（如"Qwen/Qwen2.5-7B-Instruct"）或"tiktoken:cl100k_base"，为None时按字符估算
+CONTEXT_MAX_TOKENS = 6144  # 发送给大模型的消息总token预算（不含生成的token）
+CONTEXT_REFERENCE_TOKENS = 3072  # 参考资料的token预算，未用完的部分留给历史对话
+CONTEXT_MAX_DOC_TOKENS = 512  # 每个参考片段最多保留的token数
+CONTEXT_MIN_DOC_TOKENS = 64  # 剩余预算低于该值时不再截断放入片段
+CONTEXT_DEDUP_THRESHOLD = 0.8  # 两个片段的字符n-gram重叠比例达到该值时只保留得分高的
+CONTEXT_HISTORY_SUMMARY = True  # 舍弃较早的对话时，将其中的用户问题压缩后保留在系统提示中
+
+# chat server
+CHAT_SERVER_PORT = 7860  # Web对话服务端口
+CHAT_MAX_CONCURRENCY = 16  # 同时处理的对话请求数，超出的请求排队等待
+CHAT_SESSION_IDLE_TIMEOUT = 1800  # 会话空闲超过该秒数后从内存中淘汰（历史记录仍保存在文件中）
+CHAT_MAX_SESSIONS = 1000  # 内存中保留的最大会话数
+CHAT_EVICT_INTERVAL = 60  # 检查空闲会话的间隔（秒）
+CHAT_RETRIEVAL_WORKERS = 16  # 执行检索和历史读写等同步操作的线程数
+
+# rag api
+RAG_API_HOST = "0.0.0.0"
+RAG_API_PORT = 8000
+RAG_API_WORKERS = 1  # 工作进程数
+RAG_API_LLM_MODEL = "qwen2.5-instruct"  # 生成回复使用的大模型，部署在LLM_API_URL
+RAG_API_DEFAULT_KB = "All"  # 请求未指定kb_name时检索的知识库
+RAG_API_BATCH_SIZE = 16  # 合并为一次嵌入请求的最大检索请求数
+RAG_API_BATCH_WAIT = 0.01  # 收集一批检索请求的最长等待时间（秒）
+RAG_API_RETRIEVAL_WORKERS = 16  # 每个进程执行检索的线程数
+RAG_API_MAX_CONCURRENCY = 64  # 每个进程到大模型服务的最大连接数
+RAG_API_PRELOAD_KBS = []  # 服务启动时预加载的知识库
@@ -16,11 +16,16 @@ from datetime import datetime
 from openai import OpenAI
 from typing import List
 
+from RAG.ingest.embedding_cache import get_embedding_cache, embed_with_cache
+from RAG.index_factory import create_index, needs_rescore, rescore_vectors_path
+from config import INDEX_TYPE
+
 # 配置参数
 EMBEDDING_MODEL_UID = "bge-m3"  # 将在运行时获取实际UID
 EMBEDDING_API_URL = "http://localhost:9997/v1"
 KNOWLEDGE_BASE_ROOT = r"F:\StrivingRendersMeCozy\DeepLearning\ERAG\Data\Knowledge_Base\jisuanjiaoyuxue"
 VECTOR_DIMENSION = 1024  # bge-m3的维度
+EMBEDDING_CACHE_DIR = r"F:\StrivingRendersMeCozy\DeepLearning\ERAG\Data\Embedding_Cache"
 INPUT_FILE = r"F:\StrivingRendersMeCozy\DeepLearning\ERAG\Data\Knowledge_Docs\final\chapter_merged.txt"
 
 
@@ -66,6 +71,12 @@ class ChineseTextSplitter:
 
 
 def get_embeddings(texts):
+    """获取文本的嵌入向量，缓存中已有的文本块不再重复请求"""
+    cache = get_embedding_cache(EMBEDDING_CACHE_DIR, EMBEDDING_MODEL_UID, VECTOR_DIMENSION)
+    return embed_with_cache(texts, request_embeddings, cache)
+
+
+def request_embeddings(texts):
     """使用本地API获取文本的嵌入向量"""
     client = OpenAI(api_key="not empty", base_url=EMBEDDING_API_URL)
 
@@ -165,15 +176,21 @@ def build_knowledge_base():
 
     # 构建FAISS索引 - 使用内积相似度（归一化后等价于余弦相似度）
     print("构建FAISS索引...")
-    index = faiss.IndexFlatIP(VECTOR_DIMENSION)
 
-    # 归一化向量以使用余弦相似度
+    # 归一化向量以使用余弦相似度，文本块数量较多时自动使用近似索引
     faiss.normalize_L2(chunk_vectors)
-    index.add(chunk_vectors)
+    index, index_params = create_index(chunk_vectors, list(range(len(all_chunks))),
+                                       VECTOR_DIMENSION, INDEX_TYPE)
 
     # 保存索引
     print("保存索引和元数据...")
     faiss.write_index(index, os.path.join(kb_dir, "index.faiss"))
+    # 有损压缩索引（sq_int8、ivf_pq等）同时保存原始向量，检索时重打分；ID即文本块下标，可直接按行保存
+    vectors_path = rescore_vectors_path(kb_dir, "index")
+    if needs_rescore(index_params):
+        np.save(vectors_path, chunk_vectors)
+    elif os.path.exists(vectors_path):
+        os.remove(vectors_path)
 
     # 保存元数据
     metadata = {
@@ -191,6 +208,7 @@ def build_knowledge_base():
         "name": kb_name,
         "chunk_count": len(all_chunks),
         "chapter_count": len(chapters),
+        "index_params": index_params,
         "source_file": INPUT_FILE,
         "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     }
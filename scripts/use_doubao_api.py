@@ -5,6 +5,8 @@
 # @Description: 如何调用豆包推理API，下面提供了一个例子
 from openai import OpenAI
 
+from RAG.clients import get_doubao_client
+
 def use_doubao_api(api_key, prompt):
     # 请确保您已将 API Key 存储在环境变量 ARK_API_KEY 中
     client = OpenAI(
@@ -28,12 +30,8 @@ def use_doubao_api(api_key, prompt):
     return result
 
 def use_doubao_api_custom(api_key, model, prompt):
-    # 请确保您已将 API Key 存储在环境变量 ARK_API_KEY 中
-    client = OpenAI(
-        # 此为默认路径，您可根据业务所在地域进行配置
-        base_url="https://ark.cn-beijing.volces.com/api/v3",
-        api_key=api_key,
-    )
+    # 复用共享客户端的连接池，避免每次请求重新建立TCP/TLS连接
+    client = get_doubao_client(api_key)
     print("----- standard request -----")
     completion = client.chat.completions.create(
         # 指定您创建的方舟推理接入点 ID，此处已帮您修改为您的推理接入点 ID